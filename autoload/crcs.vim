@@ -75,7 +75,7 @@ function! crcs#SetupCodesearchBuffer(bufname, dirname, buftype)
   
   " High level syntax groups for describing search results.
   if a:buftype ==# 'search'
-    if has('conceal')
+    if has('conceal') && !s:highlight_spans
       syn region csMatchFileSpec start=/^\d*\. /rs=s end=/\^>{$/me=e-3,re=e contains=csMatchNum,csMatchFileName keepend
     else
       syn region csMatchFileSpec start=/^\d*\. /rs=s end=/$/ contains=csMatchNum,csMatchFileName keepend
@@ -87,6 +87,8 @@ function! crcs#SetupCodesearchBuffer(bufname, dirname, buftype)
 
     nnoremap <buffer> <silent> [[ :call crcs#JumpToNextFile()<CR>
     nnoremap <buffer> <silent> ]] :call crcs#JumpToPrevFile()<CR>
+    command! -buffer -nargs=1 CrFile call crcs#JumpToNthFile(<q-args>)
+    command! -buffer CrMore call crcs#LoadMoreSearchResults()
   endif
 
   " Xref results
@@ -100,6 +102,9 @@ function! crcs#SetupCodesearchBuffer(bufname, dirname, buftype)
 
     nnoremap <buffer> <silent> [[ :call crcs#JumpToNextFile()<CR>
     nnoremap <buffer> <silent> ]] :call crcs#JumpToPrevFile()<CR>
+    command! -buffer -nargs=1 CrFile call crcs#JumpToNthFile(<q-args>)
+    nnoremap <buffer> <silent> za :call crcs#ExpandXrefCategory()<CR>
+    nnoremap <buffer> <silent> zc :call crcs#CollapseXrefCategory()<CR>
   endif
 
   if a:buftype ==# 'call'
@@ -141,6 +146,8 @@ endfunction
 
 let s:cs_buffer = -1
 let s:initialized = 0
+let s:job_timer = -1
+let s:highlight_spans = 0
 let s:plugin_root = resolve(expand('<sfile>:p:h:h'))
 
 " This needs to be called from a BufDelete auto command where |bufnr| is set
@@ -163,7 +170,10 @@ function! crcs#Setup()
   exec "py CR_CS_PYTHON_ROOT = r'" . s:plugin_root . "'"
   exec "pyf" fnameescape(s:plugin_root . "/vimsupport.py")
 
-  if !has('conceal')
+  if get(g:, 'codesearch_highlight_spans', 0) && (has('textprop') || has('nvim-0.5'))
+    let s:highlight_spans = 1
+    py EnableHighlightSpans()
+  elseif !has('conceal')
     py DisableConcealableMarkup()
   endif
 
@@ -210,6 +220,14 @@ function! crcs#JumpToPrevFile()
   py JumpToPrevFile()
 endfunction
 
+function! crcs#JumpToNthFile(n)
+  exec 'py' 'JumpToNthFile(' . str2nr(a:n) . ')'
+endfunction
+
+function! crcs#LoadMoreSearchResults()
+  py LoadMoreSearchResults()
+endfunction
+
 function! crcs#RefTypeCompleter(arglead, cmdline, cursorpos)
   call crcs#Setup()
   return pyeval("ReferenceTypeCompleter('" . a:arglead . "', '" . a:cmdline . "', '" . a:cursorpos . "')")
@@ -218,11 +236,16 @@ endfunction
 function! crcs#GoToRef(t)
   call crcs#Setup()
   let l:refs = pyeval("GetReferences('" . a:t . "')")
-  if length(l:refs) != 0
+  if len(l:refs) != 0
     cexpr l:refs
   endif
 endfunction
 
+function! crcs#ShowStats(clear)
+  call crcs#Setup()
+  exec 'py' 'ShowStats(' . (a:clear ? 'True' : 'False') . ')'
+endfunction
+
 function! crcs#ShowAnnotationsHere()
   call crcs#Setup()
   py ShowAnnotationsHere()
@@ -238,11 +261,87 @@ function! crcs#OpenCallgraphFold()
   py RunCallgraphSearch()
 endfunction
 
+function! crcs#ExpandXrefCategory()
+  py ExpandXrefCategory()
+endfunction
+
+function! crcs#CollapseXrefCategory()
+  py CollapseXrefCategory()
+endfunction
+
 function! crcs#CloseCallgraphFold()
   " Should only be called from a callgraph buffer.
   py CloseCallgraphFold()
 endfunction
 
+" Replaces the highlighting in buffer |bufnr| with |spans|. Each span is a list
+" of the form [start line, start column, end line, end column, highlight group]
+" where lines and byte columns count from 0 and the end is exclusive. Uses text
+" properties on Vim and extmarks on Neovim.
+"
+" If a first and last line are passed as optional arguments, only the
+" highlighting on those lines is replaced.
+function! crcs#ApplyHighlightSpans(bufnr, spans, ...)
+  let l:first = get(a:, 1, 0)
+  let l:last = get(a:, 2, -1)
+  if has('nvim')
+    let l:ns = nvim_create_namespace('crcs')
+    call nvim_buf_clear_namespace(a:bufnr, l:ns, l:first,
+          \ l:last < 0 ? -1 : l:last + 1)
+    for [l:line, l:col, l:end_line, l:end_col, l:group] in a:spans
+      call nvim_buf_set_extmark(a:bufnr, l:ns, l:line, l:col,
+            \ {'end_row': l:end_line, 'end_col': l:end_col, 'hl_group': l:group})
+    endfor
+    return
+  endif
+
+  let l:linecount = getbufinfo(a:bufnr)[0].linecount
+  if l:last < 0 || l:last >= l:linecount
+    let l:last = l:linecount - 1
+  endif
+  if l:first <= l:last
+    call prop_clear(l:first + 1, l:last + 1, {'bufnr': a:bufnr})
+  endif
+  let l:spans_by_group = {}
+  for [l:line, l:col, l:end_line, l:end_col, l:group] in a:spans
+    if !has_key(l:spans_by_group, l:group)
+      let l:spans_by_group[l:group] = []
+      if empty(prop_type_get(l:group))
+        call prop_type_add(l:group, {'highlight': l:group})
+      endif
+    endif
+    call add(l:spans_by_group[l:group],
+          \ [l:line + 1, l:col + 1, l:end_line + 1, l:end_col + 1])
+  endfor
+
+  for [l:group, l:locations] in items(l:spans_by_group)
+    if exists('*prop_add_list')
+      call prop_add_list({'type': l:group, 'bufnr': a:bufnr}, l:locations)
+      continue
+    endif
+    for [l:line, l:col, l:end_line, l:end_col] in l:locations
+      call prop_add(l:line, l:col, {'type': l:group, 'bufnr': a:bufnr,
+            \ 'end_lnum': l:end_line, 'end_col': l:end_col})
+    endfor
+  endfor
+endfunction
+
+" Starts polling for completed background requests unless we are already
+" polling. The timer stops itself once there are no outstanding requests.
+function! crcs#StartJobPolling()
+  if s:job_timer != -1
+    return
+  endif
+  let s:job_timer = timer_start(50, 'crcs#PollJobs', {'repeat': -1})
+endfunction
+
+function! crcs#PollJobs(timer)
+  if !pyeval('DispatchCompletedJobs()')
+    call timer_stop(a:timer)
+    let s:job_timer = -1
+  endif
+endfunction
+
 function! crcs#PrepareForTesting()
   call crcs#Setup()
   py PrepareForTesting()
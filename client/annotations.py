@@ -0,0 +1,85 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+import bisect
+
+# For type checking. Not needed at runtime.
+try:
+  from typing import Any, List, Optional
+except ImportError:
+  pass
+
+# Stands in for the end column of a range that continues past the end of a
+# line.
+END_OF_LINE = float('inf')
+
+
+def _SignatureOf(annotation):
+  for field in ('xref_signature', 'internal_link'):
+    value = getattr(annotation, field, None)
+    signature = getattr(value, 'signature', None) if value else None
+    if signature:
+      return signature
+  return None
+
+
+class AnnotationIndex(object):
+  """\
+  Answers "which annotations cover this position?" for the annotations of a
+  single file without scanning all of them.
+
+  Each annotation is filed under every line covered by its range, along with
+  the columns that it covers on that line. A lookup only considers the
+  annotations filed under the requested line. Ranges are inclusive at both
+  ends, like TextRange.Contains().
+  """
+
+  def __init__(self, annotations):
+    # type: (List[Any]) -> None
+    self.annotations_ = list(annotations)
+
+    # Maps a line number to a list of (start column, end column, index)
+    # tuples sorted by start column. |index| is the position of the annotation
+    # in |annotations_|.
+    self.lines_ = {}
+
+    for index, annotation in enumerate(self.annotations_):
+      r = annotation.range
+      for line in range(r.start_line, r.end_line + 1):
+        start = r.start_column if line == r.start_line else 0
+        end = r.end_column if line == r.end_line else END_OF_LINE
+        self.lines_.setdefault(line, []).append((start, end, index))
+
+    for spans in self.lines_.values():
+      spans.sort()
+
+  def AnnotationsAt(self, line, column):
+    # type: (int, int) -> List[Any]
+    """\
+    Returns the annotations whose range contains |line| and |column| in the
+    order in which they were passed in to the constructor.
+    """
+    spans = self.lines_.get(line)
+    if not spans:
+      return []
+    last = bisect.bisect_right(spans, (column, END_OF_LINE, END_OF_LINE))
+    return [
+        self.annotations_[index]
+        for index in sorted(
+            index for _, end, index in spans[:last] if end >= column)
+    ]
+
+  def SignatureAt(self, line, column):
+    # type: (int, int) -> Optional[str]
+    """\
+    Returns the signature of the first annotation containing |line| and
+    |column| that has one, or None.
+    """
+    for annotation in self.AnnotationsAt(line, column):
+      signature = _SignatureOf(annotation)
+      if signature:
+        return signature
+    return None
@@ -0,0 +1,246 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+import os
+import pickle
+import shutil
+import tempfile
+import zlib
+from collections import OrderedDict
+
+# For type checking. Not needed at runtime.
+try:
+  from typing import Any, Callable, Dict, Hashable, Optional
+except ImportError:
+  pass
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+SPILL_SUFFIX = '.spill'
+
+_MISSING = object()
+
+
+class BufferMap(object):
+  """\
+  A dictionary-like map from buffer numbers to the state backing the results
+  shown in those buffers, which keeps at most about |max_bytes| of that state
+  in memory.
+
+  |size_fn| is invoked with a value when it's stored or loaded back and
+  returns an estimate of the number of bytes it holds. Resize() estimates it
+  again after the value has changed. Once the estimated total exceeds
+  |max_bytes|, values are spilled to |spill_dir| in least recently used order.
+  A value is only spilled if |can_spill| returns True for its key and value,
+  e.g. if the buffer isn't visible, and if it isn't pinned via Pin().
+  |on_spill| is invoked with the key and value just before the value is
+  written out, and can drop anything that can't or shouldn't be pickled.
+
+  Spilled values are pickled and compressed. Looking up a spilled value loads
+  it back transparently. The loaded value is a copy, so references to the old
+  value that were held elsewhere no longer refer to what the map holds.
+
+  Spill files go into a temporary directory that's created on first use,
+  inside |spill_dir| if specified, and removed by Close().
+  """
+
+  def __init__(self,
+               max_bytes=DEFAULT_MAX_BYTES,
+               spill_dir=None,
+               size_fn=lambda value: 0,
+               can_spill=lambda key, value: True,
+               on_spill=lambda key, value: None):
+    self.max_bytes_ = max_bytes
+    self.parent_dir_ = spill_dir
+    self.spill_dir_ = None
+    self.size_fn_ = size_fn
+    self.can_spill_ = can_spill
+    self.on_spill_ = on_spill
+
+    # Maps a key to its value for values that are in memory, in least
+    # recently used order.
+    self.resident_ = OrderedDict()
+
+    # Maps a key in |resident_| to the estimated size of its value, and the
+    # sum of those.
+    self.sizes_ = {}
+    self.resident_bytes_ = 0
+
+    # Maps a key to the path of the file holding its spilled value.
+    self.spilled_ = {}
+
+    # Maps a key to the number of outstanding Pin() calls for it.
+    self.pins_ = {}
+
+    self.spill_count_ = 0
+    self.load_count_ = 0
+
+  def __contains__(self, key):
+    return key in self.resident_ or key in self.spilled_
+
+  def __len__(self):
+    return len(self.resident_) + len(self.spilled_)
+
+  def __getitem__(self, key):
+    value = self.get(key, _MISSING)
+    if value is _MISSING:
+      raise KeyError(key)
+    return value
+
+  def __setitem__(self, key, value):
+    self._Discard(key)
+    self._AddResident(key, value)
+    self.Trim(keep=key)
+
+  def get(self, key, default=None):
+    if key in self.resident_:
+      value = self.resident_.pop(key)
+      self.resident_[key] = value
+      return value
+    if key not in self.spilled_:
+      return default
+    value = self._Load(key)
+    if value is _MISSING:
+      return default
+    self._AddResident(key, value)
+    self.Trim(keep=key)
+    return value
+
+  def pop(self, key, default=None):
+    """\
+    Removes |key| and returns its value. A spilled value is discarded without
+    loading it, and |default| is returned instead.
+    """
+    value = self.resident_.get(key, default)
+    self._Discard(key)
+    self.pins_.pop(key, None)
+    return value
+
+  def IsSpilled(self, key):
+    return key in self.spilled_
+
+  def Pin(self, key):
+    # type: (Hashable) -> None
+    """\
+    Keeps the value for |key| in memory until a matching Unpin(). Used while
+    requests that are going to update the value are in flight.
+    """
+    self.pins_[key] = self.pins_.get(key, 0) + 1
+
+  def Unpin(self, key):
+    # type: (Hashable) -> None
+    count = self.pins_.get(key, 0) - 1
+    if count > 0:
+      self.pins_[key] = count
+    else:
+      self.pins_.pop(key, None)
+
+  def Resize(self, key):
+    # type: (Hashable) -> None
+    """\
+    Estimates the size of the value for |key| again after it has changed in
+    place, and spills other values if that takes the total over the budget.
+    """
+    if key not in self.resident_:
+      return
+    self.resident_bytes_ -= self.sizes_[key]
+    self.sizes_[key] = self.size_fn_(self.resident_[key])
+    self.resident_bytes_ += self.sizes_[key]
+    self.Trim(keep=key)
+
+  def ResidentBytes(self):
+    # type: () -> int
+    return self.resident_bytes_
+
+  def Trim(self, keep=None):
+    """\
+    Spills values other than the one for |keep| until the estimated size of
+    those that remain in memory is within the budget, or until there's nothing
+    left that can be spilled.
+    """
+    if self.resident_bytes_ <= self.max_bytes_:
+      return
+    for key, value in list(self.resident_.items()):
+      if self.resident_bytes_ <= self.max_bytes_:
+        break
+      if self.sizes_[key] == 0 or key == keep or key in self.pins_ or \
+          not self.can_spill_(key, value):
+        continue
+      self._Spill(key, value)
+
+  def _AddResident(self, key, value):
+    self.resident_[key] = value
+    self.sizes_[key] = self.size_fn_(value)
+    self.resident_bytes_ += self.sizes_[key]
+
+  def _RemoveResident(self, key):
+    self.resident_.pop(key, None)
+    self.resident_bytes_ -= self.sizes_.pop(key, 0)
+
+  def _SpillPath(self, key):
+    if self.spill_dir_ is None:
+      if self.parent_dir_ is not None and not os.path.isdir(self.parent_dir_):
+        os.makedirs(self.parent_dir_)
+      self.spill_dir_ = tempfile.mkdtemp(
+          prefix='crcs-buffers-', dir=self.parent_dir_)
+    return os.path.join(self.spill_dir_, 'buffer-{}{}'.format(
+        key, SPILL_SUFFIX))
+
+  def _Spill(self, key, value):
+    self.on_spill_(key, value)
+    try:
+      data = zlib.compress(pickle.dumps(value, protocol=2))
+      path = self._SpillPath(key)
+      with open(path, 'wb') as f:
+        f.write(data)
+    except Exception:
+      # Values that can't be written out stay in memory.
+      return False
+    self._RemoveResident(key)
+    self.spilled_[key] = path
+    self.spill_count_ += 1
+    return True
+
+  def _Load(self, key):
+    path = self.spilled_.pop(key)
+    try:
+      with open(path, 'rb') as f:
+        value = pickle.loads(zlib.decompress(f.read()))
+    except Exception:
+      # The file is gone or unreadable. The buffer no longer has any state
+      # associated with it, which is the same as for a buffer that was never
+      # populated.
+      value = _MISSING
+    self._RemoveFile(path)
+    self.load_count_ += 1
+    return value
+
+  def _Discard(self, key):
+    self._RemoveResident(key)
+    path = self.spilled_.pop(key, None)
+    if path is not None:
+      self._RemoveFile(path)
+
+  @staticmethod
+  def _RemoveFile(path):
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+
+  def Close(self):
+    """\
+    Forgets all values and removes their spill files.
+    """
+    for key in list(self.spilled_.keys()):
+      self._Discard(key)
+    self.resident_.clear()
+    self.sizes_.clear()
+    self.resident_bytes_ = 0
+    self.pins_.clear()
+    if self.spill_dir_ is not None:
+      shutil.rmtree(self.spill_dir_, ignore_errors=True)
+      self.spill_dir_ = None
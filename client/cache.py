@@ -0,0 +1,200 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+import hashlib
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+# For type checking. Not needed at runtime.
+try:
+  from typing import Any, Callable, Dict, Optional, Tuple
+except ImportError:
+  pass
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+DEFAULT_TTL_IN_SECONDS = 60 * 60
+
+ENTRY_SUFFIX = '.entry'
+
+
+class ResponseCache(object):
+  """\
+  A cache of responses that is persisted in |cache_dir|.
+
+  Each entry is stored in a file of its own. Entries are evicted in least
+  recently used order once the total size of the cache exceeds |max_bytes|.
+  The recency of an entry is tracked via the modification time of its file so
+  that it survives restarts.
+
+  Entries are tagged with a kind. An entry is fresh for |ttls[kind]| seconds
+  after it was written, or |default_ttl| seconds if |ttls| doesn't mention its
+  kind. Stale entries are still returned by Get(). What to do with them is up
+  to the caller. See Fetch().
+  """
+
+  def __init__(self,
+               cache_dir,
+               max_bytes=DEFAULT_MAX_BYTES,
+               ttls=None,
+               default_ttl=DEFAULT_TTL_IN_SECONDS,
+               stale_while_revalidate=False,
+               clock=time.time):
+    self.cache_dir_ = cache_dir
+    self.max_bytes_ = max_bytes
+    self.ttls_ = ttls or {}
+    self.default_ttl_ = default_ttl
+    self.stale_while_revalidate_ = stale_while_revalidate
+    self.clock_ = clock
+    self.lock_ = threading.Lock()
+
+    # Keys for which a background refresh is in progress.
+    self.refreshing_ = set()
+
+    # Maps an entry file name to its size in bytes, in least recently used
+    # order.
+    self.entries_ = OrderedDict()
+    self.total_bytes_ = 0
+
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    self._LoadIndex()
+
+  def _LoadIndex(self):
+    entries = []
+    for name in os.listdir(self.cache_dir_):
+      if not name.endswith(ENTRY_SUFFIX):
+        continue
+      try:
+        st = os.stat(os.path.join(self.cache_dir_, name))
+      except OSError:
+        continue
+      entries.append((st.st_mtime, name, st.st_size))
+    for _, name, size in sorted(entries):
+      self.entries_[name] = size
+      self.total_bytes_ += size
+    self._Evict()
+
+  def _PathFor(self, name):
+    return os.path.join(self.cache_dir_, name)
+
+  @staticmethod
+  def _NameFor(key):
+    return hashlib.sha1(key.encode('utf-8')).hexdigest() + ENTRY_SUFFIX
+
+  def TtlFor(self, kind):
+    return self.ttls_.get(kind, self.default_ttl_)
+
+  def TotalBytes(self):
+    return self.total_bytes_
+
+  def _Forget(self, name):
+    self.total_bytes_ -= self.entries_.pop(name, 0)
+    try:
+      os.remove(self._PathFor(name))
+    except OSError:
+      pass
+
+  def _Evict(self):
+    while self.total_bytes_ > self.max_bytes_ and self.entries_:
+      self._Forget(next(iter(self.entries_)))
+
+  def Get(self, key, kind):
+    # type: (str, str) -> Optional[Tuple[Any, bool]]
+    """\
+    Returns a (value, is_fresh) tuple for |key|, or None if there's no entry for
+    it.
+    """
+    name = self._NameFor(key)
+    with self.lock_:
+      if name not in self.entries_:
+        return None
+      path = self._PathFor(name)
+      try:
+        with open(path, 'rb') as f:
+          stored_key, written_at, value = pickle.load(f)
+        os.utime(path, None)
+      except Exception:
+        # Unreadable or removed from under us. Either way it's no longer
+        # useful.
+        self._Forget(name)
+        return None
+      if stored_key != key:
+        return None
+      self.entries_[name] = self.entries_.pop(name)
+    return value, self.clock_() - written_at < self.TtlFor(kind)
+
+  def Put(self, key, value):
+    # type: (str, Any) -> None
+    name = self._NameFor(key)
+    data = pickle.dumps((key, self.clock_(), value), protocol=2)
+    with self.lock_:
+      path = self._PathFor(name)
+      temp_path = '{}.{}.tmp'.format(path, threading.current_thread().ident)
+      try:
+        with open(temp_path, 'wb') as f:
+          f.write(data)
+        if os.path.exists(path):
+          os.remove(path)
+        os.rename(temp_path, path)
+      except (IOError, OSError):
+        self._Forget(name)
+        return
+      self.total_bytes_ -= self.entries_.pop(name, 0)
+      self.entries_[name] = len(data)
+      self.total_bytes_ += len(data)
+      self._Evict()
+
+  def Fetch(self, key, kind, fetch):
+    # type: (str, str, Callable[[], Any]) -> Any
+    """\
+    Returns the value for |key|, invoking |fetch| to obtain it if necessary.
+
+    A fresh entry is returned as is. A missing entry is fetched and stored. A
+    stale entry is refetched before returning, unless the cache was created
+    with |stale_while_revalidate| set. In the latter case the stale value is
+    returned immediately and refetched on a background thread.
+
+    Values of None are never cached.
+    """
+    cached = self.Get(key, kind)
+    if cached is not None:
+      value, is_fresh = cached
+      if is_fresh:
+        return value
+      if self.stale_while_revalidate_:
+        self._RefreshInBackground(key, fetch)
+        return value
+
+    value = fetch()
+    if value is not None:
+      self.Put(key, value)
+    return value
+
+  def _RefreshInBackground(self, key, fetch):
+    with self.lock_:
+      if key in self.refreshing_:
+        return
+      self.refreshing_.add(key)
+
+    def Refresh():
+      try:
+        value = fetch()
+        if value is not None:
+          self.Put(key, value)
+      except Exception:
+        # The stale entry remains in place and the next lookup tries again.
+        pass
+      finally:
+        with self.lock_:
+          self.refreshing_.discard(key)
+
+    thread = threading.Thread(target=Refresh)
+    thread.daemon = True
+    thread.start()
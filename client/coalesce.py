@@ -0,0 +1,89 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+import threading
+
+# For type checking. Not needed at runtime.
+try:
+  from typing import Any, Callable, Dict, Hashable, Optional
+except ImportError:
+  pass
+
+
+class _Fetch(object):
+  """\
+  A fetch that's in flight, along with its outcome once it's done.
+  """
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.exception = None
+
+
+class RequestCoalescer(object):
+  """\
+  Lets concurrent requests for the same key share a single fetch.
+
+  The first caller of Fetch() for a key invokes |fetch| on its own thread.
+  Callers that ask for the same key while that's in progress wait for it and
+  receive the same result, or the same exception, instead of fetching again.
+  Nothing is kept once the fetch completes. Later calls fetch afresh.
+
+  The result is shared as is. Callers that modify it need to copy it first.
+  """
+
+  def __init__(self):
+    self.lock_ = threading.Lock()
+
+    # Maps a key to the _Fetch that's in flight for it.
+    self.in_flight_ = {}
+
+    # Number of calls that joined a fetch that was already in flight, and
+    # number of calls that had to start one.
+    self.hit_count_ = 0
+    self.miss_count_ = 0
+
+  def Fetch(self, key, fetch):
+    # type: (Hashable, Callable[[], Any]) -> Any
+    with self.lock_:
+      pending = self.in_flight_.get(key)
+      is_leader = pending is None
+      if is_leader:
+        self.miss_count_ += 1
+        pending = self.in_flight_[key] = _Fetch()
+      else:
+        self.hit_count_ += 1
+
+    if not is_leader:
+      pending.done.wait()
+      if pending.exception is not None:
+        raise pending.exception
+      return pending.result
+
+    try:
+      pending.result = fetch()
+      return pending.result
+    except Exception as e:
+      pending.exception = e
+      raise
+    finally:
+      with self.lock_:
+        del self.in_flight_[key]
+      pending.done.set()
+
+  def InFlightCount(self):
+    # type: () -> int
+    with self.lock_:
+      return len(self.in_flight_)
+
+  def Counts(self):
+    # type: () -> Dict[str, int]
+    """\
+    Returns the number of hits and misses so far.
+    """
+    with self.lock_:
+      return {'hits': self.hit_count_, 'misses': self.miss_count_}
@@ -0,0 +1,237 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+import socket
+import sys
+import threading
+import time
+from io import BytesIO
+
+if sys.version_info.major == 3:
+  import http.client as httplib
+  from urllib.error import URLError
+  from urllib.request import BaseHandler, HTTPSHandler, ProxyHandler, \
+      build_opener, install_opener
+  from urllib.response import addinfourl
+else:
+  import httplib
+  from urllib import addinfourl
+  from urllib2 import BaseHandler, HTTPSHandler, ProxyHandler, URLError, \
+      build_opener, install_opener
+
+# For type checking. Not needed at runtime.
+try:
+  from typing import Any, Callable, Dict, List, Optional, Tuple
+except ImportError:
+  pass
+
+DEFAULT_MAX_IDLE_CONNECTIONS = 4
+
+DEFAULT_IDLE_TIMEOUT_IN_SECONDS = 30
+
+# Methods for which a request that fails on a reused connection is retried on
+# a fresh one. The server may have closed an idle connection at any time.
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+
+class ConnectionPool(object):
+  """\
+  Keeps HTTP and HTTPS connections alive across requests so that follow-up
+  requests to the same host skip connection setup, including the TLS
+  handshake.
+
+  At most |max_idle| idle connections are kept per host. Connections that have
+  been idle for longer than |idle_timeout| seconds are closed instead of being
+  reused, since the server is likely to have given up on them. |context| is
+  the ssl.SSLContext for HTTPS connections, or None for the default.
+  """
+
+  def __init__(self,
+               max_idle=DEFAULT_MAX_IDLE_CONNECTIONS,
+               idle_timeout=DEFAULT_IDLE_TIMEOUT_IN_SECONDS,
+               context=None,
+               clock=time.time):
+    self.max_idle_ = max_idle
+    self.idle_timeout_ = idle_timeout
+    self.context_ = context
+    self.clock_ = clock
+    self.lock_ = threading.Lock()
+
+    # Maps a (scheme, host) tuple to a list of (connection, time released)
+    # tuples for idle connections, most recently released last.
+    self.idle_ = {}
+
+    self.created_count_ = 0
+    self.reused_count_ = 0
+
+  def _Connect(self, scheme, host, timeout):
+    kwargs = {}
+    if timeout is not None:
+      kwargs['timeout'] = timeout
+    if scheme == 'https':
+      if self.context_ is not None:
+        kwargs['context'] = self.context_
+      connection = httplib.HTTPSConnection(host, **kwargs)
+    else:
+      connection = httplib.HTTPConnection(host, **kwargs)
+    with self.lock_:
+      self.created_count_ += 1
+    return connection
+
+  def _Acquire(self, key, timeout):
+    """\
+    Returns an idle connection for |key| or None.
+    """
+    now = self.clock_()
+    stale = []
+    connection = None
+    with self.lock_:
+      idle = self.idle_.get(key, [])
+      while idle:
+        candidate, released_at = idle.pop()
+        if now - released_at <= self.idle_timeout_:
+          connection = candidate
+          self.reused_count_ += 1
+          break
+        stale.append(candidate)
+      # Anything that's left is older still.
+      stale.extend(c for c, _ in idle)
+      del idle[:]
+    for c in stale:
+      c.close()
+    # urlopen() passes socket._GLOBAL_DEFAULT_TIMEOUT rather than None when no
+    # timeout is given, in which case the connection keeps the one it has.
+    if connection is not None and isinstance(timeout, (int, float)):
+      connection.timeout = timeout
+      if connection.sock is not None:
+        connection.sock.settimeout(timeout)
+    return connection
+
+  def _Release(self, key, connection):
+    with self.lock_:
+      idle = self.idle_.setdefault(key, [])
+      idle.append((connection, self.clock_()))
+      if len(idle) <= self.max_idle_:
+        return
+      oldest, _ = idle.pop(0)
+    oldest.close()
+
+  def Request(self, scheme, host, method, selector, body=None, headers=None,
+              timeout=None):
+    """\
+    Sends a request and returns a (status, reason, headers, body) tuple for the
+    response. The body is read in full before returning so that the
+    connection can be reused.
+
+    Raises socket.error or httplib.HTTPException if the request fails.
+    """
+    key = (scheme, host.lower())
+    headers = dict(headers or {})
+    headers['Connection'] = 'keep-alive'
+
+    connection = self._Acquire(key, timeout)
+    reused = connection is not None
+    while True:
+      if connection is None:
+        connection = self._Connect(scheme, host, timeout)
+      try:
+        connection.request(method, selector, body, headers)
+        response = connection.getresponse()
+        data = response.read()
+        break
+      except (socket.error, httplib.HTTPException):
+        connection.close()
+        if not reused or method not in IDEMPOTENT_METHODS:
+          raise
+        connection = None
+        reused = False
+      except BaseException:
+        connection.close()
+        raise
+
+    if response.will_close:
+      connection.close()
+    else:
+      self._Release(key, connection)
+    return response.status, response.reason, response.msg, data
+
+  def IdleCount(self):
+    # type: () -> int
+    with self.lock_:
+      return sum(len(idle) for idle in self.idle_.values())
+
+  def Close(self):
+    """\
+    Closes all idle connections.
+    """
+    with self.lock_:
+      idle, self.idle_ = self.idle_, {}
+    for connections in idle.values():
+      for c, _ in connections:
+        c.close()
+
+
+def _RequestAttribute(request, name):
+  # urllib2.Request in Python 2 fills in some of these attributes lazily via
+  # their getters, which are gone in Python 3.
+  getter = getattr(request, 'get_' + name, None)
+  if getter is not None:
+    return getter()
+  return getattr(request, name)
+
+
+class PooledHTTPHandler(BaseHandler):
+  """\
+  A urllib handler that sends HTTP and HTTPS requests via a ConnectionPool.
+
+  Requests that need to go through a tunnelling proxy, i.e. HTTPS requests
+  when https_proxy is set, are left to the standard HTTPSHandler. It must
+  therefore be in the same opener, which build_opener() takes care of unless
+  it's given a replacement.
+  """
+
+  # Run ahead of the standard HTTPHandler and HTTPSHandler, which would
+  # otherwise handle the request.
+  handler_order = 400
+
+  def __init__(self, pool):
+    self.pool_ = pool
+
+  def _Open(self, request):
+    if getattr(request, '_tunnel_host', None):
+      return None
+    headers = dict(request.unredirected_hdrs)
+    headers.update(request.headers)
+    scheme = _RequestAttribute(request, 'type')
+    host = _RequestAttribute(request, 'host')
+    selector = _RequestAttribute(request, 'selector')
+    data = _RequestAttribute(request, 'data')
+    try:
+      status, reason, response_headers, body = self.pool_.Request(
+          scheme, host, request.get_method(), selector, data, headers,
+          getattr(request, 'timeout', None))
+    except (socket.error, httplib.HTTPException) as e:
+      raise URLError(e)
+    response = addinfourl(
+        BytesIO(body), response_headers, request.get_full_url(), status)
+    response.msg = reason
+    return response
+
+  def http_open(self, request):
+    return self._Open(request)
+
+  def https_open(self, request):
+    return self._Open(request)
+
+
+def InstallConnectionPool(pool):
+  # type: (ConnectionPool) -> None
+  """\
+  Makes urlopen() send requests via |pool| for the rest of the process.
+  Proxies are taken from the environment as usual.
+  """
+  install_opener(
+      build_opener(ProxyHandler(), HTTPSHandler(), PooledHTTPHandler(pool)))
@@ -0,0 +1,136 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+import sys
+import threading
+
+if sys.version_info.major == 3:
+  import queue
+else:
+  import Queue as queue
+
+# For type checking. Not needed at runtime.
+try:
+  from typing import Any, Callable, Optional, Tuple
+except ImportError:
+  pass
+
+DEFAULT_NUM_WORKERS = 4
+
+
+class Job(object):
+  """\
+  A unit of work.
+
+  |func| is invoked with |args| via Run(), possibly on a worker thread. Once it
+  completes, either the return value or the raised exception is available via
+  Result().
+
+  |callback| is not invoked by the job itself. Whoever owns the job is
+  responsible for calling it once the job is done. For jobs submitted to a
+  WorkerPool, that happens in WorkerPool.DispatchCompleted().
+  """
+
+  def __init__(self, func, args=(), callback=None):
+    self.func = func
+    self.args = args
+    self.callback = callback
+    self.result_ = None
+    self.exception_ = None
+    self.done_ = threading.Event()
+
+  def Run(self):
+    try:
+      self.result_ = self.func(*self.args)
+    except Exception as e:
+      self.exception_ = e
+    self.done_.set()
+
+  def Done(self):
+    return self.done_.is_set()
+
+  def Failed(self):
+    return self.Done() and self.exception_ is not None
+
+  def Wait(self, timeout=None):
+    # type: (Optional[float]) -> bool
+    self.done_.wait(timeout)
+    return self.Done()
+
+  def Result(self):
+    """\
+    Returns the value returned by |func|. If |func| raised an exception, then
+    the same exception is raised here.
+    """
+    assert self.Done()
+    if self.exception_ is not None:
+      raise self.exception_
+    return self.result_
+
+
+class WorkerPool(object):
+  """\
+  Runs jobs on a bounded set of daemon threads.
+
+  Completion callbacks are not invoked on the worker threads. Instead they are
+  queued until the owner calls DispatchCompleted(). The Vim plugin calls the
+  latter from a timer so that callbacks are free to touch Vim state.
+  """
+
+  def __init__(self, num_workers=DEFAULT_NUM_WORKERS):
+    assert num_workers > 0
+    self.num_workers_ = num_workers
+    self.workers_ = []
+    self.pending_ = queue.Queue()
+    self.completed_ = queue.Queue()
+    self.lock_ = threading.Lock()
+    self.outstanding_ = 0
+
+  def Submit(self, func, args=(), callback=None):
+    # type: (Callable, Tuple, Optional[Callable[[Job], Any]]) -> Job
+    job = Job(func, args, callback)
+    with self.lock_:
+      self.outstanding_ += 1
+      if len(self.workers_) < min(self.num_workers_, self.outstanding_):
+        worker = threading.Thread(target=self._WorkerMain)
+        worker.daemon = True
+        worker.start()
+        self.workers_.append(worker)
+    self.pending_.put(job)
+    return job
+
+  def _WorkerMain(self):
+    while True:
+      job = self.pending_.get()
+      job.Run()
+      self.completed_.put(job)
+
+  def OutstandingCount(self):
+    """\
+    Returns the number of jobs whose callbacks haven't been dispatched yet.
+    """
+    with self.lock_:
+      return self.outstanding_
+
+  def DispatchCompleted(self):
+    # type: () -> bool
+    """\
+    Invokes the callbacks for all jobs that have completed since the last
+    call. Returns True if there are jobs that are still outstanding.
+
+    An exception raised by a callback propagates to the caller. Callbacks for
+    the remaining completed jobs are invoked on the next call.
+    """
+    while True:
+      try:
+        job = self.completed_.get_nowait()
+      except queue.Empty:
+        break
+      with self.lock_:
+        self.outstanding_ -= 1
+      if job.callback is not None:
+        job.callback(job)
+    return self.OutstandingCount() > 0
@@ -0,0 +1,454 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+"""\
+Measures how long commands take from start to finish against a server that's
+slow, jittery or failing.
+
+Starts a ReplayServer (see client/replay_server.py), then runs Vim with the
+plugin loaded and its requests sent to the replay server. Each scenario calls
+a vimsupport.py entry point and waits until its results are shown, including
+results that arrive in the background when g:codesearch_async is set. Every
+scenario runs --iterations times. The report shows:
+
+  - percentiles of the end to end time for each scenario, and how many runs
+    reported an error;
+  - percentiles for each stage that :CrStats tracks;
+  - what the replay server saw.
+
+The scenarios are:
+
+    search     RunCodeSearch() for each of --query in turn.
+    xref       RunXrefSearch() for Base64Encode in vroom/testdata.
+    signature  ShowSignature() for the same symbol.
+    callgraph  RunCallgraphSearch() for the same symbol. Needs a recorded
+               call graph response in --responses.
+
+Plugin settings are passed via --let. The server options are the same as for
+client/replay_server.py. For example:
+
+    python client/load_test.py --latency=lognormal:200,0.6 --error-rate=0.05 \\
+        --max-concurrency=2 --background-load=4 --let=codesearch_async=1
+
+Requires Vim or Neovim with Python support. Results cached by the plugin are
+dropped before each run unless --warm is specified.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+if sys.version_info.major == 3:
+  from urllib.request import urlopen
+else:
+  from urllib2 import urlopen
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(SCRIPT_DIR)
+
+PLUGIN_ROOT = os.path.dirname(SCRIPT_DIR)
+
+TESTDATA_DIR = os.path.join(PLUGIN_ROOT, 'vroom', 'testdata')
+
+import connection_pool
+import replay_server
+from stats import Series
+
+# Maps the name of a scenario to the vimsupport.py entry point that it times
+# and whether the cursor needs to be on SCENARIO_SYMBOL in SCENARIO_FILE
+# first. Only 'search' takes an argument, the query.
+SCENARIOS = OrderedDict([
+    ('search', ('RunCodeSearch', False)),
+    ('xref', ('RunXrefSearch', True)),
+    ('signature', ('ShowSignature', True)),
+    ('callgraph', ('RunCallgraphSearch', True)),
+])
+
+SCENARIO_FILE = os.path.join(TESTDATA_DIR, 'src', 'base', 'base64.cc')
+
+SCENARIO_SYMBOL = 'Base64Encode'
+
+DEFAULT_SCENARIOS = ['search', 'xref']
+
+DEFAULT_QUERIES = ['hello world']
+
+PERCENTILES = [50, 90, 95, 99, 100]
+
+# How often to check for completed background requests while waiting for a
+# command to finish.
+POLL_INTERVAL_IN_SECONDS = 0.002
+
+
+def _VimString(s):
+  return "'{}'".format(s.replace("'", "''"))
+
+
+def VimScript(config, settings):
+  # type: (Dict[str, Any], List[Tuple[str, str]]) -> str
+  """\
+  Returns a Vim script that loads the plugin with |settings|, a list of (name,
+  value) tuples for global variables, and runs RunInVim() with |config|.
+  """
+  lines = [
+      'set nocompatible hidden',
+      'let &runtimepath = {} . "," . &runtimepath'.format(
+          _VimString(PLUGIN_ROOT)),
+      'runtime plugin/crcs.vim',
+      'let g:codesearch_source_root = {}'.format(_VimString(TESTDATA_DIR)),
+  ]
+  for name, value in settings:
+    lines.append('let g:{} = {}'.format(name, value))
+  lines += [
+      'let g:codesearch_load_test = {}'.format(
+          _VimString(json.dumps(config, sort_keys=True))),
+      'call crcs#Setup()',
+      'py from client.load_test import RunInVim',
+      'py RunInVim()',
+      'qall!',
+  ]
+  return '\n'.join(lines) + '\n'
+
+
+def VimCommand(vim_binary, script):
+  # type: (str, str) -> List[str]
+  """\
+  Returns the command line that runs |script| in |vim_binary| without a UI and
+  without loading the user's configuration.
+  """
+  if os.path.basename(vim_binary).startswith('nvim'):
+    return [vim_binary, '--headless', '-u', 'NONE', '-i', 'NONE', '-n', '-S',
+            script]
+  return [vim_binary, '-N', '-u', 'NONE', '-i', 'NONE', '-n', '-es', '-S',
+          script]
+
+
+def _ForgetCachedResults(plugin):
+  with plugin.g_xref_memo_lock_:
+    plugin.g_xref_memo_.clear()
+  plugin.g_annotation_indexes_.clear()
+  plugin.g_staleness_trackers_.clear()
+
+
+def _WaitForResults(plugin, deadline):
+  """\
+  Delivers the results of background requests as they complete, like the
+  polling timer does, until there are none left. Returns False if that takes
+  until |deadline|.
+  """
+  while plugin.g_pending_jobs_ or plugin.g_pending_pages_:
+    if time.time() > deadline:
+      return False
+    plugin.DispatchCompletedJobs()
+    time.sleep(POLL_INTERVAL_IN_SECONDS)
+  return True
+
+
+def _RunScenario(vim, plugin, name, iteration, config):
+  entry_point, needs_symbol = SCENARIOS[name]
+  args = []
+  if name == 'search':
+    args.append(config['queries'][iteration % len(config['queries'])])
+  if needs_symbol:
+    vim.command('edit {}'.format(SCENARIO_FILE.replace(' ', '\\ ')))
+    vim.command('call cursor(1, 1)')
+    vim.command('call search({})'.format(_VimString(SCENARIO_SYMBOL)))
+  if not config['warm']:
+    _ForgetCachedResults(plugin)
+
+  # CalledFromVim reports errors via EchoVimError, which is looked up when
+  # it's called.
+  errors = []
+  echo = plugin.EchoVimError
+
+  def RecordingEcho(s):
+    errors.append(s)
+    echo(s)
+
+  plugin.EchoVimError = RecordingEcho
+  start = time.time()
+  try:
+    getattr(plugin, entry_point)(*args)
+    finished = _WaitForResults(plugin, start + config['timeout'])
+  finally:
+    plugin.EchoVimError = echo
+  if not finished:
+    errors.append('timed out')
+  return {'scenario': name, 'seconds': time.time() - start, 'errors': errors}
+
+
+def _RedirectRequests(plugin, server_url):
+  # Keep using the plugin's connection pool, if there is one.
+  plugin._InstallConnectionPool()
+  handlers = []
+  if plugin.g_connection_pool_:
+    handlers.append(
+        connection_pool.PooledHTTPHandler(plugin.g_connection_pool_))
+  replay_server.InstallReplayRedirect(server_url, *handlers)
+
+
+def RunInVim():
+  """\
+  Runs the scenarios described by g:codesearch_load_test inside Vim, after
+  crcs#Setup() has loaded vimsupport.py, and writes the results to the file
+  named there.
+  """
+  import vim
+  # crcs#Setup() loads vimsupport.py into Vim's __main__ module.
+  import __main__ as plugin
+
+  config = vim.vars['codesearch_load_test']
+  if not isinstance(config, str):
+    config = config.decode('utf-8')
+  config = json.loads(config)
+
+  results = {'samples': [], 'error': None}
+  try:
+    _RedirectRequests(plugin, config['server_url'])
+    for iteration in range(config['iterations']):
+      for name in config['scenarios']:
+        results['samples'].append(
+            _RunScenario(vim, plugin, name, iteration, config))
+  except Exception:
+    results['error'] = traceback.format_exc()
+  with open(config['results_path'], 'w') as f:
+    json.dump(results, f)
+
+
+class BackgroundLoad(object):
+  """\
+  Keeps the server at |server_url| busy with |clients| other clients, each of
+  which sends requests of the kinds in |kinds| in turn, one after the other.
+  """
+
+  def __init__(self, server_url, kinds, clients):
+    self.server_url_ = server_url
+    self.kinds_ = kinds
+    self.clients_ = clients
+    self.stop_ = threading.Event()
+    self.threads_ = []
+    self.lock_ = threading.Lock()
+    self.count_ = 0
+
+  def _Run(self, client):
+    i = 0
+    while not self.stop_.is_set():
+      kind = self.kinds_[i % len(self.kinds_)]
+      i += 1
+      url = '{}/codesearch/json?{}_request=b&client={}&i={}'.format(
+          self.server_url_, kind, client, i)
+      try:
+        urlopen(url, timeout=30).read()
+      except Exception:
+        pass
+      with self.lock_:
+        self.count_ += 1
+
+  def Start(self):
+    if not self.kinds_:
+      return
+    for client in range(self.clients_):
+      thread = threading.Thread(target=self._Run, args=(client,))
+      thread.daemon = True
+      thread.start()
+      self.threads_.append(thread)
+
+  def Stop(self):
+    self.stop_.set()
+    for thread in self.threads_:
+      thread.join()
+
+  def Count(self):
+    with self.lock_:
+      return self.count_
+
+
+def _PercentileColumns():
+  return ' '.join('{:>8s}'.format('max ms' if p == 100 else 'p{} ms'.format(p))
+                  for p in PERCENTILES)
+
+
+def _PercentileValues(series):
+  return ' '.join(
+      '{:>8.1f}'.format(series.Percentile(p) * 1000) for p in PERCENTILES)
+
+
+def _SeriesFor(seconds):
+  series = Series(window_size=max(1, len(seconds)))
+  for s in seconds:
+    series.Add(s)
+  return series
+
+
+def SummarizeSamples(samples):
+  # type: (List[Dict[str, Any]]) -> List[str]
+  """\
+  Returns a table of end to end time percentiles for each scenario in
+  |samples|, as written by RunInVim(), as a list of lines.
+  """
+  lines = ['{:<12s} {:>6s} {:>6s} {}'.format('scenario', 'count', 'errors',
+                                             _PercentileColumns())]
+  by_scenario = OrderedDict()
+  for sample in samples:
+    by_scenario.setdefault(sample['scenario'], []).append(sample)
+  for name, runs in by_scenario.items():
+    lines.append('{:<12s} {:>6d} {:>6d} {}'.format(
+        name, len(runs), sum(1 for r in runs if r['errors']),
+        _PercentileValues(_SeriesFor([r['seconds'] for r in runs]))))
+  return lines
+
+
+def ReadStatsLog(path):
+  # type: (str) -> List[Dict[str, Any]]
+  """\
+  Returns the entries in the g:codesearch_stats_log file at |path|.
+  """
+  if not os.path.exists(path):
+    return []
+  with open(path, 'r') as f:
+    return [json.loads(line) for line in f if line.strip()]
+
+
+def SummarizeStages(entries):
+  # type: (List[Dict[str, Any]]) -> List[str]
+  """\
+  Returns a table of time percentiles for each command and stage in |entries|
+  from the stats log, as a list of lines.
+  """
+  lines = ['{:<24s} {:<12s} {:>6s} {}'.format('command', 'stage', 'count',
+                                              _PercentileColumns())]
+  by_stage = {}
+  for entry in entries:
+    by_stage.setdefault((entry['command'], entry['stage']),
+                        []).append(entry['seconds'])
+  for (command, stage), seconds in sorted(by_stage.items()):
+    lines.append('{:<24s} {:<12s} {:>6d} {}'.format(
+        command, stage, len(seconds), _PercentileValues(_SeriesFor(seconds))))
+  return lines
+
+
+def _ParseSetting(s):
+  name, sep, value = s.partition('=')
+  if not sep or not name:
+    raise ValueError('expected NAME=VALUE: {}'.format(s))
+  return name, value
+
+
+def Main(argv):
+  parser = argparse.ArgumentParser(
+      description='Measures end to end command latency against a replay '
+      'server.')
+  parser.add_argument(
+      '--vim', default='vim', help='Vim or Neovim binary to run.')
+  parser.add_argument(
+      '--scenario',
+      action='append',
+      choices=list(SCENARIOS.keys()),
+      help='scenario to run. Can be repeated. Defaults to {}.'.format(
+          ' and '.join(DEFAULT_SCENARIOS)))
+  parser.add_argument(
+      '--query',
+      action='append',
+      help="query for the 'search' scenario. Can be repeated. Defaults to "
+      "'hello world'.")
+  parser.add_argument(
+      '--iterations',
+      type=int,
+      default=20,
+      help='number of times each scenario runs.')
+  parser.add_argument(
+      '--timeout',
+      type=float,
+      default=60,
+      help='seconds after which a run is abandoned.')
+  parser.add_argument(
+      '--warm',
+      action='store_true',
+      help="keep the plugin's cached results across runs.")
+  parser.add_argument(
+      '--let',
+      type=_ParseSetting,
+      action='append',
+      default=[],
+      help='plugin setting as NAME=VALUE, where VALUE is a Vim expression, '
+      'e.g. codesearch_async=1.')
+  parser.add_argument(
+      '--background-load',
+      type=int,
+      default=0,
+      help='number of other clients that keep the server busy.')
+  parser.add_argument(
+      '--json', help='also write the raw samples to this file.')
+  replay_server.AddServerArguments(parser)
+  args = parser.parse_args(argv)
+
+  server = replay_server.CreateServer(args)
+  server.Start()
+  background = BackgroundLoad(server.Url(), server.store_.Kinds(),
+                              args.background_load)
+  background.Start()
+  temp_dir = tempfile.mkdtemp(prefix='crcs-load-test-')
+  try:
+    results_path = os.path.join(temp_dir, 'results.json')
+    stats_log = os.path.join(temp_dir, 'stats.log')
+    settings = [('codesearch_stats_log', _VimString(stats_log))] + args.let
+    config = {
+        'server_url': server.Url(),
+        'scenarios': args.scenario or DEFAULT_SCENARIOS,
+        'queries': args.query or DEFAULT_QUERIES,
+        'iterations': args.iterations,
+        'timeout': args.timeout,
+        'warm': 1 if args.warm else 0,
+        'results_path': results_path,
+    }
+    script = os.path.join(temp_dir, 'load_test.vim')
+    with open(script, 'w') as f:
+      f.write(VimScript(config, settings))
+
+    with open(os.devnull, 'r') as devnull:
+      subprocess.call(VimCommand(args.vim, script), stdin=devnull)
+    if not os.path.exists(results_path):
+      print('{} exited without producing results. Does it have Python '
+            'support?'.format(args.vim))
+      return 1
+    with open(results_path, 'r') as f:
+      results = json.load(f)
+    stages = ReadStatsLog(stats_log)
+  finally:
+    background.Stop()
+    server.Stop()
+    shutil.rmtree(temp_dir)
+
+  if results['error']:
+    print(results['error'])
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(results['samples'], f, indent=2, sort_keys=True)
+
+  print('\n'.join(SummarizeSamples(results['samples'])))
+  print()
+  print('\n'.join(SummarizeStages(stages)))
+  print()
+  counts = server.Counts()
+  print('Server: ' + ', '.join(
+      '{} {}'.format(counts[k], k.replace('_', ' '))
+      for k in ('requests', 'exact', 'by_kind', 'missing', 'errors', 'queued',
+                'max_in_flight')))
+  if args.background_load:
+    print('Background requests: {}'.format(background.Count()))
+  return 1 if results['error'] else 0
+
+
+if __name__ == '__main__':
+  sys.exit(Main(sys.argv[1:]))
@@ -0,0 +1,99 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+# For type checking. Not needed at runtime.
+try:
+  from typing import Any, Callable, Dict, Hashable, List, Optional
+except ImportError:
+  pass
+
+DEFAULT_MAX_REQUESTS = 100
+
+
+class Prefetcher(object):
+  """\
+  Speculatively fetches results for keys on a WorkerPool and holds on to them
+  until they are needed.
+
+  |fetch| is invoked on a worker thread with a key and returns the result for
+  that key. |successors| is invoked on the thread that dispatches the pool's
+  callbacks with a result, and returns the keys that are likely to be needed
+  once that result is consumed. Those are in turn prefetched as long as their
+  depth doesn't exceed |max_depth|.
+
+  At most |max_requests| keys are fetched over the lifetime of a Prefetcher.
+  Once a Prefetcher is cancelled, results that arrive later don't lead to more
+  prefetches.
+  """
+
+  def __init__(self,
+               pool,
+               fetch,
+               successors,
+               max_depth,
+               max_requests=DEFAULT_MAX_REQUESTS):
+    self.pool_ = pool
+    self.fetch_ = fetch
+    self.successors_ = successors
+    self.max_depth_ = max_depth
+    self.max_requests_ = max_requests
+    self.request_count_ = 0
+    self.cancelled_ = False
+
+    # Maps a key to its Job.
+    self.jobs_ = {}
+
+    # Maps a key to a list of callbacks waiting for the corresponding job.
+    self.waiters_ = {}
+
+  def Prefetch(self, key, depth):
+    # type: (Hashable, int) -> None
+    if self.cancelled_ or depth > self.max_depth_ or key in self.jobs_:
+      return
+    if self.request_count_ >= self.max_requests_:
+      return
+    self.request_count_ += 1
+    self.jobs_[key] = self.pool_.Submit(
+        self.fetch_, (key,), lambda job: self._OnDone(key, depth, job))
+
+  def _OnDone(self, key, depth, job):
+    waiters = self.waiters_.pop(key, [])
+    if job.Failed():
+      # Don't hold on to failures. A subsequent Lookup() should result in a
+      # fresh request.
+      del self.jobs_[key]
+    elif not self.cancelled_:
+      for successor in self.successors_(job.Result()):
+        self.Prefetch(successor, depth + 1)
+
+    for waiter in waiters:
+      waiter(job)
+
+  def Lookup(self, key):
+    """\
+    Return the Job for |key| if one has been started, or None otherwise. The
+    job may still be in progress. Use WhenDone() to wait for it.
+    """
+    return self.jobs_.get(key, None)
+
+  def WhenDone(self, key, callback):
+    # type: (Hashable, Callable) -> bool
+    """\
+    Arrange for |callback| to be invoked with the Job for |key| once it's
+    done. The callback is invoked immediately if the job is already done.
+    Returns False if there's no job for |key|.
+    """
+    job = self.jobs_.get(key, None)
+    if job is None:
+      return False
+    if job.Done():
+      callback(job)
+    else:
+      self.waiters_.setdefault(key, []).append(callback)
+    return True
+
+  def Cancel(self):
+    self.cancelled_ = True
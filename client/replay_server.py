@@ -0,0 +1,517 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+"""\
+A local HTTP server that replays recorded code search responses, with
+configurable latency, bandwidth, error rate and concurrency.
+
+Responses are read from a directory of recordings like vroom/responses. A
+request that was recorded gets its recorded response. Any other request gets a
+recorded response of the same kind, e.g. some search response for a search
+request, so that arbitrary commands can be replayed. See ResponseStore.
+
+Clients can be pointed at the server via ReplayRedirectHandler, which sends
+requests for the real server to the replay server instead. client/load_test.py
+does this for the plugin running inside Vim. The server can also be run on its
+own:
+
+    python client/replay_server.py --port=8080 --latency=lognormal:150,0.5
+
+Latency distributions are given in milliseconds as one of:
+
+    fixed:MS
+    uniform:MIN,MAX
+    normal:MEAN,STDDEV
+    lognormal:MEDIAN,SIGMA
+    exponential:MEAN
+    recorded            The elapsed_ms of the recorded response.
+"""
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+if sys.version_info.major == 3:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+  from socketserver import ThreadingMixIn
+  from urllib.parse import parse_qsl, urlsplit
+  from urllib.request import BaseHandler, Request, build_opener, \
+      install_opener
+else:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+  from SocketServer import ThreadingMixIn
+  from urllib2 import BaseHandler, Request, build_opener, install_opener
+  from urlparse import parse_qsl, urlsplit
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+RESPONSES_DIR = os.path.join(os.path.dirname(SCRIPT_DIR), 'vroom', 'responses')
+
+# Header via which ReplayRedirectHandler passes on the URL that the client
+# originally asked for.
+ORIGINAL_URL_HEADER = 'X-Replay-Original-Url'
+
+# Number of times per second that a response is written when its bandwidth is
+# capped.
+BANDWIDTH_WRITES_PER_SECOND = 20
+
+# Injected 'timeout' errors hold on to the request for this many seconds
+# before closing the connection.
+TIMEOUT_ERROR_SECONDS = 60
+
+# Maps the name of a latency distribution to its number of parameters and a
+# function that takes a random.Random followed by the parameters in
+# milliseconds, and returns a sample in milliseconds.
+LATENCY_DISTRIBUTIONS = {
+    'fixed': (1, lambda rng, ms: ms),
+    'uniform': (2, lambda rng, low, high: rng.uniform(low, high)),
+    'normal': (2, lambda rng, mean, stddev: rng.normalvariate(mean, stddev)),
+    'lognormal': (2, lambda rng, median, sigma: rng.lognormvariate(
+        math.log(median), sigma)),
+    'exponential': (1, lambda rng, mean: rng.expovariate(1.0 / mean)),
+}
+
+
+def ParseLatency(spec):
+  """\
+  Returns a function that takes a random.Random and the recorded latency of a
+  response in seconds, and returns the latency to inject in seconds, as
+  described by |spec|. See the module documentation for the format. Raises
+  ValueError if |spec| is malformed.
+  """
+  if spec in ('', 'none'):
+    return lambda rng, recorded: 0.0
+  if spec == 'recorded':
+    return lambda rng, recorded: recorded
+
+  name, _, params = spec.partition(':')
+  if name not in LATENCY_DISTRIBUTIONS:
+    raise ValueError('unknown latency distribution: {}'.format(name))
+  count, sample = LATENCY_DISTRIBUTIONS[name]
+  try:
+    values = [float(v) for v in params.split(',')] if params else []
+  except ValueError:
+    raise ValueError('malformed latency parameters: {}'.format(spec))
+  if len(values) != count:
+    raise ValueError('{} takes {} parameter(s): {}'.format(name, count, spec))
+  if name in ('lognormal', 'exponential') and values[0] <= 0:
+    raise ValueError('{} requires a positive first parameter'.format(name))
+  return lambda rng, recorded: max(0.0, sample(rng, *values)) / 1000.0
+
+
+def ParseError(spec):
+  """\
+  Returns the kind of error to inject as described by |spec|: 'reset' closes
+  the connection without responding, 'timeout' keeps the client waiting, and
+  an HTTP status code responds with that status. Raises ValueError if |spec|
+  is malformed.
+  """
+  if spec in ('reset', 'timeout'):
+    return spec
+  status = int(spec)
+  if not 400 <= status < 600:
+    raise ValueError('not an HTTP error status: {}'.format(spec))
+  return status
+
+
+def _Hash(s):
+  return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+
+def _RequestKinds(url):
+  """\
+  Returns the kinds of requests in the CompoundRequest that |url| encodes, e.g.
+  ['search'] for a search request.
+  """
+  suffix = '_request'
+  return [
+      key[:-len(suffix)]
+      for key, _ in parse_qsl(urlsplit(url).query, keep_blank_values=True)
+      if key.endswith(suffix)
+  ]
+
+
+class Recording(object):
+  """\
+  A recorded response. |body| is the response as sent by the server and
+  |seconds| is the time the server took to produce it according to its
+  elapsed_ms field.
+  """
+
+  def __init__(self, name, body, seconds):
+    self.name = name
+    self.body = body
+    self.seconds = seconds
+
+
+class ResponseStore(object):
+  """\
+  The recorded responses in |directory|. Each is a JSON file named after the
+  SHA-1 hash of its request.
+
+  Lookup() finds the recording whose name matches the hash of the request URL
+  or of its path and query. Failing that, it picks one of the recordings of the
+  same kind as the request, e.g. a search response for a search request, based
+  on the hash of the URL. The same URL always gets the same recording.
+  """
+
+  def __init__(self, directory=RESPONSES_DIR):
+    # Maps the hash of a request to its Recording.
+    self.recordings_ = {}
+
+    # Maps a kind of request to the list of Recordings for requests of that
+    # kind, sorted by name.
+    self.by_kind_ = {}
+
+    for name in sorted(os.listdir(directory)):
+      if not name.endswith('.json'):
+        continue
+      with open(os.path.join(directory, name), 'rb') as f:
+        body = f.read()
+      d = json.loads(body.decode('utf-8'))
+      recording = Recording(name, body, d.get('elapsed_ms', 0) / 1000.0)
+      self.recordings_[name[:-len('.json')]] = recording
+      for key in d:
+        if key.endswith('_response'):
+          kind = key[:-len('_response')]
+          self.by_kind_.setdefault(kind, []).append(recording)
+
+  def Kinds(self):
+    return sorted(self.by_kind_.keys())
+
+  def Lookup(self, url):
+    """\
+    Returns a (Recording, is exact match) tuple for |url|, or (None, False) if
+    there's no recording of the right kind.
+    """
+    parts = urlsplit(url)
+    path = parts.path + ('?' + parts.query if parts.query else '')
+    for candidate in (url, path):
+      recording = self.recordings_.get(_Hash(candidate))
+      if recording is not None:
+        return recording, True
+
+    for kind in _RequestKinds(url):
+      recordings = self.by_kind_.get(kind)
+      if recordings:
+        return recordings[int(_Hash(url), 16) % len(recordings)], False
+    return None, False
+
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+  # Keeps connections alive so that clients can reuse them.
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    self.server.replay_.Serve(self)
+
+  def do_POST(self):
+    length = int(self.headers.get('Content-Length') or 0)
+    self.rfile.read(length)
+    self.server.replay_.Serve(self)
+
+  def log_message(self, *args):
+    pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+
+class ReplayServer(object):
+  """\
+  Serves the recordings in |store| over HTTP on |host|:|port|, or on a free
+  port if |port| is 0.
+
+  Before responding, each request waits for one of |max_concurrency| slots if
+  specified, and then for a latency drawn from |latency|, which is a function
+  as returned by ParseLatency(). With probability |error_rate| the request
+  then fails with |error| as returned by ParseError(). Otherwise the recording
+  is sent at no more than |bandwidth| bytes per second if specified. Requests
+  without a recording get a 404.
+
+  |seed| seeds the random numbers behind latencies and errors.
+  """
+
+  def __init__(self,
+               store,
+               latency=None,
+               bandwidth=None,
+               error_rate=0.0,
+               error=503,
+               max_concurrency=None,
+               seed=None,
+               host='127.0.0.1',
+               port=0,
+               sleep=time.sleep):
+    self.store_ = store
+    self.latency_ = latency or ParseLatency('none')
+    self.bandwidth_ = bandwidth
+    self.error_rate_ = error_rate
+    self.error_ = error
+    self.slots_ = threading.Semaphore(
+        max_concurrency) if max_concurrency else None
+    self.rng_ = random.Random(seed)
+    self.sleep_ = sleep
+    self.lock_ = threading.Lock()
+
+    self.counts_ = {
+        'requests': 0,
+        'exact': 0,
+        'by_kind': 0,
+        'missing': 0,
+        'errors': 0,
+        'queued': 0,
+        'max_in_flight': 0,
+    }
+    self.in_flight_ = 0
+
+    self.server_ = _ThreadingHTTPServer((host, port), _ReplayHandler)
+    self.server_.replay_ = self
+    self.thread_ = None
+
+  def Url(self):
+    host, port = self.server_.server_address[:2]
+    return 'http://{}:{}'.format(host, port)
+
+  def Start(self):
+    self.thread_ = threading.Thread(
+        target=self.server_.serve_forever, args=(0.05,))
+    self.thread_.daemon = True
+    self.thread_.start()
+
+  def Stop(self):
+    self.server_.shutdown()
+    self.server_.server_close()
+    self.thread_.join()
+
+  def Counts(self):
+    """\
+    Returns the number of requests received, replayed from an exact or a same
+    kind recording, and without a recording, as well as the number of errors
+    injected, the number of requests that had to wait for a slot, and the
+    largest number of requests that were served at the same time.
+    """
+    with self.lock_:
+      return dict(self.counts_)
+
+  def _Count(self, key, delta=1):
+    with self.lock_:
+      self.counts_[key] += delta
+
+  def _Random(self):
+    with self.lock_:
+      return self.rng_.random()
+
+  def _Latency(self, recorded):
+    with self.lock_:
+      return self.latency_(self.rng_, recorded)
+
+  def Serve(self, handler):
+    self._Count('requests')
+    if self.slots_ is None:
+      self._Respond(handler)
+      return
+
+    if not self.slots_.acquire(False):
+      self._Count('queued')
+      self.slots_.acquire()
+    try:
+      self._Respond(handler)
+    finally:
+      self.slots_.release()
+
+  def _Respond(self, handler):
+    with self.lock_:
+      self.in_flight_ += 1
+      self.counts_['max_in_flight'] = max(self.counts_['max_in_flight'],
+                                          self.in_flight_)
+    try:
+      url = handler.headers.get(ORIGINAL_URL_HEADER) or handler.path
+      recording, exact = self.store_.Lookup(url)
+      self.sleep_(self._Latency(recording.seconds if recording else 0.0))
+
+      if self.error_rate_ and self._Random() < self.error_rate_:
+        self._Count('errors')
+        self._SendError(handler)
+        return
+
+      if recording is None:
+        self._Count('missing')
+        self._Send(handler, 404, b'no recording for this request\n',
+                   'text/plain')
+        return
+      self._Count('exact' if exact else 'by_kind')
+      self._Send(handler, 200, recording.body, 'application/json')
+    except socket.error:
+      # The client gave up.
+      handler.close_connection = True
+    finally:
+      with self.lock_:
+        self.in_flight_ -= 1
+
+  def _SendError(self, handler):
+    handler.close_connection = True
+    if self.error_ == 'reset':
+      return
+    if self.error_ == 'timeout':
+      self.sleep_(TIMEOUT_ERROR_SECONDS)
+      return
+    self._Send(handler, self.error_, b'injected error\n', 'text/plain')
+
+  def _Send(self, handler, status, body, content_type):
+    handler.send_response(status)
+    handler.send_header('Content-Type', content_type)
+    handler.send_header('Content-Length', str(len(body)))
+    handler.end_headers()
+    if not self.bandwidth_:
+      handler.wfile.write(body)
+      return
+
+    chunk_size = max(1, int(self.bandwidth_ / BANDWIDTH_WRITES_PER_SECOND))
+    for start in range(0, len(body), chunk_size):
+      chunk = body[start:start + chunk_size]
+      handler.wfile.write(chunk)
+      handler.wfile.flush()
+      self.sleep_(float(len(chunk)) / self.bandwidth_)
+
+
+class ReplayRedirectHandler(BaseHandler):
+  """\
+  A urllib handler that sends requests for any http or https URL to the replay
+  server at |server_url| instead, keeping the path and query. The original URL
+  is passed on to the server in a header so that it can find the recording.
+  """
+
+  # Redirect before any other handler prepares the request, e.g. by adding a
+  # Host header for the original server.
+  handler_order = 100
+
+  def __init__(self, server_url):
+    self.server_url_ = server_url.rstrip('/')
+
+  def _Redirect(self, request):
+    original_url = request.get_full_url()
+    if original_url.startswith(self.server_url_ + '/'):
+      return request
+    parts = urlsplit(original_url)
+    url = self.server_url_ + (parts.path or '/')
+    if parts.query:
+      url += '?' + parts.query
+
+    data = request.get_data() if hasattr(request, 'get_data') else request.data
+    redirected = Request(url, data, dict(request.headers))
+    for key, value in request.unredirected_hdrs.items():
+      if key.lower() != 'host':
+        redirected.add_unredirected_header(key, value)
+    redirected.add_header(ORIGINAL_URL_HEADER, original_url)
+    if hasattr(request, 'timeout'):
+      redirected.timeout = request.timeout
+    return redirected
+
+  def http_request(self, request):
+    return self._Redirect(request)
+
+  def https_request(self, request):
+    return self._Redirect(request)
+
+
+def InstallReplayRedirect(server_url, *handlers):
+  """\
+  Makes urlopen() send requests to the replay server at |server_url| for the
+  rest of the process. |handlers| are passed on to build_opener(), e.g. a
+  PooledHTTPHandler to keep using a ConnectionPool.
+  """
+  install_opener(build_opener(ReplayRedirectHandler(server_url), *handlers))
+
+
+def AddServerArguments(parser):
+  # type: (argparse.ArgumentParser) -> None
+  """\
+  Adds the options that configure a ReplayServer to |parser|. See
+  CreateServer().
+  """
+  parser.add_argument(
+      '--responses',
+      default=RESPONSES_DIR,
+      help='directory containing the recorded responses.')
+  parser.add_argument(
+      '--latency',
+      type=ParseLatency,
+      default='none',
+      help='latency distribution in milliseconds, e.g. fixed:100, '
+      'uniform:50,500, normal:200,50, lognormal:150,0.5, exponential:200 or '
+      'recorded.')
+  parser.add_argument(
+      '--bandwidth',
+      type=float,
+      help='maximum rate at which each response is sent, in KB/s.')
+  parser.add_argument(
+      '--error-rate',
+      type=float,
+      default=0.0,
+      help='fraction of requests that fail, between 0 and 1.')
+  parser.add_argument(
+      '--error',
+      type=ParseError,
+      default=503,
+      help="how requests fail: an HTTP status code, 'reset' or 'timeout'.")
+  parser.add_argument(
+      '--max-concurrency',
+      type=int,
+      help='number of requests that are served at the same time. Others wait.')
+  parser.add_argument(
+      '--seed', type=int, help='seed for latencies and errors.')
+
+
+def CreateServer(args, port=0):
+  """\
+  Returns a ReplayServer configured by the options added by
+  AddServerArguments().
+  """
+  return ReplayServer(
+      ResponseStore(args.responses),
+      latency=args.latency,
+      bandwidth=args.bandwidth * 1024 if args.bandwidth else None,
+      error_rate=args.error_rate,
+      error=args.error,
+      max_concurrency=args.max_concurrency,
+      seed=args.seed,
+      port=port)
+
+
+def Main(argv):
+  parser = argparse.ArgumentParser(
+      description='Replays recorded code search responses over HTTP.')
+  parser.add_argument(
+      '--port', type=int, default=8080, help='port to listen on.')
+  AddServerArguments(parser)
+  args = parser.parse_args(argv)
+
+  server = CreateServer(args, port=args.port)
+  server.Start()
+  print('Replaying {} kind(s) of responses on {}. Press Ctrl-C to stop.'.format(
+      len(server.store_.Kinds()), server.Url()))
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    pass
+  server.Stop()
+  print(json.dumps(server.Counts(), sort_keys=True))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(Main(sys.argv[1:]))
@@ -0,0 +1,104 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+# For type checking. Not needed at runtime.
+try:
+  from typing import Callable
+except ImportError:
+  pass
+
+# Number of lines that are read from the buffer at a time while comparing it
+# against the baseline.
+CHUNK_SIZE = 512
+
+
+class StalenessTracker(object):
+  """\
+  Decides whether a prefix of a buffer differs from the version of the file
+  that's known to the server, while avoiding asking the server or rereading
+  the buffer where possible.
+
+  Once a prefix of the buffer has been verified by the server, the hashes of
+  its lines become the baseline. Later checks compare the buffer against the
+  baseline and stop at the first line that differs. Only a prefix that extends
+  past the baseline needs to be verified by the server again.
+
+  Results are remembered until the buffer's changedtick changes. A check for
+  the same or a shorter prefix at the same changedtick doesn't read the buffer
+  at all.
+  """
+
+  def __init__(self):
+    # Hashes of the leading lines of the buffer that are known to match the
+    # server's version of the file.
+    self.baseline_ = []
+
+    self.changedtick_ = None
+
+    # Number of leading lines of the buffer that have been compared against
+    # the baseline at |changedtick_| and found to match.
+    self.matched_ = 0
+
+    # True if the line following the |matched_| lines differs from the
+    # baseline.
+    self.diverged_ = False
+
+    # Length of the shortest prefix that the server reported as stale at
+    # |changedtick_|, if any.
+    self.stale_prefix_ = None
+
+  def _Reset(self, changedtick):
+    self.changedtick_ = changedtick
+    self.matched_ = 0
+    self.diverged_ = False
+    self.stale_prefix_ = None
+
+  def _CompareWithBaseline(self, end, get_lines):
+    limit = min(end, len(self.baseline_))
+    while not self.diverged_ and self.matched_ < limit:
+      chunk = get_lines(self.matched_, min(self.matched_ + CHUNK_SIZE, limit))
+      if not chunk:
+        break
+      for text in chunk:
+        if hash(text) != self.baseline_[self.matched_]:
+          self.diverged_ = True
+          break
+        self.matched_ += 1
+
+  def IsStale(self, end, changedtick, get_lines, verify):
+    # type: (int, int, Callable, Callable) -> bool
+    """\
+    Returns True if the first |end| lines of the buffer differ from the
+    server's version of the file.
+
+    |changedtick| is the current b:changedtick of the buffer. |get_lines| is
+    invoked with a half open range of 0-based line numbers and returns those
+    lines of the buffer. |verify| is invoked with a prefix of the buffer and
+    returns True if the server considers it stale.
+    """
+    if changedtick != self.changedtick_:
+      self._Reset(changedtick)
+
+    if self.stale_prefix_ is not None and end >= self.stale_prefix_:
+      return True
+
+    self._CompareWithBaseline(end, get_lines)
+    if self.matched_ >= end:
+      return False
+    if self.diverged_:
+      return True
+
+    # The prefix extends past the baseline.
+    lines = get_lines(0, end)
+    if verify(lines):
+      self.stale_prefix_ = end
+      return True
+
+    self.baseline_ = [hash(text) for text in lines]
+    # |lines| is shorter than |end| if the buffer is. Either way the whole
+    # prefix has been verified.
+    self.matched_ = end
+    return False
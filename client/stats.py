@@ -0,0 +1,243 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+import bisect
+import contextlib
+import json
+import threading
+import time
+from collections import deque
+
+# For type checking. Not needed at runtime.
+try:
+  from typing import Any, Callable, Dict, List, Optional, Tuple
+except ImportError:
+  pass
+
+# Number of most recent samples that are kept for each command and stage.
+WINDOW_SIZE = 256
+
+# Exclusive upper bounds of the histogram buckets in milliseconds. The last
+# bucket catches everything else.
+BUCKET_BOUNDS_MS = [1, 10, 100, 1000, 10000]
+
+
+class CommandRecord(object):
+  """\
+  Identifies one invocation of |command|. Stages that run on behalf of the
+  invocation, possibly on other threads, are attributed to it. |id| is unique
+  within a Stats instance and correlates the stages in the log.
+  """
+
+  def __init__(self, command, record_id):
+    self.command = command
+    self.id = record_id
+
+
+class StageTimer(object):
+  """\
+  Yielded by Stats.Stage(). Set |size| to record the size of the stage's
+  payload, e.g. the number of bytes or lines that it processed.
+  """
+
+  def __init__(self):
+    self.size = None
+
+
+class Series(object):
+  """\
+  The most recent |window_size| samples for a command and a stage, along with
+  the total number of samples ever added.
+  """
+
+  def __init__(self, window_size=WINDOW_SIZE):
+    self.seconds_ = deque(maxlen=window_size)
+    self.sizes_ = deque(maxlen=window_size)
+    self.count_ = 0
+
+  def Add(self, seconds, size=None):
+    self.seconds_.append(seconds)
+    if size is not None:
+      self.sizes_.append(size)
+    self.count_ += 1
+
+  def Count(self):
+    return self.count_
+
+  def Percentile(self, p):
+    # type: (float) -> Optional[float]
+    """\
+    Returns the |p|th percentile, 0 <= |p| <= 100, of the samples in the
+    window in seconds, or None if there are none.
+    """
+    return _Percentile(sorted(self.seconds_), p)
+
+  def SizePercentile(self, p):
+    # type: (float) -> Optional[float]
+    return _Percentile(sorted(self.sizes_), p)
+
+  def Histogram(self):
+    # type: () -> List[int]
+    """\
+    Returns the number of samples in the window that fall into each of the
+    buckets described by BUCKET_BOUNDS_MS.
+    """
+    counts = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+    for seconds in self.seconds_:
+      counts[bisect.bisect_right(BUCKET_BOUNDS_MS, seconds * 1000)] += 1
+    return counts
+
+
+def _Percentile(samples, p):
+  if not samples:
+    return None
+  index = int(round((len(samples) - 1) * p / 100.0))
+  return samples[index]
+
+
+def _FormatMs(seconds):
+  if seconds is None:
+    return '-'
+  return '{:.1f}'.format(seconds * 1000)
+
+
+def _FormatSize(size):
+  if size is None:
+    return '-'
+  return '{:.0f}'.format(size)
+
+
+class Stats(object):
+  """\
+  Collects the time taken by each stage of each command.
+
+  A command is started with Command(), which makes its CommandRecord current
+  for the calling thread. Stage() times a block of code and attributes it to
+  the current command, or to '-' if there is none. Work that's handed off to
+  another thread can be attributed to the same command by wrapping it with
+  Activate().
+
+  The most recent samples for each command and stage are kept in memory and
+  summarized by Report(). If |log_path| is specified, each sample is also
+  appended to that file as a line of JSON.
+  """
+
+  def __init__(self, log_path=None, window_size=WINDOW_SIZE, clock=time.time):
+    # type: (Optional[str], int, Callable[[], float]) -> None
+    self.log_path_ = log_path
+    self.window_size_ = window_size
+    self.clock_ = clock
+    self.lock_ = threading.Lock()
+    self.local_ = threading.local()
+    self.next_id_ = 1
+
+    # Maps a (command, stage) tuple to a Series.
+    self.series_ = {}
+
+  def Current(self):
+    # type: () -> Optional[CommandRecord]
+    return getattr(self.local_, 'record', None)
+
+  @contextlib.contextmanager
+  def Activate(self, record):
+    """\
+    Makes |record| the current CommandRecord for the calling thread while the
+    block runs.
+    """
+    previous = self.Current()
+    self.local_.record = record
+    try:
+      yield record
+    finally:
+      self.local_.record = previous
+
+  @contextlib.contextmanager
+  def Command(self, command):
+    """\
+    Starts a new invocation of |command| and records the time taken by the
+    block as its 'total' stage.
+    """
+    with self.lock_:
+      record = CommandRecord(command, self.next_id_)
+      self.next_id_ += 1
+    with self.Activate(record):
+      with self.Stage('total'):
+        yield record
+
+  @contextlib.contextmanager
+  def Stage(self, stage):
+    """\
+    Records the time taken by the block as |stage| of the current command.
+    Yields a StageTimer.
+    """
+    timer = StageTimer()
+    start = self.clock_()
+    try:
+      yield timer
+    finally:
+      self.Record(self.Current(), stage, self.clock_() - start, timer.size)
+
+  def Record(self, record, stage, seconds, size=None):
+    # type: (Optional[CommandRecord], str, float, Optional[float]) -> None
+    command = record.command if record else '-'
+    with self.lock_:
+      key = (command, stage)
+      series = self.series_.get(key)
+      if series is None:
+        series = self.series_[key] = Series(self.window_size_)
+      series.Add(seconds, size)
+      if self.log_path_:
+        self._Log({
+            'time': self.clock_(),
+            'command': command,
+            'id': record.id if record else None,
+            'stage': stage,
+            'seconds': seconds,
+            'size': size
+        })
+
+  def _Log(self, entry):
+    try:
+      with open(self.log_path_, 'a') as f:
+        f.write(json.dumps(entry, sort_keys=True) + '\n')
+    except (IOError, OSError):
+      # Don't keep failing on every sample.
+      self.log_path_ = None
+
+  def GetSeries(self, command, stage):
+    # type: (str, str) -> Optional[Series]
+    with self.lock_:
+      return self.series_.get((command, stage))
+
+  def Clear(self):
+    with self.lock_:
+      self.series_.clear()
+
+  def Report(self):
+    # type: () -> List[str]
+    """\
+    Returns a human readable summary of the samples in the window as a list of
+    lines.
+    """
+    buckets = ['<{}'.format(b) for b in BUCKET_BOUNDS_MS] + ['more']
+    lines = [
+        '{:<24s} {:<12s} {:>6s} {:>8s} {:>8s} {:>8s} {:>8s}  {}'.format(
+            'command', 'stage', 'count', 'p50 ms', 'p90 ms', 'max ms',
+            'size', 'histogram (ms): ' + ' '.join(buckets))
+    ]
+    with self.lock_:
+      keys = sorted(self.series_.keys())
+      for command, stage in keys:
+        series = self.series_[(command, stage)]
+        lines.append(
+            '{:<24s} {:<12s} {:>6d} {:>8s} {:>8s} {:>8s} {:>8s}  {}'.format(
+                command, stage, series.Count(),
+                _FormatMs(series.Percentile(50)),
+                _FormatMs(series.Percentile(90)),
+                _FormatMs(series.Percentile(100)),
+                _FormatSize(series.SizePercentile(50)),
+                ' '.join(str(c) for c in series.Histogram())))
+    return lines
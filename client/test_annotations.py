@@ -0,0 +1,113 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+import json
+import sys
+import unittest
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(SCRIPT_DIR)
+
+import annotations
+
+# A recorded response containing the annotations for base/base64.cc.
+ANNOTATION_RESPONSE = os.path.join(
+    os.path.dirname(SCRIPT_DIR), 'vroom', 'responses',
+    '24172e13a7560a2ccc1caae190e1cef9165672e3.json')
+
+
+class Struct(object):
+
+  def __init__(self, **kwargs):
+    self.__dict__.update(kwargs)
+
+
+def ToStruct(o):
+  if isinstance(o, dict):
+    return Struct(**dict((str(k), ToStruct(v)) for k, v in o.items()))
+  if isinstance(o, list):
+    return [ToStruct(v) for v in o]
+  return o
+
+
+def Annotation(start_line, start_column, end_line, end_column, signature):
+  return ToStruct({
+      'range': {
+          'start_line': start_line,
+          'start_column': start_column,
+          'end_line': end_line,
+          'end_column': end_column
+      },
+      'xref_signature': {
+          'signature': signature
+      }
+  })
+
+
+def Contains(r, line, column):
+  # Same as TextRange.Contains().
+  if line < r.start_line or line > r.end_line:
+    return False
+  if line == r.start_line and column < r.start_column:
+    return False
+  if line == r.end_line and column > r.end_column:
+    return False
+  return True
+
+
+class TestAnnotationIndex(unittest.TestCase):
+
+  def test_lookup(self):
+    index = annotations.AnnotationIndex([
+        Annotation(1, 5, 1, 10, 'a'),
+        Annotation(1, 12, 1, 12, 'b'),
+        Annotation(2, 1, 2, 20, 'outer'),
+        Annotation(2, 4, 2, 6, 'inner'),
+    ])
+    self.assertIsNone(index.SignatureAt(1, 4))
+    self.assertEqual('a', index.SignatureAt(1, 5))
+    self.assertEqual('a', index.SignatureAt(1, 10))
+    self.assertIsNone(index.SignatureAt(1, 11))
+    self.assertEqual('b', index.SignatureAt(1, 12))
+    self.assertIsNone(index.SignatureAt(3, 1))
+
+    # Overlapping annotations are returned in their original order.
+    self.assertEqual(['outer', 'inner'], [
+        a.xref_signature.signature for a in index.AnnotationsAt(2, 5)
+    ])
+    self.assertEqual('outer', index.SignatureAt(2, 5))
+
+  def test_multi_line_range(self):
+    index = annotations.AnnotationIndex([Annotation(3, 10, 5, 2, 'block')])
+    self.assertIsNone(index.SignatureAt(3, 9))
+    self.assertEqual('block', index.SignatureAt(3, 80))
+    self.assertEqual('block', index.SignatureAt(4, 1))
+    self.assertEqual('block', index.SignatureAt(5, 2))
+    self.assertIsNone(index.SignatureAt(5, 3))
+
+  def test_matches_linear_scan(self):
+    with open(ANNOTATION_RESPONSE, 'r') as f:
+      response = ToStruct(json.load(f))
+    all_annotations = response.annotation_response[0].annotation
+    index = annotations.AnnotationIndex(all_annotations)
+
+    last_line = max(a.range.end_line for a in all_annotations)
+    for line in range(1, last_line + 2):
+      for column in range(1, 100):
+        expected = [
+            a for a in all_annotations if Contains(a.range, line, column)
+        ]
+        self.assertEqual(expected, index.AnnotationsAt(line, column))
+
+    # Base64Encode() is defined on line 13.
+    self.assertTrue(
+        index.SignatureAt(13, 6).endswith(
+            'MZBL6wjnQzRflIU41%2BL764L7bAX7Ryai%2BPu64O6Cdys%3D'))
+
+
+if __name__ == '__main__':
+  unittest.main()
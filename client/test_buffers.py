@@ -0,0 +1,147 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(SCRIPT_DIR)
+
+import buffers
+
+
+class TestBufferMap(unittest.TestCase):
+
+  def setUp(self):
+    self.parent_dir = tempfile.mkdtemp()
+    self.visible = set()
+    self.spilled = []
+
+  def tearDown(self):
+    shutil.rmtree(self.parent_dir)
+
+  def NewMap(self, max_bytes):
+    m = buffers.BufferMap(
+        max_bytes=max_bytes,
+        spill_dir=self.parent_dir,
+        size_fn=lambda value: len(value) if value else 0,
+        can_spill=lambda key, value: key not in self.visible,
+        on_spill=lambda key, value: self.spilled.append(key))
+    self.addCleanup(m.Close)
+    return m
+
+  def test_spills_least_recently_used(self):
+    m = self.NewMap(max_bytes=25)
+    m[1] = 'a' * 10
+    m[2] = 'b' * 10
+    self.assertEqual([], self.spilled)
+
+    m.get(1)
+    m[3] = 'c' * 10
+    self.assertEqual([2], self.spilled)
+    self.assertTrue(m.IsSpilled(2))
+    self.assertEqual(20, m.ResidentBytes())
+    self.assertEqual(3, len(m))
+    self.assertIn(2, m)
+
+    # Loading 2 back spills the least recently used of the others.
+    self.assertEqual('b' * 10, m[2])
+    self.assertFalse(m.IsSpilled(2))
+    self.assertEqual([2, 1], self.spilled)
+    self.assertEqual(1, m.load_count_)
+
+  def test_visible_and_pinned_values_stay(self):
+    m = self.NewMap(max_bytes=5)
+    self.visible.add(1)
+    m[1] = 'a' * 10
+    m[2] = 'b' * 10
+    m.Pin(3)
+    m[3] = 'c' * 10
+    m[4] = None
+    self.assertEqual([2], self.spilled)
+
+    m.Unpin(3)
+    m.Trim()
+    self.assertEqual([2, 3], self.spilled)
+    self.assertIsNone(m[4])
+
+  def test_value_being_set_stays(self):
+    m = self.NewMap(max_bytes=5)
+    m[1] = 'a' * 10
+    self.assertEqual([], self.spilled)
+    self.assertEqual('a' * 10, m[1])
+
+  def test_pop_and_close_remove_files(self):
+    m = self.NewMap(max_bytes=5)
+    m[1] = 'a' * 10
+    m[2] = 'b' * 10
+    spill_dir = m.spill_dir_
+    self.assertEqual(1, len(os.listdir(spill_dir)))
+    self.assertIsNone(m.pop(1))
+    self.assertEqual([], os.listdir(spill_dir))
+    self.assertNotIn(1, m)
+    self.assertIsNone(m.get(1))
+    self.assertRaises(KeyError, lambda: m[1])
+
+    m.Trim()
+    m[3] = 'c' * 10
+    self.assertTrue(m.IsSpilled(2))
+    m.Close()
+    self.assertFalse(os.path.exists(spill_dir))
+    self.assertEqual(0, len(m))
+
+  def test_unpicklable_value_stays(self):
+    m = self.NewMap(max_bytes=5)
+    lock = threading.Lock()
+    m[1] = [lock] * 10
+    m[2] = 'b' * 10
+    self.assertFalse(m.IsSpilled(1))
+    self.assertIs(lock, m[1][0])
+
+  def test_sizes_are_estimated_when_stored(self):
+    sized = []
+
+    def Size(value):
+      sized.append(value[0])
+      return len(value)
+
+    m = buffers.BufferMap(max_bytes=25, spill_dir=self.parent_dir,
+                          size_fn=Size)
+    self.addCleanup(m.Close)
+    for key in range(5):
+      m[key] = [str(key)] * 5
+    self.assertEqual(['0', '1', '2', '3', '4'], sized)
+    self.assertEqual(25, m.ResidentBytes())
+
+    # Values that grow in place are accounted for once resized.
+    m[4].extend(['4'] * 10)
+    self.assertEqual(25, m.ResidentBytes())
+    m.Resize(4)
+    self.assertEqual(['0', '1', '2', '3', '4', '4'], sized)
+    self.assertEqual([0, 1], sorted(m.spilled_))
+    self.assertEqual(25, m.ResidentBytes())
+
+    # Loading a value back estimates its size again.
+    self.assertEqual(['0'] * 5, m[0])
+    self.assertEqual('0', sized[-1])
+    self.assertEqual(sum(len(v) for v in m.resident_.values()),
+                     m.ResidentBytes())
+
+  def test_missing_spill_file(self):
+    m = self.NewMap(max_bytes=5)
+    m[1] = 'a' * 10
+    m[2] = 'b' * 10
+    os.remove(m.spilled_[1])
+    self.assertIsNone(m.get(1))
+    self.assertNotIn(1, m)
+
+
+if __name__ == '__main__':
+  unittest.main()
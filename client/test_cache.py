@@ -0,0 +1,152 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(SCRIPT_DIR)
+
+import cache
+
+
+class FakeClock(object):
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+
+class TestResponseCache(unittest.TestCase):
+
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp()
+    self.clock = FakeClock()
+
+  def tearDown(self):
+    shutil.rmtree(self.cache_dir)
+
+  def NewCache(self, **kwargs):
+    return cache.ResponseCache(self.cache_dir, clock=self.clock, **kwargs)
+
+  def test_get_and_put(self):
+    c = self.NewCache()
+    self.assertIsNone(c.Get('a', 'search'))
+    c.Put('a', {'x': [1, 2]})
+    self.assertEqual(({'x': [1, 2]}, True), c.Get('a', 'search'))
+
+  def test_ttl_per_kind(self):
+    c = self.NewCache(ttls={'search': 10}, default_ttl=100)
+    c.Put('a', 'value')
+    self.clock.now += 50
+    self.assertEqual(('value', False), c.Get('a', 'search'))
+    self.assertEqual(('value', True), c.Get('a', 'xref'))
+    self.clock.now += 50
+    self.assertEqual(('value', False), c.Get('a', 'xref'))
+
+  def test_persists(self):
+    self.NewCache().Put('a', 'value')
+    c = self.NewCache()
+    self.assertEqual(('value', True), c.Get('a', 'search'))
+    self.assertTrue(c.TotalBytes() > 0)
+
+  def test_lru_eviction(self):
+    c = self.NewCache()
+    c.Put('a', 'x' * 100)
+    entry_size = c.TotalBytes()
+
+    c = self.NewCache(max_bytes=entry_size * 2)
+    c.Put('b', 'x' * 100)
+    c.Get('a', 'search')
+    c.Put('c', 'x' * 100)
+
+    # 'b' was the least recently used.
+    self.assertIsNone(c.Get('b', 'search'))
+    self.assertIsNotNone(c.Get('a', 'search'))
+    self.assertIsNotNone(c.Get('c', 'search'))
+    self.assertEqual(2 * entry_size, c.TotalBytes())
+    self.assertEqual(2, len(os.listdir(self.cache_dir)))
+
+  def test_budget_applies_on_startup(self):
+    c = self.NewCache()
+    c.Put('a', 'value')
+    c.Put('b', 'value')
+    c = self.NewCache(max_bytes=1)
+    self.assertEqual(0, c.TotalBytes())
+    self.assertEqual([], os.listdir(self.cache_dir))
+
+  def test_corrupt_entry(self):
+    c = self.NewCache()
+    c.Put('a', 'value')
+    for name in os.listdir(self.cache_dir):
+      with open(os.path.join(self.cache_dir, name), 'wb') as f:
+        f.write(b'garbage')
+    self.assertIsNone(c.Get('a', 'search'))
+    self.assertEqual(0, c.TotalBytes())
+
+  def test_fetch(self):
+    c = self.NewCache(default_ttl=10)
+    fetched = []
+
+    def Fetch():
+      fetched.append(1)
+      return len(fetched)
+
+    self.assertEqual(1, c.Fetch('a', 'search', Fetch))
+    self.assertEqual(1, c.Fetch('a', 'search', Fetch))
+    self.clock.now += 20
+    self.assertEqual(2, c.Fetch('a', 'search', Fetch))
+    self.assertEqual(2, len(fetched))
+
+    self.assertIsNone(c.Fetch('b', 'search', lambda: None))
+    self.assertIsNone(c.Get('b', 'search'))
+
+  def test_stale_while_revalidate(self):
+    c = self.NewCache(default_ttl=10, stale_while_revalidate=True)
+    c.Put('a', 'old')
+    self.clock.now += 20
+
+    release = threading.Event()
+
+    def Fetch():
+      release.wait()
+      return 'new'
+
+    # The stale value is returned without waiting for the fetch.
+    self.assertEqual('old', c.Fetch('a', 'search', Fetch))
+    self.assertEqual('old', c.Fetch('a', 'search', Fetch))
+    self.assertEqual(set(['a']), c.refreshing_)
+
+    release.set()
+    deadline = time.time() + 10
+    while c.refreshing_ and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertEqual(('new', True), c.Get('a', 'search'))
+
+  def test_failed_revalidation_keeps_stale_entry(self):
+    c = self.NewCache(default_ttl=10, stale_while_revalidate=True)
+    c.Put('a', 'old')
+    self.clock.now += 20
+
+    def Fetch():
+      raise IOError('offline')
+
+    self.assertEqual('old', c.Fetch('a', 'search', Fetch))
+    deadline = time.time() + 10
+    while c.refreshing_ and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertEqual(('old', False), c.Get('a', 'search'))
+
+
+if __name__ == '__main__':
+  unittest.main()
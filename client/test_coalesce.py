@@ -0,0 +1,103 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+import os
+import sys
+import threading
+import unittest
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(SCRIPT_DIR)
+
+import coalesce
+
+
+class TestRequestCoalescer(unittest.TestCase):
+
+  def setUp(self):
+    self.coalescer = coalesce.RequestCoalescer()
+    self.started = threading.Event()
+    self.release = threading.Event()
+    self.fetch_count = 0
+
+  def BlockingFetch(self, result):
+
+    def Fetch():
+      self.fetch_count += 1
+      self.started.set()
+      self.release.wait()
+      if isinstance(result, Exception):
+        raise result
+      return result
+
+    return Fetch
+
+  def StartThreads(self, key, fetch, count):
+    results = []
+
+    def Run():
+      try:
+        results.append(self.coalescer.Fetch(key, fetch))
+      except Exception as e:
+        results.append(e)
+
+    threads = [threading.Thread(target=Run) for _ in range(count)]
+    threads[0].start()
+    self.started.wait()
+    for t in threads[1:]:
+      t.start()
+    return threads, results
+
+  def WaitForWaiters(self, count):
+    # Waiters register themselves before blocking.
+    while self.coalescer.Counts()['hits'] < count:
+      self.release.wait(0.001)
+
+  def test_concurrent_requests_share_fetch(self):
+    value = {'a': 1}
+    threads, results = self.StartThreads('k', self.BlockingFetch(value), 4)
+    self.WaitForWaiters(3)
+    self.assertEqual(1, self.coalescer.InFlightCount())
+    self.release.set()
+    for t in threads:
+      t.join()
+
+    self.assertEqual(1, self.fetch_count)
+    self.assertEqual(4, len(results))
+    for r in results:
+      self.assertIs(value, r)
+    self.assertEqual({'hits': 3, 'misses': 1}, self.coalescer.Counts())
+    self.assertEqual(0, self.coalescer.InFlightCount())
+
+  def test_exception_is_shared(self):
+    error = ValueError('boom')
+    threads, results = self.StartThreads('k', self.BlockingFetch(error), 2)
+    self.WaitForWaiters(1)
+    self.release.set()
+    for t in threads:
+      t.join()
+    self.assertEqual([error, error], results)
+    self.assertEqual(1, self.fetch_count)
+
+  def test_completed_fetches_are_not_reused(self):
+    self.release.set()
+    fetch = self.BlockingFetch('v')
+    self.assertEqual('v', self.coalescer.Fetch('k', fetch))
+    self.assertEqual('v', self.coalescer.Fetch('k', fetch))
+    self.assertEqual(2, self.fetch_count)
+    self.assertEqual({'hits': 0, 'misses': 2}, self.coalescer.Counts())
+
+  def test_different_keys(self):
+    threads, results = self.StartThreads('a', self.BlockingFetch('a'), 1)
+    self.assertEqual('b', self.coalescer.Fetch('b', lambda: 'b'))
+    self.release.set()
+    threads[0].join()
+    self.assertEqual(['a'], results)
+    self.assertEqual({'hits': 0, 'misses': 2}, self.coalescer.Counts())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,189 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+import os
+import sys
+import threading
+import unittest
+
+if sys.version_info.major == 3:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+  from socketserver import ThreadingMixIn
+  from urllib.error import HTTPError, URLError
+  from urllib.request import ProxyHandler, build_opener
+else:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+  from SocketServer import ThreadingMixIn
+  from urllib2 import HTTPError, ProxyHandler, URLError, build_opener
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(SCRIPT_DIR)
+
+import connection_pool
+
+
+class FakeClock(object):
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    self.server.RecordRequest(self.client_address)
+    if self.path == '/missing':
+      self.Respond(404, b'not found')
+      return
+    self.Respond(200, self.path.encode('utf-8'))
+    if self.path == '/hang-up':
+      # Closes the connection without saying so in the response.
+      self.close_connection = True
+
+  def do_CONNECT(self):
+    # Acts as a proxy that refuses to open tunnels.
+    self.server.RecordRequest(self.client_address)
+    self.server.tunnels.append(self.path)
+    self.Respond(407, b'')
+    self.close_connection = True
+
+  def Respond(self, status, body):
+    self.send_response(status)
+    self.send_header('Content-Type', 'text/plain')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+  def __init__(self):
+    HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+    self.lock = threading.Lock()
+    self.connections = set()
+    self.request_count = 0
+    self.tunnels = []
+
+  def RecordRequest(self, client_address):
+    with self.lock:
+      self.connections.add(client_address)
+      self.request_count += 1
+
+
+class TestConnectionPool(unittest.TestCase):
+
+  def setUp(self):
+    self.server = StandInServer()
+    thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+    thread.daemon = True
+    thread.start()
+    self.base_url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+    self.clock = FakeClock()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def NewOpener(self, proxies=None, **kwargs):
+    pool = connection_pool.ConnectionPool(clock=self.clock, **kwargs)
+    self.addCleanup(pool.Close)
+    return pool, build_opener(
+        ProxyHandler(proxies or {}), connection_pool.PooledHTTPHandler(pool))
+
+  def Fetch(self, opener, path):
+    response = opener.open(self.base_url + path, timeout=5)
+    try:
+      self.assertEqual(200, response.getcode())
+      return response.read()
+    finally:
+      response.close()
+
+  def test_connection_is_reused(self):
+    pool, opener = self.NewOpener()
+    for i in range(3):
+      self.assertEqual('/{}'.format(i).encode('utf-8'),
+                       self.Fetch(opener, '/{}'.format(i)))
+    self.assertEqual(3, self.server.request_count)
+    self.assertEqual(1, len(self.server.connections))
+    self.assertEqual(1, pool.created_count_)
+    self.assertEqual(2, pool.reused_count_)
+    self.assertEqual(1, pool.IdleCount())
+
+  def test_connection_is_reused_without_timeout(self):
+    pool, opener = self.NewOpener()
+    for path in ['/a', '/b']:
+      response = opener.open(self.base_url + path)
+      self.assertEqual(path.encode('utf-8'), response.read())
+      response.close()
+    self.assertEqual(1, len(self.server.connections))
+    self.assertEqual(1, pool.reused_count_)
+    self.assertEqual(1, pool.IdleCount())
+
+  def test_idle_timeout(self):
+    pool, opener = self.NewOpener(idle_timeout=10)
+    self.Fetch(opener, '/a')
+    self.clock.now += 5
+    self.Fetch(opener, '/b')
+    self.clock.now += 11
+    self.Fetch(opener, '/c')
+    self.assertEqual(2, len(self.server.connections))
+    self.assertEqual(1, pool.reused_count_)
+
+  def test_max_idle(self):
+    pool, opener = self.NewOpener(max_idle=0)
+    self.Fetch(opener, '/a')
+    self.Fetch(opener, '/b')
+    self.assertEqual(2, len(self.server.connections))
+    self.assertEqual(0, pool.IdleCount())
+
+  def test_retries_connection_closed_by_server(self):
+    pool, opener = self.NewOpener()
+    self.Fetch(opener, '/hang-up')
+    self.assertEqual(b'/a', self.Fetch(opener, '/a'))
+    self.assertEqual(2, len(self.server.connections))
+    self.assertEqual(1, pool.reused_count_)
+    self.assertEqual(2, pool.created_count_)
+
+  def test_http_error(self):
+    pool, opener = self.NewOpener()
+    try:
+      opener.open(self.base_url + '/missing', timeout=5)
+      self.fail('HTTPError not raised')
+    except HTTPError as e:
+      self.assertEqual(404, e.code)
+      self.assertEqual(b'not found', e.read())
+    # The connection is still good.
+    self.Fetch(opener, '/a')
+    self.assertEqual(1, len(self.server.connections))
+
+  def test_http_proxy(self):
+    pool, opener = self.NewOpener(proxies={'http': self.base_url})
+    response = opener.open('http://example.com/a', timeout=5)
+    # The proxy sees the full URL.
+    self.assertEqual(b'http://example.com/a', response.read())
+    self.assertEqual(1, pool.created_count_)
+
+  def test_https_proxy_is_left_to_standard_handler(self):
+    pool, opener = self.NewOpener(proxies={'https': self.base_url})
+    try:
+      opener.open('https://example.com/a', timeout=5)
+      self.fail('URLError not raised')
+    except URLError as e:
+      self.assertIn('407', str(e.reason))
+    self.assertEqual(['example.com:443'], self.server.tunnels)
+    self.assertEqual(0, pool.created_count_)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,74 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+import sys
+import threading
+import unittest
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(SCRIPT_DIR)
+
+import jobs
+
+
+def WaitForIdle(pool):
+  while pool.DispatchCompleted():
+    pass
+
+
+class TestJobs(unittest.TestCase):
+
+  def test_run_synchronously(self):
+    job = jobs.Job(lambda a, b: a + b, (1, 2))
+    self.assertFalse(job.Done())
+    job.Run()
+    self.assertTrue(job.Done())
+    self.assertEqual(3, job.Result())
+
+  def test_result_reraises(self):
+
+    def Fail():
+      raise ValueError('boom')
+
+    job = jobs.Job(Fail)
+    job.Run()
+    self.assertRaises(ValueError, job.Result)
+
+  def test_callbacks_run_on_dispatching_thread(self):
+    pool = jobs.WorkerPool(2)
+    threads = []
+    results = []
+
+    def OnDone(job):
+      threads.append(threading.current_thread())
+      results.append(job.Result())
+
+    for i in range(10):
+      pool.Submit(lambda x: x * x, (i,), OnDone)
+    WaitForIdle(pool)
+
+    self.assertEqual(sorted(results), [i * i for i in range(10)])
+    self.assertEqual(set(threads), set([threading.current_thread()]))
+    self.assertLessEqual(len(pool.workers_), 2)
+    self.assertEqual(0, pool.OutstandingCount())
+
+  def test_callback_exception_does_not_lose_jobs(self):
+    pool = jobs.WorkerPool(1)
+    delivered = []
+
+    def Fail(job):
+      raise ValueError('boom')
+
+    pool.Submit(lambda: 1, (), Fail).Wait()
+    pool.Submit(lambda: 2, (), lambda job: delivered.append(job.Result()))
+    self.assertRaises(ValueError, WaitForIdle, pool)
+    WaitForIdle(pool)
+    self.assertEqual([2], delivered)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,78 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(SCRIPT_DIR)
+
+import load_test
+
+
+class TestVimScript(unittest.TestCase):
+
+  def test_script(self):
+    config = {'server_url': "http://it's", 'iterations': 2}
+    script = load_test.VimScript(config, [('codesearch_async', '1')])
+    lines = script.splitlines()
+    self.assertEqual('runtime plugin/crcs.vim', lines[2])
+    self.assertIn('let g:codesearch_async = 1', lines)
+    config_line = [l for l in lines if 'g:codesearch_load_test' in l][0]
+    # The single quote is doubled in the Vim string.
+    value = config_line.split(' = ', 1)[1][1:-1].replace("''", "'")
+    self.assertEqual(config, json.loads(value))
+    self.assertLess(
+        lines.index(config_line), lines.index('call crcs#Setup()'))
+    self.assertEqual('qall!', lines[-1])
+
+  def test_command(self):
+    self.assertIn('-es', load_test.VimCommand('/usr/bin/vim', 'a.vim'))
+    self.assertIn('--headless', load_test.VimCommand('nvim', 'a.vim'))
+
+
+class TestSummaries(unittest.TestCase):
+
+  def test_samples(self):
+    samples = [{
+        'scenario': 'search',
+        'seconds': 0.1 * (i + 1),
+        'errors': ['timed out'] if i == 9 else []
+    } for i in range(10)]
+    samples.append({'scenario': 'xref', 'seconds': 0.25, 'errors': []})
+    lines = load_test.SummarizeSamples(samples)
+    self.assertEqual(3, len(lines))
+    self.assertEqual(['p50', 'ms', 'p90', 'ms'], lines[0].split()[3:7])
+    self.assertEqual(['search', '10', '1'], lines[1].split()[:3])
+    self.assertEqual('1000.0', lines[1].split()[-1])
+    self.assertEqual(['xref', '1', '0', '250.0'], lines[2].split()[:4])
+
+  def test_stages(self):
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    path = os.path.join(temp_dir, 'stats.log')
+    self.assertEqual([], load_test.ReadStatsLog(path))
+    with open(path, 'w') as f:
+      for command, stage, seconds in [('CrSearch', 'request', 0.2),
+                                      ('CrSearch', 'render', 0.01),
+                                      ('CrSearch', 'request', 0.4)]:
+        f.write(json.dumps({
+            'command': command,
+            'stage': stage,
+            'seconds': seconds
+        }) + '\n')
+    lines = load_test.SummarizeStages(load_test.ReadStatsLog(path))
+    self.assertEqual(['CrSearch', 'render', '1'], lines[1].split()[:3])
+    self.assertEqual(['CrSearch', 'request', '2'], lines[2].split()[:3])
+    self.assertEqual('400.0', lines[2].split()[-1])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,110 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+import sys
+import threading
+import unittest
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(SCRIPT_DIR)
+
+import jobs
+import prefetch
+
+# A tiny call graph. Maps a node to its callers.
+GRAPH = {
+    'root': ['a', 'b'],
+    'a': ['c', 'd'],
+    'b': ['e'],
+    'c': ['f'],
+    'd': [],
+    'e': [],
+    'f': [],
+}
+
+
+def WaitForIdle(pool):
+  while pool.DispatchCompleted():
+    pass
+
+
+class TestPrefetcher(unittest.TestCase):
+
+  def setUp(self):
+    self.pool = jobs.WorkerPool(3)
+    self.lock = threading.Lock()
+    self.fetched = []
+
+  def Fetch(self, key):
+    with self.lock:
+      self.fetched.append(key)
+    if key == 'broken':
+      raise ValueError(key)
+    return GRAPH[key]
+
+  def MakePrefetcher(self, max_depth, max_requests=100):
+    return prefetch.Prefetcher(self.pool, self.Fetch, lambda callers: callers,
+                               max_depth, max_requests)
+
+  def test_depth_limit(self):
+    p = self.MakePrefetcher(2)
+    for key in GRAPH['root']:
+      p.Prefetch(key, 1)
+    WaitForIdle(self.pool)
+
+    self.assertEqual(sorted(['a', 'b', 'c', 'd', 'e']), sorted(self.fetched))
+    self.assertEqual(['c', 'd'], p.Lookup('a').Result())
+    self.assertIsNone(p.Lookup('f'))
+
+  def test_request_limit(self):
+    p = self.MakePrefetcher(10, max_requests=2)
+    p.Prefetch('root', 0)
+    WaitForIdle(self.pool)
+    self.assertEqual(sorted(['root', 'a']), sorted(self.fetched))
+
+  def test_duplicate_keys_fetched_once(self):
+    p = self.MakePrefetcher(1)
+    p.Prefetch('a', 1)
+    p.Prefetch('a', 1)
+    WaitForIdle(self.pool)
+    self.assertEqual(['a'], self.fetched)
+
+  def test_when_done(self):
+    p = self.MakePrefetcher(0)
+    delivered = []
+    self.assertFalse(p.WhenDone('a', delivered.append))
+
+    p.Prefetch('a', 0)
+    self.assertTrue(p.WhenDone('a', lambda job: delivered.append(job.Result())))
+    WaitForIdle(self.pool)
+    self.assertEqual([['c', 'd']], delivered)
+
+    # Already done.
+    p.WhenDone('a', lambda job: delivered.append(job.Result()))
+    self.assertEqual([['c', 'd'], ['c', 'd']], delivered)
+
+  def test_failures_are_forgotten(self):
+    p = self.MakePrefetcher(0)
+    failures = []
+    p.Prefetch('broken', 0)
+    p.WhenDone('broken', lambda job: failures.append(job.Failed()))
+    WaitForIdle(self.pool)
+    self.assertEqual([True], failures)
+    self.assertIsNone(p.Lookup('broken'))
+
+  def test_cancel(self):
+    p = self.MakePrefetcher(5)
+    p.Prefetch('root', 0)
+    p.Cancel()
+    WaitForIdle(self.pool)
+    p.Prefetch('a', 1)
+    WaitForIdle(self.pool)
+    self.assertEqual(['root'], self.fetched)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,225 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+if sys.version_info.major == 3:
+  from urllib.error import HTTPError
+  from urllib.request import build_opener
+else:
+  from urllib2 import HTTPError, build_opener
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(SCRIPT_DIR)
+
+import connection_pool
+import replay_server
+
+SEARCH_URL = 'https://example.com/codesearch/json?search_request=b&query=foo'
+
+
+class TestParseLatency(unittest.TestCase):
+
+  def test_distributions(self):
+    rng = random.Random(1)
+    self.assertEqual(0.0, replay_server.ParseLatency('none')(rng, 5))
+    self.assertEqual(5, replay_server.ParseLatency('recorded')(rng, 5))
+    self.assertEqual(0.25, replay_server.ParseLatency('fixed:250')(rng, 5))
+    for _ in range(100):
+      sample = replay_server.ParseLatency('uniform:10,20')(rng, 0)
+      self.assertTrue(0.01 <= sample <= 0.02)
+      # Negative samples are clamped.
+      self.assertEqual(0.0,
+                       replay_server.ParseLatency('normal:-100,1')(rng, 0))
+      self.assertTrue(
+          replay_server.ParseLatency('lognormal:100,0.5')(rng, 0) > 0)
+
+  def test_malformed(self):
+    for spec in ('bogus:1', 'fixed', 'fixed:a', 'uniform:1', 'lognormal:0,1'):
+      self.assertRaises(ValueError, replay_server.ParseLatency, spec)
+
+  def test_parse_error(self):
+    self.assertEqual(500, replay_server.ParseError('500'))
+    self.assertEqual('reset', replay_server.ParseError('reset'))
+    self.assertRaises(ValueError, replay_server.ParseError, '200')
+    self.assertRaises(ValueError, replay_server.ParseError, 'later')
+
+
+class ReplayTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.responses_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.responses_dir)
+    self.Record('exact', {'search_response': [{'n': 1}], 'elapsed_ms': 7},
+                SEARCH_URL)
+    self.Record('other', {'search_response': [{'n': 2}]})
+    self.Record('xrefs', {'xref_search_response': [{'n': 3}]})
+
+  def Record(self, name, response, url=None):
+    if url is not None:
+      name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    with open(os.path.join(self.responses_dir, name + '.json'), 'w') as f:
+      json.dump(response, f)
+
+  def NewServer(self, **kwargs):
+    server = replay_server.ReplayServer(
+        replay_server.ResponseStore(self.responses_dir), **kwargs)
+    server.Start()
+    self.addCleanup(server.Stop)
+    return server
+
+  def Fetch(self, server, url):
+    opener = build_opener(replay_server.ReplayRedirectHandler(server.Url()))
+    response = opener.open(url, timeout=5)
+    try:
+      return json.loads(response.read().decode('utf-8'))
+    finally:
+      response.close()
+
+
+class TestResponseStore(ReplayTestCase):
+
+  def test_lookup(self):
+    store = replay_server.ResponseStore(self.responses_dir)
+    self.assertEqual(['search', 'xref_search'], store.Kinds())
+
+    recording, exact = store.Lookup(SEARCH_URL)
+    self.assertTrue(exact)
+    self.assertEqual(0.007, recording.seconds)
+
+    recording, exact = store.Lookup(
+        'https://example.com/codesearch/json?xref_search_request=b&x=1')
+    self.assertFalse(exact)
+    self.assertEqual({'xref_search_response': [{'n': 3}]},
+                     json.loads(recording.body.decode('utf-8')))
+
+    # Requests of the same kind are spread across its recordings, but each
+    # always gets the same one.
+    names = set()
+    for i in range(20):
+      url = 'https://example.com/json?search_request=b&query={}'.format(i)
+      name = store.Lookup(url)[0].name
+      self.assertEqual(name, store.Lookup(url)[0].name)
+      names.add(name)
+    self.assertEqual(2, len(names))
+
+    self.assertEqual((None, False),
+                     store.Lookup('https://example.com/json?call_request=b'))
+
+
+class TestReplayServer(ReplayTestCase):
+
+  def test_replay(self):
+    server = self.NewServer()
+    self.assertEqual({'search_response': [{'n': 1}], 'elapsed_ms': 7},
+                     self.Fetch(server, SEARCH_URL))
+    self.Fetch(server, 'https://example.com/json?xref_search_request=b')
+    try:
+      self.Fetch(server, 'https://example.com/json?call_request=b')
+      self.fail('HTTPError not raised')
+    except HTTPError as e:
+      self.assertEqual(404, e.code)
+
+    counts = server.Counts()
+    self.assertEqual(3, counts['requests'])
+    self.assertEqual(1, counts['exact'])
+    self.assertEqual(1, counts['by_kind'])
+    self.assertEqual(1, counts['missing'])
+
+  def test_latency(self):
+    sleeps = []
+    server = self.NewServer(
+        latency=replay_server.ParseLatency('recorded'), sleep=sleeps.append)
+    self.Fetch(server, SEARCH_URL)
+    self.assertEqual([0.007], sleeps)
+
+  def test_bandwidth(self):
+    sleeps = []
+    server = self.NewServer(bandwidth=200, sleep=sleeps.append)
+    self.Fetch(server, SEARCH_URL)
+    # 10 byte chunks at 200 bytes per second, after a latency of 0.
+    self.assertEqual(0.0, sleeps[0])
+    self.assertTrue(len(sleeps) > 2)
+    self.assertAlmostEqual(0.05, sleeps[1])
+
+  def test_errors(self):
+    server = self.NewServer(error_rate=1.0, error=500)
+    try:
+      self.Fetch(server, SEARCH_URL)
+      self.fail('HTTPError not raised')
+    except HTTPError as e:
+      self.assertEqual(500, e.code)
+
+    server = self.NewServer(error_rate=1.0, error='reset')
+    self.assertRaises(Exception, self.Fetch, server, SEARCH_URL)
+    self.assertEqual(1, server.Counts()['errors'])
+
+  def test_error_rate(self):
+    server = self.NewServer(error_rate=0.5, seed=3)
+    failures = 0
+    for _ in range(40):
+      try:
+        self.Fetch(server, SEARCH_URL)
+      except HTTPError:
+        failures += 1
+    self.assertEqual(failures, server.Counts()['errors'])
+    self.assertTrue(5 < failures < 35)
+
+  def test_max_concurrency(self):
+    release = threading.Event()
+    entered = []
+
+    def Sleep(seconds):
+      entered.append(seconds)
+      release.wait(5)
+
+    server = self.NewServer(max_concurrency=2, sleep=Sleep)
+    threads = [
+        threading.Thread(target=self.Fetch, args=(server, SEARCH_URL))
+        for _ in range(4)
+    ]
+    for t in threads:
+      t.start()
+    deadline = time.time() + 5
+    while (server.Counts()['queued'] < 2 or len(entered) < 2) and \
+        time.time() < deadline:
+      time.sleep(0.01)
+    self.assertEqual(2, len(entered))
+    release.set()
+    for t in threads:
+      t.join()
+
+    counts = server.Counts()
+    self.assertEqual(4, counts['exact'])
+    self.assertEqual(2, counts['queued'])
+    self.assertEqual(2, counts['max_in_flight'])
+
+  def test_redirect_through_connection_pool(self):
+    server = self.NewServer()
+    pool = connection_pool.ConnectionPool()
+    self.addCleanup(pool.Close)
+    opener = build_opener(
+        replay_server.ReplayRedirectHandler(server.Url()),
+        connection_pool.PooledHTTPHandler(pool))
+    for _ in range(3):
+      response = opener.open(SEARCH_URL, timeout=5)
+      self.assertEqual({'search_response': [{'n': 1}], 'elapsed_ms': 7},
+                       json.loads(response.read().decode('utf-8')))
+    self.assertEqual(1, pool.created_count_)
+    self.assertEqual(3, server.Counts()['exact'])
+
+
+if __name__ == '__main__':
+  unittest.main()
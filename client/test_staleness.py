@@ -0,0 +1,108 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+import sys
+import unittest
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(SCRIPT_DIR)
+
+import staleness
+
+SERVER_LINES = ['line {}'.format(i) for i in range(2000)]
+
+
+class TestStalenessTracker(unittest.TestCase):
+
+  def setUp(self):
+    self.tracker = staleness.StalenessTracker()
+    self.buffer = list(SERVER_LINES)
+    self.changedtick = 1
+    self.lines_read = 0
+    self.verified = []
+
+  def GetLines(self, start, end):
+    self.lines_read += max(0, min(end, len(self.buffer)) - start)
+    return self.buffer[start:end]
+
+  def Verify(self, lines):
+    self.verified.append(len(lines))
+    return SERVER_LINES[:len(lines)] != lines
+
+  def IsStale(self, end):
+    return self.tracker.IsStale(end, self.changedtick, self.GetLines,
+                                self.Verify)
+
+  def Edit(self, index, text):
+    self.buffer[index] = text
+    self.changedtick += 1
+
+  def test_unchanged_buffer(self):
+    self.assertFalse(self.IsStale(1000))
+    self.assertEqual([1000], self.verified)
+
+    # Same changedtick. Neither the server nor the buffer is consulted.
+    self.lines_read = 0
+    self.assertFalse(self.IsStale(1000))
+    self.assertFalse(self.IsStale(10))
+    self.assertEqual(0, self.lines_read)
+    self.assertEqual([1000], self.verified)
+
+    # Moving past the baseline requires verification.
+    self.assertFalse(self.IsStale(1500))
+    self.assertEqual([1000, 1500], self.verified)
+
+  def test_edit_after_prefix(self):
+    self.assertFalse(self.IsStale(1000))
+    self.Edit(1200, 'changed')
+    self.assertFalse(self.IsStale(1000))
+    self.assertEqual([1000], self.verified)
+
+  def test_edit_within_prefix(self):
+    self.assertFalse(self.IsStale(1000))
+    self.Edit(10, 'changed')
+
+    # Detected without asking the server. Comparison stops at the change.
+    self.lines_read = 0
+    self.assertTrue(self.IsStale(1000))
+    self.assertTrue(self.lines_read <= staleness.CHUNK_SIZE)
+    self.assertFalse(self.IsStale(10))
+    self.assertTrue(self.IsStale(11))
+    self.assertEqual([1000], self.verified)
+
+    # Undoing the change makes the buffer match again.
+    self.Edit(10, SERVER_LINES[10])
+    self.assertFalse(self.IsStale(1000))
+    self.assertEqual([1000], self.verified)
+
+  def test_inserted_line(self):
+    self.assertFalse(self.IsStale(100))
+    self.buffer.insert(50, 'new line')
+    self.changedtick += 1
+    self.assertFalse(self.IsStale(50))
+    self.assertTrue(self.IsStale(51))
+
+  def test_stale_verdict_is_remembered(self):
+    self.Edit(500, 'changed')
+    self.assertTrue(self.IsStale(1000))
+    self.assertTrue(self.IsStale(1000))
+    self.assertTrue(self.IsStale(1500))
+    self.assertEqual([1000], self.verified)
+
+    # A shorter prefix can still be fresh.
+    self.assertFalse(self.IsStale(400))
+    self.assertEqual([1000, 400], self.verified)
+
+  def test_short_buffer(self):
+    self.buffer = self.buffer[:10]
+    self.assertFalse(self.IsStale(100))
+    self.assertFalse(self.IsStale(100))
+    self.assertEqual([10], self.verified)
+
+
+if __name__ == '__main__':
+  unittest.main()
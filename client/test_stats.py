@@ -0,0 +1,149 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+import json
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(SCRIPT_DIR)
+
+import stats
+
+
+class FakeClock(object):
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+  def Advance(self, seconds):
+    self.now += seconds
+
+
+class TestStats(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = FakeClock()
+    self.stats = stats.Stats(clock=self.clock)
+
+  def test_stages_are_attributed_to_command(self):
+    with self.stats.Command('RunCodeSearch'):
+      with self.stats.Stage('request') as timer:
+        self.clock.Advance(0.5)
+        timer.size = 1234
+      with self.stats.Stage('render'):
+        self.clock.Advance(0.25)
+
+    request = self.stats.GetSeries('RunCodeSearch', 'request')
+    self.assertEqual(1, request.Count())
+    self.assertEqual(0.5, request.Percentile(50))
+    self.assertEqual(1234, request.SizePercentile(50))
+    self.assertEqual(
+        0.25,
+        self.stats.GetSeries('RunCodeSearch', 'render').Percentile(50))
+    self.assertEqual(
+        0.75,
+        self.stats.GetSeries('RunCodeSearch', 'total').Percentile(50))
+
+    # Outside of a command.
+    with self.stats.Stage('render'):
+      pass
+    self.assertEqual(1, self.stats.GetSeries('-', 'render').Count())
+    self.assertIsNone(self.stats.Current())
+
+  def test_stage_records_failures(self):
+
+    def Fail():
+      with self.stats.Command('RunXrefSearch'):
+        with self.stats.Stage('request'):
+          self.clock.Advance(2)
+          raise ValueError('boom')
+
+    self.assertRaises(ValueError, Fail)
+    self.assertEqual(
+        2,
+        self.stats.GetSeries('RunXrefSearch', 'request').Percentile(50))
+
+  def test_activate_on_other_thread(self):
+    with self.stats.Command('RunCallgraphSearch') as record:
+      pass
+
+    def Work():
+      with self.stats.Activate(record):
+        with self.stats.Stage('request'):
+          self.clock.Advance(1)
+
+    thread = threading.Thread(target=Work)
+    thread.start()
+    thread.join()
+    self.assertEqual(
+        1,
+        self.stats.GetSeries('RunCallgraphSearch', 'request').Count())
+    self.assertIsNone(self.stats.Current())
+
+  def test_rolling_window(self):
+    s = stats.Stats(window_size=10, clock=self.clock)
+    for ms in range(100):
+      s.Record(None, 'render', ms / 1000.0)
+    series = s.GetSeries('-', 'render')
+    self.assertEqual(100, series.Count())
+    self.assertAlmostEqual(0.090, series.Percentile(0))
+    self.assertAlmostEqual(0.099, series.Percentile(100))
+    self.assertEqual([0, 0, 10, 0, 0, 0], series.Histogram())
+
+  def test_histogram_buckets(self):
+    for seconds in [0.0005, 0.005, 0.05, 0.5, 5, 50, 0.001]:
+      self.stats.Record(None, 'total', seconds)
+    # Bounds are exclusive.
+    self.assertEqual([1, 2, 1, 1, 1, 1],
+                     self.stats.GetSeries('-', 'total').Histogram())
+
+  def test_report(self):
+    with self.stats.Command('RunCodeSearch'):
+      self.clock.Advance(0.1)
+    lines = self.stats.Report()
+    self.assertEqual(2, len(lines))
+    self.assertTrue(lines[1].startswith('RunCodeSearch'))
+    self.assertIn('100.0', lines[1])
+
+    self.stats.Clear()
+    self.assertEqual(1, len(self.stats.Report()))
+
+  def test_log(self):
+    temp_dir = tempfile.mkdtemp()
+    try:
+      log_path = os.path.join(temp_dir, 'stats.log')
+      s = stats.Stats(log_path=log_path, clock=self.clock)
+      with s.Command('RunCodeSearch') as record:
+        with s.Stage('request') as timer:
+          timer.size = 10
+
+      with open(log_path, 'r') as f:
+        entries = [json.loads(line) for line in f]
+      self.assertEqual(['request', 'total'], [e['stage'] for e in entries])
+      self.assertEqual([record.id] * 2, [e['id'] for e in entries])
+      self.assertEqual(10, entries[0]['size'])
+
+      # A log that can't be written doesn't get in the way.
+      s = stats.Stats(
+          log_path=os.path.join(temp_dir, 'missing', 'stats.log'),
+          clock=self.clock)
+      with s.Command('RunCodeSearch'):
+        pass
+      self.assertEqual(1, s.GetSeries('RunCodeSearch', 'total').Count())
+    finally:
+      shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+  unittest.main()
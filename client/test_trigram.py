@@ -0,0 +1,297 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(SCRIPT_DIR)
+
+import trigram
+
+
+class TestRequiredLiterals(unittest.TestCase):
+
+  def test_literals(self):
+    self.assertEqual(['foobar'], trigram._RequiredLiterals('foobar'))
+    self.assertEqual(['foo', 'bar'], trigram._RequiredLiterals('foo.*bar'))
+    self.assertEqual(['fo', 'bar'], trigram._RequiredLiterals('foo?bar'))
+    self.assertEqual(['foo', 'bar'], trigram._RequiredLiterals('foo+bar'))
+    self.assertEqual(['a.b'], trigram._RequiredLiterals(r'a\.b'))
+    self.assertEqual(['foo', 'bar'], trigram._RequiredLiterals(r'foo\sbar'))
+    self.assertEqual(['foo', 'bar'],
+                     trigram._RequiredLiterals('foo[a-z]bar(baz)?'))
+    self.assertEqual(['a', 'b'], trigram._RequiredLiterals(r'a\x41b'))
+    self.assertEqual([], trigram._RequiredLiterals('foo|bar'))
+
+
+class TestQuery(unittest.TestCase):
+
+  def test_tags(self):
+    q = trigram.Query('-file:test file:"base/ x" lang:c++ Foo -Bar')
+    self.assertTrue(q.MatchesPath('src/base/ x/foo.cc'))
+    self.assertFalse(q.MatchesPath('src/base/ x/foo_test.cc'))
+    self.assertFalse(q.MatchesPath('src/base/foo.cc'))
+    self.assertEqual(set([('f', 'o', 'o')]), q.trigrams_)
+    self.assertIsNotNone(q.MatchLines('foo'))
+    self.assertIsNone(q.MatchLines('foo\nbar'))
+
+  def test_case(self):
+    self.assertIsNotNone(trigram.Query('Foo').MatchLines('foo'))
+    self.assertIsNone(trigram.Query('Foo case:yes').MatchLines('foo'))
+
+  def test_all_terms_must_match(self):
+    q = trigram.Query('foo bar')
+    self.assertEqual({0: [(0, 3)], 2: [(3, 6)]}, q.MatchLines('foo\n\nxx bar'))
+    self.assertIsNone(q.MatchLines('foo'))
+
+  def test_match_spanning_lines(self):
+    q = trigram.Query(r'a\s+b')
+    self.assertEqual({1: [(0, 3)]}, q.MatchLines('a\na b\nb'))
+    self.assertIsNone(q.MatchLines('a\nb'))
+
+  def test_invalid_regex_is_literal(self):
+    q = trigram.Query('Foo(')
+    self.assertEqual(
+        set([('f', 'o', 'o'), ('o', 'o', '(')]), q.trigrams_)
+    self.assertEqual({1: [(1, 5)]}, q.MatchLines('foo\n foo('))
+
+
+class FakeClock(object):
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+
+class TestTrigramIndex(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.index_dir = os.path.join(self.root, '.index')
+    self.clock = FakeClock()
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def WriteFile(self, path, contents, mtime=None):
+    full_path = os.path.join(self.root, *path.split('/'))
+    if not os.path.isdir(os.path.dirname(full_path)):
+      os.makedirs(os.path.dirname(full_path))
+    with open(full_path, 'wb') as f:
+      f.write(contents)
+    if mtime is not None:
+      os.utime(full_path, (mtime, mtime))
+
+  def NewIndex(self, **kwargs):
+    return trigram.TrigramIndex(
+        self.root, index_dir=self.index_dir, clock=self.clock, **kwargs)
+
+  def Search(self, index, query, **kwargs):
+    return index.Search(query, **kwargs)['search_response'][0]
+
+  def Paths(self, response):
+    return [r['top_file']['file']['name'] for r in response['search_result']]
+
+  def test_search(self):
+    self.WriteFile('src/a.cc', b'int main() {\n  return Foo();\n}\n')
+    self.WriteFile('src/b/c.h', b'// Foo\nclass Foo {};\n')
+    self.WriteFile('src/d.txt', b'nothing to see here\n')
+    index = self.NewIndex()
+    self.assertEqual(3, index.Update())
+    self.assertTrue(index.IsReady())
+
+    response = self.Search(index, 'foo')
+    self.assertEqual(['src/a.cc', 'src/b/c.h'], self.Paths(response))
+    self.assertFalse(response['hit_max_results'])
+    self.assertEqual(2, response['estimated_total_number_of_results'])
+
+    result = response['search_result'][0]
+    self.assertEqual(2, result['best_matching_line_number'])
+    self.assertEqual(1, result['num_matches'])
+    snippet = result['snippet'][0]
+    self.assertEqual(1, snippet['first_line_number'])
+    self.assertEqual('int main() {\n  return Foo();\n}',
+                     snippet['text']['text'])
+    self.assertEqual([{
+        'range': {
+            'start_line': 2,
+            'end_line': 2,
+            'start_column': 10,
+            'end_column': 13
+        },
+        'type': 'SNIPPET_QUERY_MATCH'
+    }], snippet['text']['range'])
+
+    self.assertEqual(['src/b/c.h'],
+                     self.Paths(self.Search(index, 'class foo')))
+    self.assertEqual(['src/b/c.h'],
+                     self.Paths(self.Search(index, 'file:\\.h$')))
+    self.assertEqual([], self.Paths(self.Search(index, 'Foo case:yes file:d')))
+
+  def test_snippets(self):
+    lines = ['line {}'.format(i) for i in range(40)]
+    lines[5] = lines[7] = lines[30] = 'match'
+    self.WriteFile('a', '\n'.join(lines).encode('utf-8'))
+    index = self.NewIndex()
+    index.Update()
+
+    result = self.Search(index, 'match', lines_context=2)['search_result'][0]
+    self.assertEqual(3, result['num_matches'])
+    self.assertEqual([(4, 10), (29, 33)],
+                     [(s['first_line_number'],
+                       s['first_line_number'] + s['text']['text'].count('\n'))
+                      for s in result['snippet']])
+    self.assertFalse(result['has_unshown_matches'])
+
+    result = self.Search(
+        index, 'match', lines_context=2, max_snippets=1)['search_result'][0]
+    self.assertEqual(1, len(result['snippet']))
+    self.assertTrue(result['has_unshown_matches'])
+
+  def test_paging(self):
+    for i in range(5):
+      self.WriteFile('f{}'.format(i), b'needle\n')
+    self.WriteFile('g', b'needle in a haystack\n')
+    index = self.NewIndex()
+    index.Update()
+
+    response = self.Search(index, 'needle$', max_num_results=2)
+    self.assertEqual(['f0', 'f1'], self.Paths(response))
+    self.assertTrue(response['hit_max_results'])
+    # The last candidate hasn't been read, so it may or may not match.
+    self.assertEqual(6, response['estimated_total_number_of_results'])
+
+    response = self.Search(
+        index, 'needle$', results_offset=4, max_num_results=2)
+    self.assertEqual(['f4'], self.Paths(response))
+    self.assertEqual(4, response['results_offset'])
+    self.assertFalse(response['hit_max_results'])
+    self.assertEqual(5, response['estimated_total_number_of_results'])
+
+  def test_skipped_files(self):
+    self.WriteFile('src/a', b'needle')
+    self.WriteFile('src/.git/b', b'needle')
+    self.WriteFile('src/out/c', b'needle')
+    self.WriteFile('src/third_party/d', b'needle')
+    self.WriteFile('src/e', b'needle\0')
+    self.WriteFile('src/f', b'needle' * 100)
+    index = self.NewIndex(max_file_size=100, excludes=['src/third_party'])
+    index.Update()
+    self.assertEqual(['src/a', 'src/out/c'],
+                     self.Paths(self.Search(index, 'needle')))
+
+  def test_incremental_update(self):
+    self.WriteFile('a', b'alpha', mtime=100)
+    self.WriteFile('b', b'beta', mtime=100)
+    index = self.NewIndex()
+    self.assertEqual(2, index.Update())
+    self.assertEqual(0, index.Update())
+
+    self.WriteFile('a', b'gamma', mtime=200)
+    os.remove(os.path.join(self.root, 'b'))
+    self.WriteFile('c', b'alphabet', mtime=100)
+    self.assertEqual(3, index.Update())
+    self.assertEqual(['c'], self.Paths(self.Search(index, 'alpha')))
+    self.assertEqual(['a'], self.Paths(self.Search(index, 'gamma')))
+    self.assertEqual([], self.Paths(self.Search(index, 'beta')))
+    self.assertEqual(2, index.FileCount())
+    # Two of the four ids were dead, so the index was compacted.
+    self.assertEqual(['a', 'c'], index.paths_)
+    self.assertEqual(0, index.dead_count_)
+
+  def test_persistence(self):
+    self.WriteFile('a', b'alpha', mtime=100)
+    self.WriteFile('b', b'beta', mtime=100)
+    self.NewIndex().Update()
+
+    index = self.NewIndex()
+    self.assertTrue(index.Load())
+    self.assertTrue(index.IsReady())
+    self.assertEqual(['a'], self.Paths(self.Search(index, 'alpha')))
+
+    # Only the changed file is read.
+    self.WriteFile('b', b'betamax', mtime=200)
+    index = self.NewIndex()
+    self.assertEqual(1, index.Update())
+    self.assertEqual(['b'], self.Paths(self.Search(index, 'max')))
+
+    # An index for another root is ignored.
+    other = trigram.TrigramIndex(
+        os.path.join(self.root, 'a'), index_dir=self.index_dir)
+    self.assertFalse(other.Load())
+
+  def test_shards(self):
+    for i in range(20):
+      self.WriteFile('f{:02d}'.format(i), 'common word{}\n'.format(i).encode(
+          'utf-8'), mtime=100)
+    # Postings are spilled to disk every few files and merged into shards.
+    index = self.NewIndex(max_pending_postings=30)
+    self.assertEqual(20, index.Update())
+    self.assertEqual(0, index.generation_)
+    self.assertEqual({}, index.pending_)
+    self.assertEqual(
+        ['f{:02d}'.format(i) for i in range(20)],
+        self.Paths(self.Search(index, 'common')))
+    self.assertEqual(['f07'], self.Paths(self.Search(index, 'word7$')))
+
+    # A changed file is found via the pending postings until the next merge,
+    # and the new index reads the shards written by the first.
+    self.WriteFile('f03', b'rare\n', mtime=200)
+    index = self.NewIndex(max_pending_postings=30)
+    self.assertEqual(1, index.Update())
+    self.assertEqual(0, index.generation_)
+    self.assertEqual(['f03'], self.Paths(self.Search(index, 'rare')))
+    self.assertEqual(19, len(self.Paths(self.Search(index, 'common'))))
+
+    # Removing most files compacts the index into a new generation.
+    for i in range(4, 20):
+      os.remove(os.path.join(self.root, 'f{:02d}'.format(i)))
+    self.assertEqual(16, index.Update())
+    self.assertEqual(1, index.generation_)
+    self.assertEqual(['f00', 'f01', 'f02', 'f03'], index.paths_)
+    self.assertEqual(['f00', 'f01', 'f02'],
+                     self.Paths(self.Search(index, 'common')))
+    self.assertEqual(['f03'], self.Paths(self.Search(index, 'rare')))
+    self.assertEqual(['gen-1', 'index'], sorted(os.listdir(self.index_dir)))
+
+  def test_temporary_index_dir(self):
+    self.WriteFile('a', b'alpha')
+    index = trigram.TrigramIndex(self.root, max_pending_postings=1)
+    index.Update()
+    temp_dir = index.temp_dir_
+    self.assertTrue(os.path.isdir(os.path.join(temp_dir, 'gen-0')))
+    self.assertEqual(['a'], self.Paths(self.Search(index, 'alpha')))
+    index.Close()
+    self.assertFalse(os.path.exists(temp_dir))
+
+  def test_update_in_background(self):
+    self.WriteFile('a', b'alpha')
+    index = self.NewIndex(update_interval=60)
+    index.Update()
+
+    self.WriteFile('b', b'beta')
+    # Too soon after the last update.
+    index.UpdateInBackground()
+    self.assertFalse(index.updating_)
+    self.assertEqual(1, index.FileCount())
+
+    self.clock.now += 61
+    index.UpdateInBackground()
+    deadline = time.time() + 5
+    while index.updating_ and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertEqual(2, index.FileCount())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,108 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+import sys
+import unittest
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(SCRIPT_DIR)
+
+import xrefs
+
+
+class Struct(object):
+
+  def __init__(self, **kwargs):
+    self.__dict__.update(kwargs)
+
+
+def Result(filename, *matches):
+  return Struct(
+      file=Struct(name=filename),
+      match=[
+          Struct(type_id=t, line_number=l, signature=s) for t, l, s in matches
+      ])
+
+
+# Maps a signature to the XrefSearchResults for it.
+XREFS = {
+    'method': [
+        Result('a.h', ('DECLARATION', 10, 'a-decl'),
+               ('REFERENCE', 20, 'method')),
+        Result('b.h', ('DECLARATION', 5, 'b-decl')),
+        Result('a.cc', ('DEFINITION', 30, 'a-decl'), ('CALLED_BY', 3, 'x')),
+    ],
+    'a-decl': [
+        Result('c.cc', ('OVERRIDDEN_BY', 7, 'c-impl')),
+        Result('d.cc', ('OVERRIDDEN_BY', 9, 'd-impl')),
+    ],
+    'b-decl': [
+        Result('c.cc', ('OVERRIDDEN_BY', 7, 'c-impl')),
+        Result('b.h', ('REFERENCE', 1, 'b-decl')),
+    ],
+    'c-impl': [Result('e.cc', ('OVERRIDDEN_BY', 2, 'e-impl'))],
+}
+
+
+class TestTraverseXrefs(unittest.TestCase):
+
+  def setUp(self):
+    self.requests = []
+
+  def Search(self, signatures):
+    self.requests.append(list(signatures))
+    return [XREFS.get(s, []) for s in signatures]
+
+  def Locations(self, visited):
+    return [(f.name, m.line_number) for f, m in visited]
+
+  def test_call_targets(self):
+    visited = xrefs.TraverseXrefs(self.Search, 'method',
+                                  [['DECLARATION', 'DEFINITION'],
+                                   ['OVERRIDDEN_BY']])
+    self.assertEqual([('a.h', 10), ('b.h', 5), ('a.cc', 30), ('c.cc', 7),
+                      ('d.cc', 9)], self.Locations(visited))
+
+    # One request per hop regardless of the number of declarations. Duplicate
+    # signatures are only looked up once.
+    self.assertEqual([['method'], ['a-decl', 'b-decl']], self.requests)
+
+  def test_stops_when_nothing_matches(self):
+    visited = xrefs.TraverseXrefs(self.Search, 'method',
+                                  [['EXTENDS'], ['OVERRIDDEN_BY']])
+    self.assertEqual([], visited)
+    self.assertEqual([['method']], self.requests)
+
+  def test_three_hops(self):
+    visited = xrefs.TraverseXrefs(self.Search, 'a-decl', [['OVERRIDDEN_BY'],
+                                                          ['OVERRIDDEN_BY'],
+                                                          ['OVERRIDDEN_BY']])
+    self.assertEqual([('c.cc', 7), ('d.cc', 9), ('e.cc', 2)],
+                     self.Locations(visited))
+    self.assertEqual([['a-decl'], ['c-impl', 'd-impl'], ['e-impl']],
+                     self.requests)
+
+
+class TestPartitionByKind(unittest.TestCase):
+
+  def test_partition(self):
+    partitions = xrefs.PartitionByKind(XREFS['method'])
+    self.assertEqual(
+        set(['DECLARATION', 'DEFINITION', 'REFERENCE', 'CALLED_BY']),
+        set(partitions.keys()))
+    self.assertEqual([('a.h', 10), ('b.h', 5)],
+                     [(f.name, m.line_number)
+                      for f, m in partitions['DECLARATION']])
+    self.assertEqual([('a.cc', 3)], [(f.name, m.line_number)
+                                     for f, m in partitions['CALLED_BY']])
+
+  def test_empty(self):
+    self.assertEqual({}, xrefs.PartitionByKind([]))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,990 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+import bisect
+import fnmatch
+import os
+import pickle
+import re
+import shutil
+import stat
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+# For type checking. Not needed at runtime.
+try:
+  from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+except ImportError:
+  pass
+
+INDEX_VERSION = 2
+
+DEFAULT_MAX_FILE_SIZE = 1024 * 1024
+
+DEFAULT_UPDATE_INTERVAL_IN_SECONDS = 5 * 60
+
+# Number of postings that are kept in memory while indexing before they're
+# written to disk. Each takes 4 bytes plus a share of the per trigram overhead.
+DEFAULT_MAX_PENDING_POSTINGS = 2 * 1024 * 1024
+
+# Number of files across which the posting lists are spread, by trigram.
+SHARD_COUNT = 256
+
+# Number of shard directories that are kept in memory.
+MAX_CACHED_DIRECTORIES = 32
+
+# Size of a file id in a posting list.
+ITEM_SIZE = array('i').itemsize
+
+# Each shard starts with the size of its directory.
+_HEADER = struct.Struct('<Q')
+
+# Directories that are never indexed, by name. Hidden directories are skipped
+# as well.
+DEFAULT_EXCLUDES = ['out', 'out_*', 'node_modules']
+
+DEFAULT_MAX_SNIPPETS = 3
+
+# Files with a NUL byte in this many leading bytes are considered binary.
+BINARY_SNIFF_SIZE = 8 * 1024
+
+# The index is compacted once more than this fraction of the file ids refer to
+# files that have since been changed or removed.
+COMPACTION_RATIO = 0.25
+
+# Posting lists that are more than this many times as long as the current set
+# of candidates aren't worth intersecting. Reading the few candidates that are
+# left is cheaper.
+INTERSECTION_RATIO = 64
+
+# Tags in queries that are handled locally. Other tags, like 'lang:' and
+# 'package:', are dropped.
+FILE_TAGS = ('file', 'f')
+IGNORED_TAGS = ('lang', 'package', 'pkg', 'p')
+
+# Number of characters that follow \x, \u and \U in a regular expression.
+_ESCAPE_LENGTHS = {'x': 2, 'u': 4, 'U': 8}
+
+_TOKEN_RE = re.compile(r'(?:[^\s"]|"(?:[^"\\]|\\.)*")+')
+_QUOTED_RE = re.compile(r'"((?:[^"\\]|\\.)*)"')
+_TAG_RE = re.compile(r'(\w+):(.*)$', re.DOTALL)
+
+
+def _ToBytes(a):
+  # array.tostring() is called tobytes() in Python 3.
+  if hasattr(a, 'tobytes'):
+    return a.tobytes()
+  return a.tostring()
+
+
+def _FromBytes(data):
+  a = array('i')
+  if hasattr(a, 'frombytes'):
+    a.frombytes(data)
+  else:
+    a.fromstring(data)
+  return a
+
+
+def _Shard(t):
+  # type: (Tuple[str, str, str]) -> int
+  # hash() isn't stable across runs.
+  return (ord(t[0]) * 961 + ord(t[1]) * 31 + ord(t[2])) % SHARD_COUNT
+
+
+def _RequiredLiterals(pattern):
+  # type: (str) -> List[str]
+  """\
+  Returns strings that any match of the regular expression |pattern| must
+  contain. Errs on the side of returning fewer of them. Alternations and
+  anything inside a group are ignored.
+  """
+  if '|' in pattern:
+    return []
+  runs = []
+  current = []
+  depth = 0
+  i = 0
+  while i < len(pattern):
+    c = pattern[i]
+    literal = None
+    if c == '\\':
+      escaped = pattern[i + 1:i + 2]
+      i += 2
+      if escaped in _ESCAPE_LENGTHS:
+        i += _ESCAPE_LENGTHS[escaped]
+      elif escaped == 'N':
+        i = pattern.find('}', i) + 1 or len(pattern)
+      elif escaped.isdigit():
+        while pattern[i:i + 1].isdigit():
+          i += 1
+      elif escaped and not escaped.isalnum():
+        literal = escaped
+    elif c == '[':
+      i += 1
+      if pattern[i:i + 1] == '^':
+        i += 1
+      if pattern[i:i + 1] == ']':
+        i += 1
+      while i < len(pattern) and pattern[i] != ']':
+        i += 2 if pattern[i] == '\\' else 1
+      i += 1
+    else:
+      i += 1
+      if c == '(':
+        depth += 1
+      elif c == ')':
+        depth -= 1
+      elif c not in '.^$*+?{}':
+        literal = c
+
+    quantifier = pattern[i:i + 1]
+    if literal is not None and depth == 0 and quantifier not in ('*', '?', '{'):
+      current.append(literal)
+      if quantifier != '+':
+        continue
+    if current:
+      runs.append(''.join(current))
+      current = []
+  if current:
+    runs.append(''.join(current))
+  return runs
+
+
+def _Trigrams(s):
+  # type: (str) -> Set[Tuple[str, str, str]]
+  """\
+  Returns the set of distinct three character sequences in |s|, each as a tuple
+  of characters. Tuples are much faster to produce than substrings.
+  """
+  return set(zip(s, s[1:], s[2:]))
+
+
+def _AsRegex(pattern):
+  """\
+  Returns |pattern| if it's a valid regular expression, or a regular expression
+  that matches it literally otherwise.
+  """
+  try:
+    re.compile(pattern)
+    return pattern
+  except re.error:
+    return re.escape(pattern)
+
+
+def _Unquote(s):
+  return _QUOTED_RE.sub(lambda m: re.sub(r'\\(.)', r'\1', m.group(1)), s)
+
+
+class Query(object):
+  """\
+  A code search query, as understood by TrigramIndex.
+
+  Terms are regular expressions, all of which need to match a line in a file
+  for the file to match. Terms prefixed with '-' must not match any line.
+  'file:' restricts the search to files whose path matches a regular
+  expression, and '-file:' excludes them. Matching is case insensitive unless
+  the query contains 'case:yes'. Terms that aren't valid regular expressions
+  are matched literally.
+  """
+
+  def __init__(self, query):
+    # type: (str) -> None
+    terms = []
+    excluded_terms = []
+    file_patterns = []
+    excluded_file_patterns = []
+    self.case_sensitive_ = False
+
+    for token in _TOKEN_RE.findall(query):
+      negated = token.startswith('-') and len(token) > 1
+      if negated:
+        token = token[1:]
+      m = _TAG_RE.match(token)
+      tag = m.group(1).lower() if m else None
+      if tag in FILE_TAGS:
+        target = excluded_file_patterns if negated else file_patterns
+        target.append(_AsRegex(_Unquote(m.group(2))))
+      elif tag == 'case':
+        self.case_sensitive_ = m.group(2).lower() == 'yes'
+      elif tag in IGNORED_TAGS:
+        pass
+      else:
+        (excluded_terms if negated else terms).append(
+            _AsRegex(_Unquote(token)))
+
+    # Required trigrams, in lower case, for terms that must match.
+    self.trigrams_ = set()
+    for term in terms:
+      for literal in _RequiredLiterals(term):
+        self.trigrams_.update(_Trigrams(literal.lower()))
+
+    self.terms_ = [self._Compile(t, re.MULTILINE) for t in terms]
+    self.excluded_terms_ = [
+        self._Compile(t, re.MULTILINE) for t in excluded_terms
+    ]
+    self.file_patterns_ = [self._Compile(p) for p in file_patterns]
+    self.excluded_file_patterns_ = [
+        self._Compile(p) for p in excluded_file_patterns
+    ]
+
+  def _Compile(self, pattern, flags=0):
+    if not self.case_sensitive_:
+      flags |= re.IGNORECASE
+    return re.compile(pattern, flags)
+
+  def MatchesPath(self, path):
+    # type: (str) -> bool
+    return all(p.search(path) for p in self.file_patterns_) and \
+        not any(p.search(path) for p in self.excluded_file_patterns_)
+
+  def MatchLines(self, text):
+    # type: (str) -> Optional[Dict[int, List[Tuple[int, int]]]]
+    """\
+    Returns a map from the index of each line in |text| that matches a term to
+    the list of (start, end) column ranges that match, or None if |text|
+    doesn't match the query.
+    """
+    for term in self.excluded_terms_:
+      if term.search(text):
+        return None
+
+    # Matching the whole text at once with re.MULTILINE is much faster than
+    # matching line by line. Matches that span lines are redone line by line.
+    line_starts = None
+    matches = {}
+    for term in self.terms_:
+      found = False
+      for m in term.finditer(text):
+        start, end = m.span()
+        if start < end:
+          if line_starts is None:
+            line_starts = _LineStarts(text)
+          number = bisect.bisect_right(line_starts, start) - 1
+          if number + 1 < len(line_starts) and end >= line_starts[number + 1]:
+            found = self._MatchLinesOneByOne(term, text, matches)
+            break
+          line_start = line_starts[number]
+          matches.setdefault(number, []).append(
+              (start - line_start, end - line_start))
+        found = True
+      if not found:
+        return None
+    return matches
+
+  @staticmethod
+  def _MatchLinesOneByOne(term, text, matches):
+    found = False
+    for number, line in enumerate(text.split('\n')):
+      for m in term.finditer(line):
+        found = True
+        if m.end() > m.start() and m.span() not in matches.get(number, ()):
+          matches.setdefault(number, []).append(m.span())
+    return found
+
+
+def _LineStarts(text):
+  # type: (str) -> List[int]
+  starts = [0]
+  i = text.find('\n')
+  while i >= 0:
+    starts.append(i + 1)
+    i = text.find('\n', i + 1)
+  return starts
+
+
+def _MergeSpans(spans):
+  merged = []
+  for start, end in sorted(spans):
+    if merged and start <= merged[-1][1]:
+      merged[-1][1] = max(merged[-1][1], end)
+    else:
+      merged.append([start, end])
+  return merged
+
+
+def _Snippet(lines, start, end, matches):
+  ranges = []
+  for number in range(start, end):
+    for span_start, span_end in _MergeSpans(matches.get(number, [])):
+      ranges.append({
+          'range': {
+              'start_line': number - start + 1,
+              'end_line': number - start + 1,
+              'start_column': span_start + 1,
+              'end_column': span_end + 1
+          },
+          'type': 'SNIPPET_QUERY_MATCH'
+      })
+  return {
+      'first_line_number': start + 1,
+      'text': {
+          'text': '\n'.join(lines[start:end]),
+          'range': ranges
+      }
+  }
+
+
+class TrigramIndex(object):
+  """\
+  A trigram index over the text files below |root|, which answers code search
+  queries without involving the server.
+
+  Each file is indexed by the set of distinct three character sequences in its
+  lower cased text. A query is reduced to the trigrams that any matching line
+  must contain. Only files that contain all of them are read and matched
+  against the query. Queries that don't yield any trigrams, e.g. 'file:'
+  queries or very short terms, read every file.
+
+  The posting lists, i.e. the ids of the files that contain each trigram, are
+  kept on disk in |index_dir|, split into SHARD_COUNT shards by trigram. A
+  query only reads the lists for its own trigrams. Postings for files that
+  were indexed recently are kept in memory until there are more than
+  |max_pending_postings| of them, after which they're merged into a new set of
+  shards, one shard at a time. Memory use therefore depends on the number of
+  files, not on their size. If |index_dir| isn't specified, a temporary
+  directory is used and removed by Close().
+
+  Update() brings the index up to date. It only reads files whose
+  modification time or size differ from when they were last indexed. Files
+  larger than |max_file_size| bytes, binary files, hidden files and
+  directories, and directories whose name or path relative to |root| matches
+  one of the glob patterns in |excludes| are skipped.
+
+  Searches may run while the index is being updated. They see the files that
+  had been indexed when the update started and some of the ones indexed
+  since. Files are always matched against their current contents, so results
+  are never stale, but text that was added after a file was indexed isn't
+  found until the next update.
+  """
+
+  def __init__(self,
+               root,
+               index_dir=None,
+               max_file_size=DEFAULT_MAX_FILE_SIZE,
+               excludes=DEFAULT_EXCLUDES,
+               update_interval=DEFAULT_UPDATE_INTERVAL_IN_SECONDS,
+               max_pending_postings=DEFAULT_MAX_PENDING_POSTINGS,
+               clock=time.time):
+    self.root_ = root
+    self.index_dir_ = index_dir
+    self.max_file_size_ = max_file_size
+    self.excludes_ = list(excludes)
+    self.update_interval_ = update_interval
+    self.max_pending_postings_ = max_pending_postings
+    self.clock_ = clock
+    self.lock_ = threading.Lock()
+
+    # Directory that holds the index if |index_dir| wasn't specified. Created
+    # when it's first needed.
+    self.temp_dir_ = None
+
+    self.loaded_ = False
+    self.updating_ = False
+
+    # Time at which the last update completed, or None if there hasn't been
+    # one yet.
+    self.updated_at_ = None
+
+    # Maps a file id to the path of the file relative to |root|, using '/' as
+    # the separator, or to None if the file has since been changed or removed.
+    self.paths_ = []  # type: List[Optional[str]]
+
+    # Maps the path of each file that's been seen to a (file id, modification
+    # time, size) tuple. The id is -1 for binary or unreadable files.
+    self.files_ = {}  # type: Dict[str, Tuple[int, float, int]]
+
+    # Number of ids in |paths_| that no longer refer to a file.
+    self.dead_count_ = 0
+
+    # The shards on disk, or None if there aren't any yet. |shards_| holds the
+    # numbers of the shards that have any postings at all.
+    self.generation_ = None  # type: Optional[int]
+    self.shards_ = set()  # type: Set[int]
+
+    # Maps a shard to its directory, which maps a trigram to the (offset,
+    # count) of its posting list in the shard, for recently used shards.
+    self.directories_ = OrderedDict()
+
+    # Maps a trigram to an array of the ids of the files indexed since the
+    # shards were written that contain it, in ascending order. The ids are
+    # all larger than the ones in the shards.
+    self.pending_ = {}  # type: Dict[Tuple[str, str, str], array]
+    self.pending_count_ = 0
+
+    # Whether some postings have been moved from |pending_| to the spool files
+    # since the shards were written. They aren't found until they're merged.
+    self.spooled_ = False
+
+  def FileCount(self):
+    # type: () -> int
+    with self.lock_:
+      return len(self.paths_) - self.dead_count_
+
+  def IsReady(self):
+    # type: () -> bool
+    """\
+    Returns True if the index covers the whole tree, i.e. if it was loaded from
+    |index_dir| or has been updated at least once.
+    """
+    with self.lock_:
+      return self.loaded_ or self.updated_at_ is not None
+
+  def Close(self):
+    # type: () -> None
+    """\
+    Removes the temporary directory that holds the index, if there is one.
+    """
+    with self.lock_:
+      temp_dir, self.temp_dir_ = self.temp_dir_, None
+    if temp_dir is not None:
+      shutil.rmtree(temp_dir, ignore_errors=True)
+
+  def _IndexDir(self):
+    if self.index_dir_:
+      return self.index_dir_
+    if self.temp_dir_ is None:
+      self.temp_dir_ = tempfile.mkdtemp(prefix='crcs-index-')
+    return self.temp_dir_
+
+  def _GenerationDir(self, generation):
+    return os.path.join(self._IndexDir(), 'gen-{}'.format(generation))
+
+  def _ShardPath(self, generation, shard):
+    return os.path.join(
+        self._GenerationDir(generation), 'shard-{:03d}'.format(shard))
+
+  def _SpoolPath(self, shard):
+    return os.path.join(self._IndexDir(), 'spool-{:03d}'.format(shard))
+
+  def Load(self):
+    # type: () -> bool
+    """\
+    Loads the index from |index_dir|. Returns False, leaving the index as is,
+    if there's no usable index there.
+    """
+    if not self.index_dir_:
+      return False
+    try:
+      with open(os.path.join(self.index_dir_, 'index'), 'rb') as f:
+        state = pickle.load(f)
+      if state['version'] != INDEX_VERSION or state['root'] != self.root_:
+        return False
+      if state['generation'] is not None and not os.path.isdir(
+          self._GenerationDir(state['generation'])):
+        return False
+      pending = dict(
+          (t, _FromBytes(ids)) for t, ids in state['pending'].items())
+    except Exception:
+      return False
+    with self.lock_:
+      self.paths_ = state['paths']
+      self.files_ = state['files']
+      self.dead_count_ = self.paths_.count(None)
+      self.generation_ = state['generation']
+      self.shards_ = state['shards']
+      self.directories_.clear()
+      self.pending_ = pending
+      self.pending_count_ = sum(len(ids) for ids in pending.values())
+      self.loaded_ = True
+    return True
+
+  def Save(self):
+    # type: () -> None
+    """\
+    Writes the list of files and the pending postings to |index_dir|, replacing
+    the previous copy. The shards are written as they're created.
+    """
+    if not self.index_dir_:
+      return
+    with self.lock_:
+      if self.spooled_:
+        # The spooled postings would be lost.
+        return
+      state = {
+          'version': INDEX_VERSION,
+          'root': self.root_,
+          'paths': self.paths_,
+          'files': self.files_,
+          'generation': self.generation_,
+          'shards': self.shards_,
+          'pending':
+              dict((t, _ToBytes(ids)) for t, ids in self.pending_.items()),
+      }
+      data = pickle.dumps(state, protocol=2)
+    index_path = os.path.join(self.index_dir_, 'index')
+    temp_path = '{}.{}.tmp'.format(index_path,
+                                   threading.current_thread().ident)
+    try:
+      if not os.path.isdir(self.index_dir_):
+        os.makedirs(self.index_dir_)
+      with open(temp_path, 'wb') as f:
+        f.write(data)
+      if os.path.exists(index_path):
+        os.remove(index_path)
+      os.rename(temp_path, index_path)
+    except (IOError, OSError):
+      # The index is rebuilt from scratch next time.
+      pass
+
+  def _IsExcluded(self, name, path):
+    return name.startswith('.') or any(
+        fnmatch.fnmatch(name, p) or fnmatch.fnmatch(path, p)
+        for p in self.excludes_)
+
+  def _WalkFiles(self):
+    # type: () -> Iterator[Tuple[str, str, Any]]
+    """\
+    Yields a (path relative to |root|, full path, stat result) tuple for each
+    file that should be indexed.
+    """
+    for dirpath, dirnames, filenames in os.walk(self.root_):
+      relative_dir = os.path.relpath(dirpath, self.root_).replace(os.sep, '/')
+      prefix = '' if relative_dir == '.' else relative_dir + '/'
+      dirnames[:] = sorted(
+          d for d in dirnames if not self._IsExcluded(d, prefix + d))
+      for name in sorted(filenames):
+        if name.startswith('.'):
+          continue
+        full_path = os.path.join(dirpath, name)
+        try:
+          st = os.stat(full_path)
+        except OSError:
+          continue
+        if stat.S_ISREG(st.st_mode) and st.st_size <= self.max_file_size_:
+          yield prefix + name, full_path, st
+
+  @staticmethod
+  def _ReadTrigrams(full_path):
+    # type: (str) -> Optional[Set[str]]
+    try:
+      with open(full_path, 'rb') as f:
+        data = f.read()
+    except (IOError, OSError):
+      return None
+    if b'\0' in data[:BINARY_SNIFF_SIZE]:
+      return None
+    return _Trigrams(data.decode('utf-8', 'replace').lower())
+
+  def _Remove(self, path):
+    file_id = self.files_.pop(path, (-1,))[0]
+    if file_id >= 0:
+      self.paths_[file_id] = None
+      self.dead_count_ += 1
+
+  def _Add(self, path, st, trigrams):
+    if trigrams is None:
+      self.files_[path] = (-1, st.st_mtime, st.st_size)
+      return
+    file_id = len(self.paths_)
+    self.paths_.append(path)
+    self.files_[path] = (file_id, st.st_mtime, st.st_size)
+    for t in trigrams:
+      ids = self.pending_.get(t)
+      if ids is None:
+        ids = self.pending_[t] = array('i')
+      ids.append(file_id)
+    self.pending_count_ += len(trigrams)
+
+  def _Spill(self):
+    """\
+    Appends the pending postings to the spool files, grouped by shard. Only
+    the update thread changes |pending_|, so it can be read without the lock.
+    """
+    by_shard = {}
+    for t, ids in self.pending_.items():
+      by_shard.setdefault(_Shard(t), {})[t] = _ToBytes(ids)
+    try:
+      if not os.path.isdir(self._IndexDir()):
+        os.makedirs(self._IndexDir())
+      for shard, postings in by_shard.items():
+        with open(self._SpoolPath(shard), 'ab') as f:
+          pickle.dump(postings, f, protocol=2)
+    except (IOError, OSError):
+      # Keep the postings in memory. Whatever made it to the spool files is
+      # merged twice, which is harmless.
+      return
+    with self.lock_:
+      self.pending_ = {}
+      self.pending_count_ = 0
+      self.spooled_ = True
+
+  def _ReadSpool(self, shard):
+    # type: (int) -> Iterator[Dict[Tuple[str, str, str], bytes]]
+    try:
+      with open(self._SpoolPath(shard), 'rb') as f:
+        while True:
+          yield pickle.load(f)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+      return
+
+  def _RemoveSpool(self):
+    for shard in range(SHARD_COUNT):
+      path = self._SpoolPath(shard)
+      if os.path.exists(path):
+        os.remove(path)
+
+  def _ReadShard(self, generation, shard):
+    # type: (int, int) -> Dict[Tuple[str, str, str], array]
+    with open(self._ShardPath(generation, shard), 'rb') as f:
+      size, = _HEADER.unpack(f.read(_HEADER.size))
+      directory = pickle.loads(f.read(size))
+      data = f.read()
+    return dict((t, _FromBytes(data[offset:offset + count * ITEM_SIZE]))
+                for t, (offset, count) in directory.items())
+
+  def _WriteShard(self, generation, shard, postings):
+    """\
+    Writes a shard as its size prefixed, pickled directory followed by the
+    posting lists it points into. Offsets are relative to the end of the
+    directory.
+    """
+    directory = {}
+    offset = 0
+    for t in sorted(postings):
+      directory[t] = (offset, len(postings[t]))
+      offset += len(postings[t]) * ITEM_SIZE
+    data = pickle.dumps(directory, protocol=2)
+    with open(self._ShardPath(generation, shard), 'wb') as f:
+      f.write(_HEADER.pack(len(data)))
+      f.write(data)
+      for t in sorted(postings):
+        f.write(_ToBytes(postings[t]))
+
+  def _Merge(self, compact):
+    """\
+    Writes a new generation of shards that holds the postings in the current
+    shards, the spool files and |pending_|. If |compact| is set, the ids of
+    files that have been changed or removed are dropped and the rest are
+    renumbered. Relative order is preserved, so posting lists remain sorted.
+
+    Only the update thread changes the index, so it's read without the lock
+    here. Searches use the current shards until the new ones are complete.
+    Returns False if the shards couldn't be written.
+    """
+    new_ids = None
+    paths = self.paths_
+    if compact:
+      new_ids = array('i', [-1]) * len(self.paths_)
+      paths = []
+      for file_id, path in enumerate(self.paths_):
+        if path is not None:
+          new_ids[file_id] = len(paths)
+          paths.append(path)
+
+    pending_by_shard = {}
+    for t in self.pending_:
+      pending_by_shard.setdefault(_Shard(t), []).append(t)
+
+    generation = 0 if self.generation_ is None else self.generation_ + 1
+    generation_dir = self._GenerationDir(generation)
+    shards = set()
+    try:
+      if os.path.isdir(generation_dir):
+        shutil.rmtree(generation_dir)
+      os.makedirs(generation_dir)
+      for shard in range(SHARD_COUNT):
+        postings = {}
+        if shard in self.shards_:
+          postings = self._ReadShard(self.generation_, shard)
+        for chunk in self._ReadSpool(shard):
+          for t, ids in chunk.items():
+            postings.setdefault(t, array('i')).extend(_FromBytes(ids))
+        for t in pending_by_shard.get(shard, ()):
+          postings.setdefault(t, array('i')).extend(self.pending_[t])
+        if new_ids is not None:
+          for t in list(postings):
+            kept = array('i', [new_ids[i] for i in postings[t]
+                               if new_ids[i] >= 0])
+            if kept:
+              postings[t] = kept
+            else:
+              del postings[t]
+        if postings:
+          self._WriteShard(generation, shard, postings)
+          shards.add(shard)
+    except (IOError, OSError, EOFError, struct.error, pickle.UnpicklingError):
+      shutil.rmtree(generation_dir, ignore_errors=True)
+      return False
+
+    with self.lock_:
+      self.generation_ = generation
+      self.shards_ = shards
+      self.directories_.clear()
+      self.pending_ = {}
+      self.pending_count_ = 0
+      self.spooled_ = False
+      if new_ids is not None:
+        for path, (file_id, mtime, size) in list(self.files_.items()):
+          if file_id >= 0:
+            self.files_[path] = (new_ids[file_id], mtime, size)
+        self.paths_ = paths
+        self.dead_count_ = 0
+
+    # Older generations are removed once the index no longer refers to them.
+    self.Save()
+    try:
+      self._RemoveSpool()
+      for name in os.listdir(self._IndexDir()):
+        if name.startswith('gen-') and name != os.path.basename(generation_dir):
+          shutil.rmtree(os.path.join(self._IndexDir(), name),
+                        ignore_errors=True)
+    except OSError:
+      pass
+    return True
+
+  def _StartUpdate(self, if_older_than=None):
+    with self.lock_:
+      if self.updating_:
+        return False
+      if if_older_than is not None and self.updated_at_ is not None and \
+          self.clock_() - self.updated_at_ < if_older_than:
+        return False
+      self.updating_ = True
+      return True
+
+  def _Update(self):
+    changed = 0
+    merged = False
+    try:
+      if not self.loaded_ and self.updated_at_ is None:
+        self.Load()
+      if not self.spooled_:
+        # Left behind by an update that didn't complete.
+        try:
+          self._RemoveSpool()
+        except OSError:
+          pass
+
+      seen = set()
+      for path, full_path, st in self._WalkFiles():
+        seen.add(path)
+        entry = self.files_.get(path)
+        if entry is not None and entry[1:] == (st.st_mtime, st.st_size):
+          continue
+        # Reading happens outside of the lock so that searches can proceed.
+        trigrams = self._ReadTrigrams(full_path)
+        with self.lock_:
+          self._Remove(path)
+          self._Add(path, st, trigrams)
+        changed += 1
+        if self.pending_count_ > self.max_pending_postings_:
+          self._Spill()
+
+      with self.lock_:
+        for path in [p for p in self.files_ if p not in seen]:
+          self._Remove(path)
+          changed += 1
+      compact = self.dead_count_ > len(self.paths_) * COMPACTION_RATIO
+      if self.spooled_ or compact:
+        merged = self._Merge(compact)
+      with self.lock_:
+        self.updated_at_ = self.clock_()
+    finally:
+      with self.lock_:
+        self.updating_ = False
+
+    if changed and not merged:
+      self.Save()
+    return changed
+
+  def Update(self):
+    # type: () -> int
+    """\
+    Brings the index up to date with the files below |root|, loading it from
+    |index_dir| first if that hasn't happened yet. Returns the number of
+    files that were added, changed or removed. Does nothing if an update is
+    already in progress.
+    """
+    if not self._StartUpdate():
+      return 0
+    return self._Update()
+
+  def UpdateInBackground(self):
+    # type: () -> None
+    """\
+    Like Update(), but runs on a background thread, and only if the last
+    update completed more than |update_interval| seconds ago.
+    """
+    if not self._StartUpdate(if_older_than=self.update_interval_):
+      return
+    thread = threading.Thread(target=self._Update)
+    thread.daemon = True
+    thread.start()
+
+  def _Directory(self, shard):
+    """\
+    Returns a (directory, offset of the posting lists) tuple for |shard|, or
+    None if it can't be read. Must be called with the lock held.
+    """
+    directory = self.directories_.pop(shard, None)
+    if directory is None:
+      try:
+        with open(self._ShardPath(self.generation_, shard), 'rb') as f:
+          size, = _HEADER.unpack(f.read(_HEADER.size))
+          directory = (pickle.loads(f.read(size)), _HEADER.size + size)
+      except (IOError, OSError, EOFError, struct.error,
+              pickle.UnpicklingError):
+        return None
+    self.directories_[shard] = directory
+    while len(self.directories_) > MAX_CACHED_DIRECTORIES:
+      self.directories_.popitem(last=False)
+    return directory
+
+  def _Lookup(self, t):
+    """\
+    Returns a (count, reader) tuple for the posting list of |t|, where reader()
+    returns the list, or None if the list can't be read. Must be called with
+    the lock held.
+    """
+    pending = self.pending_.get(t, ())
+    shard = _Shard(t)
+    if self.generation_ is None or shard not in self.shards_:
+      return len(pending), lambda: array('i', pending)
+    directory = self._Directory(shard)
+    if directory is None:
+      return None
+    entries, directory_size = directory
+    offset, count = entries.get(t, (0, 0))
+    path = self._ShardPath(self.generation_, shard)
+
+    def Read():
+      ids = array('i')
+      if count:
+        try:
+          with open(path, 'rb') as f:
+            f.seek(directory_size + offset)
+            ids = _FromBytes(f.read(count * ITEM_SIZE))
+        except (IOError, OSError):
+          return None
+      ids.extend(pending)
+      return ids
+
+    return count + len(pending), Read
+
+  def _CandidatePaths(self, query):
+    # type: (Query) -> List[str]
+    with self.lock_:
+      postings = []
+      for t in query.trigrams_:
+        posting = self._Lookup(t)
+        if posting is not None:
+          postings.append(posting)
+      postings.sort(key=lambda p: p[0])
+
+      candidates = None
+      for count, Read in postings:
+        if candidates is not None and (
+            not candidates or count > len(candidates) * INTERSECTION_RATIO):
+          break
+        ids = Read()
+        if ids is None:
+          continue
+        if candidates is None:
+          candidates = set(ids)
+        else:
+          candidates.intersection_update(ids)
+
+      if candidates is None:
+        return [p for p in self.paths_ if p is not None]
+      return [
+          self.paths_[i]
+          for i in candidates
+          if i < len(self.paths_) and self.paths_[i] is not None
+      ]
+
+  def _MatchFile(self, query, path, lines_context, max_snippets):
+    try:
+      with open(os.path.join(self.root_, *path.split('/')), 'rb') as f:
+        text = f.read().decode('utf-8', 'replace')
+    except (IOError, OSError):
+      return None
+    text = text.replace('\r\n', '\n')
+    if text.endswith('\n'):
+      text = text[:-1]
+    matches = query.MatchLines(text)
+    if matches is None:
+      return None
+
+    lines = text.split('\n')
+    windows = []
+    for number in sorted(matches):
+      start = max(0, number - lines_context)
+      end = min(len(lines), number + lines_context + 1)
+      if windows and start <= windows[-1][1]:
+        windows[-1][1] = end
+      else:
+        windows.append([start, end])
+
+    return {
+        'top_file': {
+            'file': {
+                'name': path
+            }
+        },
+        'best_matching_line_number': min(matches) + 1 if matches else 1,
+        'num_matches': sum(len(spans) for spans in matches.values()),
+        'has_unshown_matches': len(windows) > max_snippets,
+        'match_reason': {
+            'content': bool(matches),
+            'filename': not query.terms_
+        },
+        'snippet': [
+            _Snippet(lines, start, end, matches)
+            for start, end in windows[:max_snippets]
+        ]
+    }
+
+  def Search(self,
+             query,
+             results_offset=0,
+             max_num_results=100,
+             lines_context=3,
+             max_snippets=DEFAULT_MAX_SNIPPETS):
+    # type: (str, int, int, int, int) -> Dict[str, Any]
+    """\
+    Searches for |query| and returns the matching files, ordered by path, as a
+    dictionary in the shape of a CompoundResponse holding a single
+    SearchResponse. At most |max_num_results| files are returned, skipping the
+    first |results_offset|. Each comes with up to |max_snippets| snippets that
+    include |lines_context| lines around matching lines.
+    """
+    parsed = Query(query)
+    paths = sorted(p for p in self._CandidatePaths(parsed)
+                   if parsed.MatchesPath(p))
+
+    results = []
+    match_count = 0
+    hit_max_results = False
+    estimated_total = 0
+    for index, path in enumerate(paths):
+      result = self._MatchFile(parsed, path, lines_context, max_snippets)
+      if result is None:
+        continue
+      match_count += 1
+      if match_count <= results_offset:
+        continue
+      if len(results) == max_num_results:
+        hit_max_results = True
+        # Candidates that haven't been read yet may or may not match.
+        estimated_total = match_count + len(paths) - index - 1
+        break
+      results.append(result)
+
+    return {
+        'search_response': [{
+            'search_result': results,
+            'results_offset': results_offset,
+            'hit_max_results': hit_max_results,
+            'estimated_total_number_of_results':
+                estimated_total if hit_max_results else match_count,
+            'status': 0
+        }]
+    }
@@ -0,0 +1,76 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+
+# For type checking. Not needed at runtime.
+try:
+  from typing import Any, Callable, Dict, List, Tuple
+except ImportError:
+  pass
+
+
+def _UniqueSignatures(matches):
+  seen = set()
+  signatures = []
+  for _, match in matches:
+    if not match.signature or match.signature in seen:
+      continue
+    seen.add(match.signature)
+    signatures.append(match.signature)
+  return signatures
+
+
+def TraverseXrefs(search, signature, hops):
+  # type: (Callable, str, List[List[Any]]) -> List[Tuple[Any, Any]]
+  """\
+  Walks cross references starting at |signature| one hop at a time and
+  returns a list of (file, match) tuples for every match that was visited.
+
+  |hops| is a list of lists of KytheXrefKind values. The first hop selects
+  the matches for |signature| whose type_id is in |hops[0]|. Each subsequent
+  hop selects matches of the kinds in |hops[n]| for the signatures of the
+  matches that were selected during the preceding hop.
+
+  |search| is invoked once per hop with the list of signatures to look up. It
+  returns a list containing a list of XrefSearchResult objects for each of
+  those signatures. Hence the number of round trips depends on the number of
+  hops and not on the number of matches found along the way.
+  """
+  visited = []
+  seen = set()
+  signatures = [signature]
+  for kinds in hops:
+    if not signatures:
+      break
+
+    matches = []
+    for results in search(signatures):
+      for result in results:
+        for match in result.match:
+          if match.type_id not in kinds:
+            continue
+          key = (result.file.name, match.line_number, match.type_id)
+          if key in seen:
+            continue
+          seen.add(key)
+          matches.append((result.file, match))
+
+    visited.extend(matches)
+    signatures = _UniqueSignatures(matches)
+  return visited
+
+
+def PartitionByKind(results):
+  # type: (List[Any]) -> Dict[Any, List[Tuple[Any, Any]]]
+  """\
+  Groups the matches in the list of XrefSearchResults |results| by their
+  type_id. Returns a dictionary mapping a KytheXrefKind to a list of
+  (file, match) tuples in the order in which they appear in |results|.
+  """
+  partitions = {}
+  for result in results:
+    for match in result.match:
+      partitions.setdefault(match.type_id, []).append((result.file, match))
+  return partitions
@@ -13,6 +13,7 @@ command! CrXrefSearch call crcs#XrefSearch()
 command! CrCallgraph call crcs#Callgraph()
 command! CrLoadCallers call crcs#JumpToCallers()
 command! CrShowSignature call crcs#ShowSignature()
+command! -bang CrStats call crcs#ShowStats(<bang>0)
 
 command! -nargs=1 -complete=customlist,crcs#RefTypeCompleter CrTour call crcs#GoToRef(<q-args>)
 
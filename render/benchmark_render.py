@@ -0,0 +1,460 @@
+# Copyright 2017 The Chromium Authors.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd.
+"""\
+Benchmarks for the renderer.
+
+Replays the recorded responses in vroom/responses and render/testdata, as well
+as synthetic responses that are scaled up from them, through each stage of
+displaying a response:
+
+    coerce  Message.Coerce() of the decoded JSON.
+    render  RenderCompoundResponse().
+    lookup  JumpTargetAt(), SignatureAt() and NodeAt() for every line.
+    markup  CountBlockMarkupOverhead() for every line.
+
+For each response and stage, reports the best of several timings, the peak
+memory allocated while the stage runs, and the memory that's still held by
+the stage's result afterwards, e.g. by the LocationMapper for 'render'. The
+latter two require tracemalloc, i.e. Python 3. Run as:
+
+    python render/benchmark_render.py
+
+Pass --save-baseline=<file> to record the results, and --baseline=<file> on a
+later run to compare against them. Stages that got slower by more than
+--threshold are flagged, and the exit status is non-zero if there are any.
+--scaling runs the older micro-benchmarks which compare lookup strategies and
+check that rendering time grows linearly with the number of format ranges.
+"""
+
+from __future__ import print_function
+
+import argparse
+import copy
+import gc
+import itertools
+import json
+import sys
+import os
+import timeit
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(SCRIPT_DIR)
+
+CODESEARCH_DIR = os.path.join(
+    os.path.dirname(SCRIPT_DIR), 'third_party', 'codesearch-py')
+sys.path.append(CODESEARCH_DIR)
+
+RESPONSES_DIR = os.path.join(os.path.dirname(SCRIPT_DIR), 'vroom', 'responses')
+
+TESTDATA_DIR = os.path.join(SCRIPT_DIR, 'testdata')
+
+import render as r
+import codesearch as cs
+
+
+def LoadRenderableResponses(directory=RESPONSES_DIR):
+  """\
+  Returns a list of (name, CompoundResponse) tuples for every recorded
+  response in |directory| that the renderer knows how to display.
+  """
+  responses = []
+  for name in sorted(os.listdir(directory)):
+    if not name.endswith('.json'):
+      continue
+    with open(os.path.join(directory, name), 'r') as f:
+      d = json.load(f)
+    if not any(k in d for k in ('search_response', 'xref_search_response',
+                                'call_graph_response')):
+      continue
+    responses.append((name, cs.Message.Coerce(d, cs.CompoundResponse)))
+  return responses
+
+
+def LinearNearestPrecedingKey(keys, line):
+  # The lookup strategy used prior to indexing. Kept around for comparison.
+  candidates = [l for l in keys if l <= line]
+  if len(candidates) == 0:
+    return None
+  return max(candidates)
+
+
+def TimeLookups(lookup, keys, line_count, repeat=3):
+  """\
+  Returns the best of |repeat| timings of resolving every line in a buffer of
+  |line_count| lines using |lookup|.
+  """
+
+  def Run():
+    for line in range(line_count):
+      lookup(keys, line)
+
+  return min(timeit.repeat(Run, number=1, repeat=repeat))
+
+
+def BenchmarkRendering(responses, repeat=3):
+  print('{:<48s} {:>6s} {:>12s}'.format('response', 'lines', 'render (ms)'))
+  for name, response in responses:
+    timing = min(
+        timeit.repeat(
+            lambda: r.RenderCompoundResponse(response, 'benchmark'),
+            number=1,
+            repeat=repeat))
+    line_count = len(r.RenderCompoundResponse(response, 'benchmark').Lines())
+    print('{:<48s} {:>6d} {:>12.2f}'.format(name, line_count, timing * 1000))
+
+
+def MakeAnnotatedText(range_count, ranges_per_line):
+  """\
+  Returns an AnnotatedText consisting of |range_count| keywords, each of which
+  is covered by a format range, laid out |ranges_per_line| to a line.
+  """
+  word = 'keyword '
+  line_count = (range_count + ranges_per_line - 1) // ranges_per_line
+  lines = []
+  ranges = []
+  for line in range(line_count):
+    count = min(ranges_per_line, range_count - line * ranges_per_line)
+    lines.append(word * count)
+    for i in range(count):
+      ranges.append({
+          'type': 'SYNTAX_KEYWORD',
+          'range': {
+              'start_line': line + 1,
+              'start_column': i * len(word) + 1,
+              'end_line': line + 1,
+              'end_column': i * len(word) + len(word)
+          }
+      })
+  return cs.Message.Coerce({
+      'text': '\n'.join(lines),
+      'range': ranges
+  }, cs.AnnotatedText)
+
+
+def BenchmarkAnnotatedText(range_counts=(1000, 2000, 4000, 8000, 16000),
+                           repeat=3):
+  print('{:<24s} {:>8s} {:>12s} {:>14s}'.format(
+      'layout', 'ranges', 'render (ms)', 'per range (us)'))
+  for ranges_per_line, layout in [(10, '10 ranges per line'),
+                                  (None, 'single line')]:
+    for range_count in range_counts:
+      text = MakeAnnotatedText(range_count, ranges_per_line or range_count)
+
+      def Run():
+        r.RenderAnnotatedText(r.LocationMapper(), text, 2, 'benchmark.cc')
+
+      timing = min(timeit.repeat(Run, number=1, repeat=repeat))
+      print('{:<24s} {:>8d} {:>12.2f} {:>14.2f}'.format(
+          layout, range_count, timing * 1000, timing * 1e6 / range_count))
+
+
+def BenchmarkLookups(responses):
+  print('{:<48s} {:>6s} {:>8s} {:>12s} {:>12s}'.format(
+      'response', 'lines', 'targets', 'linear (ms)', 'bisect (ms)'))
+  for name, response in responses:
+    mapper = r.RenderCompoundResponse(response, 'benchmark')
+    keys = list(mapper.jump_table_.Lines())
+    line_count = len(mapper.Lines())
+
+    for line in range(line_count):
+      assert r.NearestPrecedingKey(keys, line) == \
+          LinearNearestPrecedingKey(keys, line)
+
+    linear = TimeLookups(LinearNearestPrecedingKey, keys, line_count)
+    indexed = TimeLookups(r.NearestPrecedingKey, keys, line_count)
+    print('{:<48s} {:>6d} {:>8d} {:>12.2f} {:>12.2f}'.format(
+        name, line_count, len(keys), linear * 1000, indexed * 1000))
+
+
+def LoadJson(directory):
+  """\
+  Returns a list of (name, decoded JSON) tuples for every recorded response in
+  |directory|.
+  """
+  payloads = []
+  for name in sorted(os.listdir(directory)):
+    if not name.endswith('.json'):
+      continue
+    with open(os.path.join(directory, name), 'r') as f:
+      payloads.append((name, json.load(f)))
+  return payloads
+
+
+def _LoadTestData(name):
+  with open(os.path.join(TESTDATA_DIR, name), 'r') as f:
+    return json.load(f)
+
+
+def MakeSearchPayload(result_count):
+  """\
+  Returns a search response with |result_count| results in as many files,
+  made by repeating the results in search-response-01.json.
+  """
+  d = _LoadTestData('search-response-01.json')
+  response = d['search_response'][0]
+  templates = response['search_result']
+  results = []
+  for index, template in zip(range(result_count), itertools.cycle(templates)):
+    result = copy.deepcopy(template)
+    name = result['top_file']['file']['name']
+    result['top_file']['file']['name'] = 'src/synthetic/{}/{}'.format(
+        index, name)
+    results.append(result)
+  response['search_result'] = results
+  response['hit_max_results'] = False
+  return d
+
+
+def MakeXrefPayload(match_count, matches_per_file=10):
+  """\
+  Returns an xref search response with |match_count| matches spread over files
+  with |matches_per_file| matches each, made by repeating the matches in
+  xrefs-response-03.json.
+  """
+  d = _LoadTestData('xrefs-response-03.json')
+  response = d['xref_search_response'][0]
+  templates = [
+      m for result in response['search_result'] for m in result['match']
+  ]
+  matches = itertools.cycle(templates)
+  results = []
+  for index in range(0, match_count, matches_per_file):
+    count = min(matches_per_file, match_count - index)
+    result_matches = []
+    for line in range(count):
+      match = copy.deepcopy(next(matches))
+      match['line_number'] = line + 1
+      result_matches.append(match)
+    results.append({
+        'file': {
+            'name': 'src/synthetic/file_{}.cc'.format(index),
+            'package_name': 'chromium'
+        },
+        'match': result_matches
+    })
+  response['search_result'] = results
+  return d
+
+
+def MakeCallGraphPayload(depth, fanout):
+  """\
+  Returns a call graph response whose root has |fanout| callers, each of which
+  has |fanout| callers and so on, |depth| levels deep. The nodes are copies of
+  the callers in call-graph-01.json.
+  """
+  d = _LoadTestData('call-graph-01.json')
+  root = d['call_graph_response'][0]['node']
+  templates = itertools.cycle(root['children'])
+
+  def MakeNodes(level):
+    if level == depth:
+      return []
+    nodes = []
+    for _ in range(fanout):
+      node = copy.deepcopy(next(templates))
+      node['children'] = MakeNodes(level + 1)
+      nodes.append(node)
+    return nodes
+
+  root['children'] = MakeNodes(0)
+  return d
+
+
+def SyntheticPayloads():
+  return [
+      ('synthetic search 1k results', MakeSearchPayload(1000)),
+      ('synthetic search 10k results', MakeSearchPayload(10000)),
+      ('synthetic xrefs 1k matches', MakeXrefPayload(1000)),
+      ('synthetic xrefs 10k matches', MakeXrefPayload(10000)),
+      ('synthetic call graph depth 200', MakeCallGraphPayload(200, 1)),
+      ('synthetic call graph 4^6 nodes', MakeCallGraphPayload(6, 4)),
+  ]
+
+
+def Measure(func, repeat):
+  """\
+  Returns the best of |repeat| timings of |func| in seconds, the peak number
+  of bytes allocated while running it once more, and the number of bytes that
+  remain allocated while its return value is alive. The latter two are None if
+  tracemalloc isn't available.
+  """
+  gc.collect()
+  timing = min(timeit.repeat(func, number=1, repeat=repeat))
+  if tracemalloc is None:
+    return timing, None, None
+  gc.collect()
+  tracemalloc.start()
+  try:
+    result = func()
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    del result
+  finally:
+    tracemalloc.stop()
+  return timing, peak, retained
+
+
+def _Lookup(mapper):
+  line_count = len(mapper.Lines())
+  for line in range(1, line_count + 1):
+    mapper.JumpTargetAt(line, 40)
+    mapper.SignatureAt(line)
+    mapper.NodeAt(line)
+
+
+def _CountMarkup(mapper):
+  for line in mapper.Lines():
+    r.CountBlockMarkupOverhead(line)
+
+
+def BenchmarkStages(name, payload, repeat):
+  """\
+  Returns a list of (name, stage, seconds, peak bytes, retained bytes) tuples
+  for each stage of displaying |payload|. Stages after 'coerce' are skipped
+  if |payload| isn't a response that can be rendered.
+  """
+  results = []
+
+  def Record(stage, func):
+    timing, peak, retained = Measure(func, repeat)
+    results.append((name, stage, timing, peak, retained))
+
+  Record('coerce', lambda: cs.Message.Coerce(payload, cs.CompoundResponse))
+  if not any(k in payload for k in ('search_response', 'xref_search_response',
+                                    'call_graph_response')):
+    return results
+
+  response = cs.Message.Coerce(payload, cs.CompoundResponse)
+  Record('render', lambda: r.RenderCompoundResponse(response, 'benchmark'))
+  mapper = r.RenderCompoundResponse(response, 'benchmark')
+  Record('lookup', lambda: _Lookup(mapper))
+  Record('markup', lambda: _CountMarkup(mapper))
+  return results
+
+
+def _FormatKilobytes(size):
+  if size is None:
+    return '-'
+  return '{:.0f}'.format(size / 1024.0)
+
+
+def _Key(name, stage):
+  return '{}/{}'.format(name, stage)
+
+
+def ReportResults(results, baseline=None, threshold=1.25):
+  """\
+  Prints |results| as returned by BenchmarkStages(), compared against
+  |baseline| if given. |baseline| maps '<name>/<stage>' to a dictionary as
+  written by SaveBaseline(). Returns the list of keys for stages that are
+  slower than |threshold| times their baseline.
+  """
+  print('{:<48s} {:<7s} {:>10s} {:>10s} {:>10s} {:>8s}'.format(
+      'response', 'stage', 'time (ms)', 'peak (KB)', 'kept (KB)', 'vs base'))
+  regressions = []
+  for name, stage, timing, peak, retained in results:
+    key = _Key(name, stage)
+    comparison = ''
+    if baseline and key in baseline:
+      ratio = timing / max(baseline[key]['seconds'], 1e-9)
+      comparison = '{:.2f}x'.format(ratio)
+      if ratio > threshold:
+        comparison += ' !'
+        regressions.append(key)
+    print('{:<48s} {:<7s} {:>10.2f} {:>10s} {:>10s} {:>8s}'.format(
+        name[:48], stage, timing * 1000, _FormatKilobytes(peak),
+        _FormatKilobytes(retained), comparison))
+  return regressions
+
+
+def SaveBaseline(results, path):
+  baseline = {}
+  for name, stage, timing, peak, retained in results:
+    baseline[_Key(name, stage)] = {
+        'seconds': timing,
+        'peak_bytes': peak,
+        'retained_bytes': retained
+    }
+  with open(path, 'w') as f:
+    json.dump(baseline, f, indent=2, sort_keys=True)
+
+
+def LoadBaseline(path):
+  with open(path, 'r') as f:
+    return json.load(f)
+
+
+def Main(argv):
+  parser = argparse.ArgumentParser(
+      description='Benchmarks for the renderer.')
+  parser.add_argument(
+      '--repeat',
+      type=int,
+      default=3,
+      help='number of times each stage is timed. The best time is reported.')
+  parser.add_argument(
+      '--filter',
+      default='',
+      help='only run benchmarks whose name contains this string.')
+  parser.add_argument(
+      '--no-synthetic',
+      action='store_true',
+      help="don't run the benchmarks for synthetic responses.")
+  parser.add_argument(
+      '--baseline', help='compare against the results saved in this file.')
+  parser.add_argument(
+      '--save-baseline', help='save the results to this file.')
+  parser.add_argument(
+      '--threshold',
+      type=float,
+      default=1.25,
+      help='flag stages that take more than this many times as long as their '
+      'baseline.')
+  parser.add_argument(
+      '--scaling',
+      action='store_true',
+      help='also run the lookup and format range micro-benchmarks.')
+  args = parser.parse_args(argv)
+
+  payloads = LoadJson(RESPONSES_DIR) + LoadJson(TESTDATA_DIR)
+  if not args.no_synthetic:
+    payloads += SyntheticPayloads()
+
+  results = []
+  for name, payload in payloads:
+    if args.filter in name:
+      results.extend(BenchmarkStages(name, payload, args.repeat))
+
+  baseline = LoadBaseline(args.baseline) if args.baseline else None
+  regressions = ReportResults(results, baseline, args.threshold)
+  if args.save_baseline:
+    SaveBaseline(results, args.save_baseline)
+
+  if args.scaling:
+    print()
+    BenchmarkLookups(LoadRenderableResponses())
+    print()
+    BenchmarkRendering(LoadRenderableResponses(TESTDATA_DIR))
+    print()
+    BenchmarkAnnotatedText()
+
+  if regressions:
+    print()
+    print('{} stage(s) slower than {:.2f}x the baseline:'.format(
+        len(regressions), args.threshold))
+    for key in regressions:
+      print('  ' + key)
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(Main(sys.argv[1:]))
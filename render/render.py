@@ -4,16 +4,18 @@
 # license that can be found in the LICENSE file or at
 # https://developers.google.com/open-source/licenses/bsd.
 
+import bisect
 import os
 import sys
 import re
+from array import array
 from contextlib import contextmanager
 
 import codesearch as cs
 
 # For type checking. Not needed at runtime.
 try:
-  from typing import Any, Optional, List, Dict, Union, Type, Tuple
+  from typing import Any, Optional, List, Dict, Union, Type, Tuple, Sequence
 except ImportError:
   pass
 
@@ -22,6 +24,36 @@ SNIPPET_INDENT = 4
 TAG_START_FORMAT = '^{:s}{{'
 TAG_END_FORMAT = '}}{:s}_'
 
+# If True, LocationMapper records the extents of tagged blocks as highlight
+# spans. See EnableHighlightSpans().
+HIGHLIGHT_SPANS = False
+
+# Highlight group for each type of tagged block when rendering highlight
+# spans. Blocks that only give structure to the output don't have one.
+HIGHLIGHT_GROUPS = {
+    'k': 'csKeyword',
+    's': 'csString',
+    'c': 'csComment',
+    '0': 'csNumber',
+    'D': 'csMacro',
+    'C': 'csClass',
+    'K': 'csConst',
+    '\\': 'csEscape',
+    '-': 'csDeprecatd',
+    '$': 'csQueryMatch',
+    'q': 'csQuery',
+    'Cat': 'csCategory',
+    'F': 'csFilename',
+    'S': 'csSymbol',
+}
+
+# Rough per item memory overhead in bytes, used by
+# LocationMapper.EstimateSize(). Measured with tracemalloc on the synthetic
+# payloads in benchmark_render.py.
+LINE_OVERHEAD_ESTIMATE = 80
+MARKUP_OVERHEAD_ESTIMATE = 250
+NODE_SIZE_ESTIMATE = 1000
+
 
 def StartTag(s):
   assert isinstance(s, str)
@@ -68,57 +100,576 @@ def TaggedBlock(mapper, block_type):
      with TaggedBlock(mapper, 'x'):
         mapper.write(...)
   '''
-  mapper.write(StartTag(block_type))
+  mapper.StartBlock(block_type)
   yield
-  mapper.write(EndTag(block_type))
+  mapper.EndBlock(block_type)
+
+
+def NearestPrecedingKey(keys, line):
+  # type: (List[int], int) -> Optional[int]
+  """\
+  Return the largest element of the sorted list |keys| that is less than or
+  equal to |line|, or None if there's no such element.
+
+  >>> NearestPrecedingKey([1, 4, 9], 5)
+  4
+  >>> NearestPrecedingKey([1, 4, 9], 4)
+  4
+  >>> NearestPrecedingKey([1, 4, 9], 0) is None
+  True
+  """
+  index = bisect.bisect_right(keys, line)
+  if index == 0:
+    return None
+  return keys[index - 1]
+
+
+def _MarkupEntries(markup):
+  """\
+  Yield (end, length) tuples for the tags described by a |markup_map_| entry.
+  """
+  ends, totals = markup
+  previous = 0
+  for end, total in zip(ends, totals):
+    yield end, total - previous
+    previous = total
+
+
+def _AppendMarkup(markup_map, line, end, length):
+  ends, totals = markup_map.setdefault(line, ([], []))
+  ends.append(end)
+  totals.append(length + (totals[-1] if totals else 0))
+
+
+def _SpliceLineMap(line_map, keys, start_line, end_line, delta, other_map,
+                   other_keys, first_line_fn, last_line_fn):
+  """\
+  Helper for LocationMapper.Splice(). Replaces the entries for lines
+  |start_line| through |end_line| - 1 in |line_map| with those from
+  |other_map| and shifts the rest by |delta| lines. |keys| and |other_keys|
+  are the sorted keys of the respective maps. |keys| is updated in place.
+
+  |first_line_fn| is applied to the value for the first line of |other_map|,
+  and |last_line_fn| to the value for |end_line|.
+  """
+  head = bisect.bisect_left(keys, start_line)
+  tail = bisect.bisect_left(keys, end_line)
+  tail_items = [(k, line_map.pop(k)) for k in keys[tail:]]
+  for k in keys[head:tail]:
+    del line_map[k]
+
+  new_keys = keys[:head]
+  for k in other_keys:
+    value = other_map[k]
+    if k == 0:
+      value = first_line_fn(value)
+    line_map[k + start_line] = value
+    new_keys.append(k + start_line)
+
+  for k, value in tail_items:
+    if k == end_line:
+      value = last_line_fn(value)
+    k += delta
+    # Metadata that's retained from the last line wins.
+    if new_keys and new_keys[-1] == k:
+      new_keys.pop()
+    line_map[k] = value
+    new_keys.append(k)
+
+  keys[:] = new_keys
+
+
+class StringTable(object):
+  """\
+  Assigns a small integer to each distinct string so that metadata which
+  repeats the same file name or signature on many lines only stores the
+  string once.
+
+  Strings are never removed. A table belongs to a single LocationMapper, so
+  it doesn't outlive the results that it was built for.
+  """
+
+  def __init__(self):
+    self.strings_ = []
+    self.ids_ = {}
+
+  def Intern(self, s):
+    # type: (Any) -> int
+    string_id = self.ids_.get(s)
+    if string_id is None:
+      string_id = self.ids_[s] = len(self.strings_)
+      self.strings_.append(s)
+    return string_id
+
+  def Get(self, string_id):
+    # type: (int) -> Any
+    return self.strings_[string_id]
+
+  def Ids(self, other):
+    # type: (StringTable) -> List[int]
+    """\
+    Returns a list that maps each id in |other| to the id of the same string
+    in this table, interning strings as needed.
+    """
+    return [self.Intern(s) for s in other.strings_]
+
+
+class LineTable(object):
+  """\
+  Maps line numbers to tuples of |width| integers, for lines that have
+  metadata associated with them. Lines are kept in one array and the values
+  in another, |width| entries per line, instead of as a dictionary of tuples.
+
+  Lines are only ever added in increasing order while rendering. Setting the
+  value for the last line again replaces it.
+  """
+
+  def __init__(self, width):
+    self.width_ = width
+    self.lines_ = array('i')
+    self.values_ = array('i')
+
+  def __len__(self):
+    return len(self.lines_)
+
+  def Set(self, line, values):
+    # type: (int, Tuple[int, ...]) -> None
+    assert len(values) == self.width_
+    if self.lines_ and self.lines_[-1] == line:
+      self.values_[-self.width_:] = array('i', values)
+      return
+    assert not self.lines_ or self.lines_[-1] < line
+    self.lines_.append(line)
+    self.values_.extend(values)
+
+  def Lines(self):
+    # type: () -> array
+    """\
+    Returns the lines that have values, in increasing order.
+    """
+    return self.lines_
+
+  def Lookup(self, line):
+    # type: (int) -> Optional[Tuple[int, Sequence[int]]]
+    """\
+    Returns a (line, values) tuple for the largest line that is less than or
+    equal to |line|, or None.
+    """
+    index = bisect.bisect_right(self.lines_, line) - 1
+    if index < 0:
+      return None
+    offset = index * self.width_
+    return self.lines_[index], self.values_[offset:offset + self.width_]
+
+  def Items(self):
+    width = self.width_
+    for index, line in enumerate(self.lines_):
+      yield line, tuple(self.values_[index * width:(index + 1) * width])
+
+  def Splice(self, start_line, end_line, delta, other, new_value_fn,
+             first_line_fn, last_line_fn):
+    """\
+    Same as _SpliceLineMap(), but for LineTables. |new_value_fn| is applied to
+    every value taken from |other| before |first_line_fn|.
+    """
+    head = bisect.bisect_left(self.lines_, start_line)
+    tail = bisect.bisect_left(self.lines_, end_line)
+    width = self.width_
+    old_items = list(self.Items())
+
+    items = old_items[:head]
+    for line, values in other.Items():
+      values = new_value_fn(values)
+      if line == 0:
+        values = first_line_fn(values)
+      items.append((line + start_line, values))
+
+    for line, values in old_items[tail:]:
+      if line == end_line:
+        values = last_line_fn(values)
+      line += delta
+      # Metadata that's retained from the last line wins.
+      if items and items[-1][0] == line:
+        items.pop()
+      items.append((line, values))
+
+    self.lines_ = array('i', [line for line, _ in items])
+    self.values_ = array('i')
+    for _, values in items:
+      assert len(values) == width
+      self.values_.extend(values)
+
+
+class RenderedNode(object):
+  """\
+  Describes where a call graph node was rendered. |start| and |end| are the
+  (line, column) positions of the start and the end of the node's block
+  including its descendants, counting from 0.
+  """
+
+  def __init__(self, node, level, start, end):
+    self.node = node
+    self.level = level
+    self.start = start
+    self.end = end
+
+
+class SearchContinuation(object):
+  """\
+  Describes how to fetch the rest of a truncated list of search results, and
+  where they go. |position| is the (line, column) position of the truncation
+  notice, |query| is the search query, and |results_offset| is the offset of
+  the first result that hasn't been rendered.
+  """
+
+  def __init__(self, position, query, results_offset):
+    self.position = position
+    self.query = query
+    self.results_offset = results_offset
 
 
 class LocationMapper(object):
 
   def __init__(self):
-    self.jump_map_ = {}
-    self.signature_map_ = {}
+    # File names and signatures referred to by |jump_table_| and
+    # |signature_table_|.
+    self.strings_ = StringTable()
+
+    # Maps a line to the jump target for text following a column on that
+    # line, as a (file name id, target line, column) tuple. The target line
+    # counts from 0.
+    self.jump_table_ = LineTable(3)
+
+    # Maps a line to the id of the signature of the symbol on that line.
+    self.signature_table_ = LineTable(1)
+
     self.lines_ = ['']
 
+    # The line that's currently being written, i.e. the last line, as a list
+    # of fragments that are joined once the line is complete. The last
+    # element of |lines_| is only brought up to date when the line is
+    # complete or via Lines(). |column_| is the length of the current line.
+    self.fragments_ = []
+    self.column_ = 0
+
+    # Lines at which the results for each file start, in order. Populated via
+    # StartFileSection() as the renderer emits each file heading.
+    self.file_lines_ = []
+
+    # Maps a line to a pair of lists describing the markup on that line. The
+    # first list contains the column at which each tag ends, in order. The
+    # second contains the total length of markup up to and including the
+    # corresponding tag. Used for mapping columns in the rendered output to
+    # columns in the source without having to parse the markup.
+    self.markup_map_ = {}
+
+    # Maps id() of each call graph node to its RenderedNode.
+    self.rendered_nodes_ = {}
+
+    # Maps the line on which each call graph node starts to the node, and a
+    # sorted list of said lines.
+    self.node_map_ = {}
+    self.node_lines_ = []
+
+    # Maps a signature to the set of id()s of rendered call graph nodes with
+    # that signature. The same signature can appear more than once in a call
+    # graph, e.g. due to recursion.
+    self.signature_nodes_ = {}
+
+    # List of (start, end, group) tuples, one for each highlighted span of
+    # text. |start| and |end| are (line, column) positions counting from 0.
+    # |end| is exclusive. None unless HIGHLIGHT_SPANS is set.
+    self.highlight_spans_ = [] if HIGHLIGHT_SPANS else None
+
+    # Maps a block type to the list of start positions of currently open
+    # blocks of that type. Only used when recording highlight spans.
+    self.open_blocks_ = {}
+
+    # SearchContinuation for truncated search results. None if all results
+    # have been rendered.
+    self.continuation_ = None
+
+  def StartFileSection(self):
+    current_line = len(self.lines_) - 1
+    if not self.file_lines_ or self.file_lines_[-1] != current_line:
+      self.file_lines_.append(current_line)
+
   def SetSignatureForLine(self, sig):
     current_line = len(self.lines_) - 1
-    self.signature_map_[current_line] = sig
+    self.signature_table_.Set(current_line, (self.strings_.Intern(sig),))
+
+  def SetNodeForLine(self, node):
+    current_line = len(self.lines_) - 1
+    if current_line not in self.node_map_:
+      self.node_lines_.append(current_line)
+    self.node_map_[current_line] = node
 
   def SetTargetForPos(self, fn, line):
     assert line > 0
     current_line = len(self.lines_) - 1
-    self.jump_map_[current_line] = (fn, line - 1, self.column())
+    self.jump_table_.Set(current_line,
+                         (self.strings_.Intern(fn), line - 1, self.column()))
 
   def column(self):
-    return len(self.lines_[-1])
+    return self.column_
+
+  def _EndLine(self):
+    self.lines_[-1] = ''.join(self.fragments_)
+    self.fragments_ = []
+    self.column_ = 0
 
   def write(self, s):
     assert isinstance(s, str)
+    if '\n' not in s:
+      if s:
+        self.fragments_.append(s)
+        self.column_ += len(s)
+      return
+
     lines = s.split('\n')
-    self.lines_[-1] += lines[0]
+    self.fragments_.append(lines[0])
+    self._EndLine()
     self.lines_.extend(lines[1:])
+    self.lines_[-1] = ''
+    self.write(lines[-1])
+
+  def WriteMarkup(self, s):
+    """\
+    Write |s| which consists solely of markup. I.e. none of the characters in
+    |s| correspond to characters in the source.
+    """
+    assert isinstance(s, str)
+    assert '\n' not in s
+    if not s:
+      return
+    current_line = len(self.lines_) - 1
+    self.write(s)
+    _AppendMarkup(self.markup_map_, current_line, self.column(), len(s))
+
+  def StartBlock(self, block_type):
+    self.WriteMarkup(StartTag(block_type))
+    if self.highlight_spans_ is not None:
+      self.open_blocks_.setdefault(block_type, []).append(self.Position())
+
+  def EndBlock(self, block_type):
+    self.WriteMarkup(EndTag(block_type))
+    if self.highlight_spans_ is not None and self.open_blocks_.get(block_type):
+      start = self.open_blocks_[block_type].pop()
+      self.AddHighlightSpan(start, self.Position(),
+                            HIGHLIGHT_GROUPS.get(block_type))
+
+  def AddHighlightSpan(self, start, end, group):
+    # type: (Tuple[int, int], Tuple[int, int], Optional[str]) -> None
+    if self.highlight_spans_ is None or group is None or start == end:
+      return
+    self.highlight_spans_.append((start, end, group))
+
+  def HighlightSpans(self, first_line=0, last_line=None):
+    # type: (int, Optional[int]) -> List[Tuple[Tuple[int, int], Tuple[int, int], str]]
+    """\
+    Return the highlight spans that start on lines |first_line| through
+    |last_line|. All spans are returned if no range is given.
+    """
+    spans = self.highlight_spans_ or []
+    if first_line == 0 and last_line is None:
+      return spans
+    return [(start, end, group)
+            for start, end, group in spans
+            if first_line <= start[0] and
+            (last_line is None or start[0] <= last_line)]
+
+  def MarkupLengthBefore(self, line, column):
+    # type: (int, int) -> int
+    """\
+    Return the number of characters of markup on |line| that precede
+    |column|. Tags that extend past |column| are not counted. Both |line| and
+    |column| are counting from 0.
+    """
+    if line not in self.markup_map_:
+      return 0
+    ends, totals = self.markup_map_[line]
+    index = bisect.bisect_right(ends, column)
+    if index == 0:
+      return 0
+    return totals[index - 1]
 
   def newline(self):
-    self.lines_.extend([''])
+    self._EndLine()
+    self.lines_.append('')
+
+  def Position(self):
+    # type: () -> Tuple[int, int]
+    return (len(self.lines_) - 1, self.column())
 
   def Lines(self):
+    if len(self.fragments_) != 1 or self.fragments_[0] is not self.lines_[-1]:
+      self.lines_[-1] = ''.join(self.fragments_)
+      self.fragments_ = [self.lines_[-1]]
     return self.lines_
 
+  def AddRenderedNode(self, node, level, start, end):
+    """\
+    Record that |node| was rendered at |level| between |start| and |end|. See
+    RenderedNode.
+    """
+    self.rendered_nodes_[id(node)] = RenderedNode(node, level, start, end)
+    self.signature_nodes_.setdefault(node.signature, set()).add(id(node))
+
+  def _ForgetRenderedNode(self, key):
+    rendered = self.rendered_nodes_.pop(key)
+    ids = self.signature_nodes_[rendered.node.signature]
+    ids.discard(key)
+    if not ids:
+      del self.signature_nodes_[rendered.node.signature]
+
+  def GetRenderedNode(self, node):
+    # type: (Any) -> Optional[RenderedNode]
+    return self.rendered_nodes_.get(id(node), None)
+
+  def NodeAt(self, line):
+    """\
+    Return the call graph node that's rendered at |line|, or None. Lines are
+    counting from 1.
+    """
+    assert line > 0
+    line = NearestPrecedingKey(self.node_lines_, line - 1)
+    if line is None:
+      return None
+    return self.node_map_[line]
+
+  def NodesForSignature(self, signature):
+    """\
+    Return the list of rendered call graph nodes with |signature|.
+    """
+    return [
+        self.rendered_nodes_[key].node
+        for key in self.signature_nodes_.get(signature, [])
+    ]
+
+  def Splice(self, start, end, other):
+    # type: (Tuple[int, int], Tuple[int, int], LocationMapper) -> None
+    """\
+    Replace the text between the positions |start| and |end| with the contents
+    of |other|, and shift the metadata for everything that follows. Positions
+    are (line, column) tuples counting from 0.
+
+    |start| and |end| must be on different lines. Jump targets, signatures and
+    file sections on the line containing |start| are taken from |other| while
+    those on the line containing |end| are retained. I.e. neither the text
+    preceding |start| nor the replaced text preceding |end| on their
+    respective lines may set any of these. Call graph nodes meet this
+    requirement since their blocks start and end at lines containing only
+    markup up to that point.
+    """
+    start_line, start_column = start
+    end_line, end_column = end
+    assert start_line < end_line
+
+    new_lines = list(other.Lines())
+    new_last_line = len(new_lines) - 1
+    delta = new_last_line - (end_line - start_line)
+    last_column_shift = len(new_lines[-1]) - end_column
+    if new_last_line == 0:
+      last_column_shift += start_column
+
+    lines = self.Lines()
+    new_lines[0] = lines[start_line][:start_column] + new_lines[0]
+    new_lines[-1] = new_lines[-1] + lines[end_line][end_column:]
+    lines[start_line:end_line + 1] = new_lines
+    self.fragments_ = [lines[-1]]
+    self.column_ = len(lines[-1])
+
+    def ShiftOld(position):
+      if position < end:
+        return position
+      line, column = position
+      if line == end_line:
+        return (start_line + new_last_line, column + last_column_shift)
+      return (line + delta, column)
+
+    def ShiftNew(position):
+      line, column = position
+      if line == 0:
+        column += start_column
+      return (start_line + line, column)
+
+    ids = self.strings_.Ids(other.strings_)
+    self.jump_table_.Splice(start_line, end_line, delta, other.jump_table_,
+                            lambda v: (ids[v[0]], v[1], v[2]),
+                            lambda v: (v[0], v[1], v[2] + start_column),
+                            lambda v: (v[0], v[1], v[2] + last_column_shift))
+    self.signature_table_.Splice(start_line, end_line, delta,
+                                 other.signature_table_,
+                                 lambda v: (ids[v[0]],), lambda v: v,
+                                 lambda v: v)
+    _SpliceLineMap(self.node_map_, self.node_lines_, start_line, end_line,
+                   delta, other.node_map_, other.node_lines_, lambda v: v,
+                   lambda v: v)
+
+    file_map = dict((l, None) for l in self.file_lines_)
+    _SpliceLineMap(file_map, self.file_lines_, start_line, end_line, delta,
+                   dict((l, None) for l in other.file_lines_),
+                   other.file_lines_, lambda v: v, lambda v: v)
+
+    prefix = [(e, n)
+              for e, n in _MarkupEntries(
+                  self.markup_map_.get(start_line, ([], [])))
+              if e <= start_column]
+    suffix = [(e + last_column_shift, n)
+              for e, n in _MarkupEntries(
+                  self.markup_map_.get(end_line, ([], [])))
+              if e > end_column]
+    tail = [(l, self.markup_map_.pop(l))
+            for l in list(self.markup_map_.keys())
+            if l >= start_line]
+    for l, markup in tail:
+      if l > end_line:
+        self.markup_map_[l + delta] = markup
+    for e, n in prefix:
+      _AppendMarkup(self.markup_map_, start_line, e, n)
+    for l in sorted(other.markup_map_.keys()):
+      for e, n in _MarkupEntries(other.markup_map_[l]):
+        _AppendMarkup(self.markup_map_, start_line + l,
+                      e + (start_column if l == 0 else 0), n)
+    for e, n in suffix:
+      _AppendMarkup(self.markup_map_, start_line + new_last_line, e, n)
+
+    for key in list(self.rendered_nodes_.keys()):
+      rendered = self.rendered_nodes_[key]
+      if start <= rendered.start < end:
+        self._ForgetRenderedNode(key)
+        continue
+      rendered.start = ShiftOld(rendered.start)
+      rendered.end = ShiftOld(rendered.end)
+    for key, rendered in other.rendered_nodes_.items():
+      self.rendered_nodes_[key] = RenderedNode(rendered.node, rendered.level,
+                                               ShiftNew(rendered.start),
+                                               ShiftNew(rendered.end))
+      self.signature_nodes_.setdefault(rendered.node.signature,
+                                       set()).add(key)
+
+    if self.highlight_spans_ is not None:
+      spans = [(ShiftOld(s), ShiftOld(e), group)
+               for s, e, group in self.highlight_spans_
+               if not (start <= s and e <= end)]
+      spans.extend((ShiftNew(s), ShiftNew(e), group)
+                   for s, e, group in other.HighlightSpans())
+      self.highlight_spans_ = spans
+
   def JumpTargetAt(self, line, column):
     # line and column are counting from 1
     assert line > 0
     assert column > 0
     line -= 1
     column -= 1
-    if line not in self.jump_map_:
-      candidates = [l for l in self.jump_map_.keys() if l < line]
-      if len(candidates) == 0:
-        return None
-      line = max(candidates)
-    filename, target_line, offset_column = self.jump_map_[line]
+    entry = self.jump_table_.Lookup(line)
+    if entry is None:
+      return None
+    line, (filename_id, target_line, offset_column) = entry
+    filename = self.strings_.Get(filename_id)
     if offset_column < column:
-      overhead = CountBlockMarkupOverhead(
-          self.lines_[line][offset_column:column])
+      overhead = self.MarkupLengthBefore(line, column) - \
+          self.MarkupLengthBefore(line, offset_column)
       target_column = column - offset_column - overhead
       assert target_column >= 0
     else:
@@ -126,46 +677,103 @@ class LocationMapper(object):
     return (filename, target_line + 1, target_column + 1)
 
   def PreviousFileLocation(self, line):
-    current_file, _, _ = self.jump_map_.get(line, ('', 0, 0))
-
-    line -= 2
-    while line >= 1:
-      f, _, _ = self.jump_map_.get(line, ('', 0, 0))
-      if f and f != current_file:
-        new_file = f
-        break
-      line -= 1
-
-    old_line = line
-    line -= 1
-    while line >= 1:
-      f, _, _ = self.jump_map_.get(line, ('', 0, 0))
-      if f != new_file:
-        return old_line + 1
-      old_line = line
-      line -= 1
-    return 1
+    # type: (int) -> int
+    """\
+    Return the line at which the results for the file containing |line|
+    start. If |line| is already at the start, return the start of the
+    preceding file instead. Lines are counting from 1.
+    """
+    index = bisect.bisect_left(self.file_lines_, line - 1)
+    if index == 0:
+      return 1
+    return self.file_lines_[index - 1] + 1
 
   def NextFileLocation(self, line):
-    original_line = line
-    current_file, _, _ = self.jump_map_.get(line, ('', 0, 0))
-    while line <= len(self.lines_):
-      f, _, _ = self.jump_map_.get(line, ('', 0, 0))
-      if f and f != current_file:
-        return line + 1
-      line += 1
-    return original_line
+    # type: (int) -> int
+    """\
+    Return the line at which the results for the file following the one
+    containing |line| start, or |line| if there's no such file. Lines are
+    counting from 1.
+    """
+    index = bisect.bisect_right(self.file_lines_, line - 1)
+    if index == len(self.file_lines_):
+      return line
+    return self.file_lines_[index] + 1
+
+  def FileCount(self):
+    return len(self.file_lines_)
+
+  def EstimateSize(self):
+    # type: () -> int
+    """\
+    Returns a rough estimate of the number of bytes held by this mapper,
+    including the call graph nodes and xref matches that it refers to.
+    """
+    size = sum(len(line) for line in self.lines_)
+    size += len(self.lines_) * LINE_OVERHEAD_ESTIMATE
+    size += len(self.markup_map_) * MARKUP_OVERHEAD_ESTIMATE
+    for table in (self.jump_table_, self.signature_table_):
+      size += (len(table.lines_) + len(table.values_)) * table.lines_.itemsize
+    size += sum(len(s) for s in self.strings_.strings_)
+    for node in self.node_map_.values():
+      size += NODE_SIZE_ESTIMATE
+      size += len(getattr(node, 'matches', None) or []) * NODE_SIZE_ESTIMATE
+    return size
+
+  def __getstate__(self):
+    # Rendered nodes are keyed by id(), which doesn't survive pickling. They
+    # are keyed afresh by __setstate__().
+    state = self.__dict__.copy()
+    state['rendered_nodes_'] = list(self.rendered_nodes_.values())
+    del state['signature_nodes_']
+    return state
+
+  def __setstate__(self, state):
+    rendered_nodes = state.pop('rendered_nodes_')
+    self.__dict__.update(state)
+    self.rendered_nodes_ = {}
+    self.signature_nodes_ = {}
+    for rendered in rendered_nodes:
+      node = rendered.node
+      self.rendered_nodes_[id(node)] = rendered
+      self.signature_nodes_.setdefault(node.signature, set()).add(id(node))
+
+  def NthFileLocation(self, n):
+    # type: (int) -> Optional[int]
+    """\
+    Return the line at which the results for the |n|th file start, or None if
+    there aren't that many files. Both |n| and the returned line are counting
+    from 1.
+    """
+    if n < 1 or n > len(self.file_lines_):
+      return None
+    return self.file_lines_[n - 1] + 1
 
   def SignatureAt(self, line):
     assert line > 0
-    line -= 1
-    if line not in self.signature_map_:
-      candidates = [l for l in self.signature_map_.keys() if l < line]
-      if len(candidates) == 0:
-        return None
-
-      line = max(candidates)
-    return self.signature_map_[line]
+    entry = self.signature_table_.Lookup(line - 1)
+    if entry is None:
+      return None
+    return self.strings_.Get(entry[1][0])
+
+  def JumpMap(self):
+    # type: () -> Dict[int, Tuple[Any, int, int]]
+    """\
+    Returns a dictionary mapping each line with a jump target to a (filename,
+    target line, column) tuple. Lines are counting from 0. Meant for tests and
+    debugging.
+    """
+    return dict((line, (self.strings_.Get(v[0]), v[1], v[2]))
+                for line, v in self.jump_table_.Items())
+
+  def SignatureMap(self):
+    # type: () -> Dict[int, Any]
+    """\
+    Returns a dictionary mapping each line with a signature to the signature.
+    Lines are counting from 0. Meant for tests and debugging.
+    """
+    return dict((line, self.strings_.Get(v[0]))
+                for line, v in self.signature_table_.Items())
 
 
 def GetBlockTypeFromFormatType(r):
@@ -195,37 +803,48 @@ def RenderAnnotatedText(mapper,
   # Max number of digits it takes to represent the line number
   line_number_width = len(str(first_line_number + len(text_lines) - 1))
 
-  insertions = []
+  # Tags to insert into each line as a list of (column, sequence, is_start,
+  # block_type) tuples. |sequence| orders tags that are inserted at the same
+  # column. Later tags go first so that a range ending at a column is closed
+  # after any range that starts at that column is opened.
+  insertions = [[] for _ in text_lines]
 
   for r in annotated_text.range:
     block_type = GetBlockTypeFromFormatType(r.type)
     if block_type is None:
       continue
-    if r.range.end_column == 1 and r.range.start_line != r.range.end_line:
-      r.range.end_line -= 1
-      r.range.end_column = len(text_lines[r.range.end_line - 1]) + 1
-    insertions.append(
-        (r.range.end_line, r.range.end_column, EndTag(block_type)))
-    insertions.append(
-        (r.range.start_line, r.range.start_column, StartTag(block_type)))
-
-  insertions.sort(lambda i1, i2: i2[0] - i1[0]
-                  if i2[0] != i1[0] else i2[1] - i1[1])
-
-  for line, column, tag in insertions:
-    assert line > 0
-    assert column > 0
-    line -= 1
-    column -= 1
-    text = text_lines[line]
-    text_lines[line] = text[:column] + tag + text[column:]
+    end_line = r.range.end_line
+    end_column = r.range.end_column
+    if end_column == 1 and r.range.start_line != end_line:
+      end_line -= 1
+      end_column = len(text_lines[end_line - 1]) + 1
+    for line, column, is_start in [(end_line, end_column, False),
+                                   (r.range.start_line, r.range.start_column,
+                                    True)]:
+      assert line > 0
+      assert column > 0
+      line_insertions = insertions[line - 1]
+      line_insertions.append((column - 1, -len(line_insertions), is_start,
+                              block_type))
 
   for index, text in enumerate(text_lines):
     mapper.newline()
     mapper.write(' ' * indent)
-    mapper.write('{:{}d} '.format(index + first_line_number, line_number_width))
+    start = mapper.Position()
+    mapper.write('{:{}d}'.format(index + first_line_number, line_number_width))
+    mapper.AddHighlightSpan(start, mapper.Position(), 'csLineNum')
+    mapper.write(' ')
     mapper.SetTargetForPos(filename, index + first_line_number)
-    mapper.write(text)
+
+    last_column = 0
+    for column, _, is_start, block_type in sorted(insertions[index]):
+      mapper.write(text[last_column:column])
+      if is_start:
+        mapper.StartBlock(block_type)
+      else:
+        mapper.EndBlock(block_type)
+      last_column = column
+    mapper.write(text[last_column:])
 
 
 def RenderSnippet(mapper,
@@ -246,6 +865,7 @@ def RenderSnippet(mapper,
 
 def RenderSearchResult(mapper, index, search_result):
   filename = search_result.top_file.file.name
+  mapper.StartFileSection()
   mapper.SetTargetForPos(filename, 1)
   mapper.write('{}. {}'.format(index + 1, filename))
   for s_index, snippet in enumerate(search_result.snippet):
@@ -254,6 +874,56 @@ def RenderSearchResult(mapper, index, search_result):
   mapper.newline()
 
 
+def _RenderSearchResults(mapper, query, search_response):
+  for index, result in enumerate(search_response.search_result):
+    RenderSearchResult(mapper, index + search_response.results_offset, result)
+    mapper.newline()
+
+  if search_response.hit_max_results:
+    result_count = search_response.results_offset + len(
+        search_response.search_result)
+    mapper.continuation_ = SearchContinuation(mapper.Position(), query,
+                                              result_count)
+    mapper.write(
+        'Search results are truncated. Showing {} results out of an estimated {}.'
+        .format(result_count,
+                search_response.estimated_total_number_of_results))
+    mapper.newline()
+
+
+def RenderSearchResponsePage(query, search_response):
+  """\
+  Renders the results in |search_response|, which is a subsequent page of
+  results for |query|. The returned LocationMapper is meant to be passed to
+  AppendSearchResponsePage().
+  """
+  assert isinstance(search_response, cs.SearchResponse)
+  mapper = LocationMapper()
+  _RenderSearchResults(mapper, query, search_response)
+  return mapper
+
+
+def AppendSearchResponsePage(mapper, page):
+  # type: (LocationMapper, LocationMapper) -> int
+  """\
+  Replaces the truncation notice at the end of the search results in |mapper|
+  with the page of results in |page|. Returns the first line, counting from 0,
+  that changed. Earlier lines, and their metadata, are left untouched.
+  """
+  assert mapper.continuation_ is not None
+  start = mapper.continuation_.position
+  mapper.continuation_ = None
+  if page.continuation_ is not None:
+    line, column = page.continuation_.position
+    if line == 0:
+      column += start[1]
+    mapper.continuation_ = SearchContinuation(
+        (start[0] + line, column), page.continuation_.query,
+        page.continuation_.results_offset)
+  mapper.Splice(start, mapper.Position(), page)
+  return start[0]
+
+
 def RenderSearchResponse(mapper, query, search_response):
   assert isinstance(search_response, cs.SearchResponse)
 
@@ -264,17 +934,7 @@ def RenderSearchResponse(mapper, query, search_response):
     mapper.newline()
     mapper.newline()
 
-    for index, result in enumerate(search_response.search_result):
-      RenderSearchResult(mapper, index + search_response.results_offset, result)
-      mapper.newline()
-
-    if search_response.hit_max_results:
-      mapper.write(
-          'Search results are truncated. Showing {} results out of an estimated {}.'
-          .format(
-              len(search_response.search_result),
-              search_response.estimated_total_number_of_results))
-      mapper.newline()
+    _RenderSearchResults(mapper, query, search_response)
   else:
     mapper.write('No results for query ')
     with TaggedBlock(mapper, 'q'):
@@ -291,12 +951,7 @@ def RenderSearchResponse(mapper, query, search_response):
 
 def RenderXrefResults(mapper, results):
 
-  def XrefResultSorter(r1, r2):
-    if r1[0].name == r2[0].name:
-      return cmp(r1[1].line_number, r2[1].line_number)
-    return cmp(r1[0].name, r2[0].name)
-
-  results.sort(cmp=XrefResultSorter)
+  results.sort(key=lambda r: (r[0].name, r[1].line_number))
 
   last_fn = None
   for result in results:
@@ -306,6 +961,7 @@ def RenderXrefResults(mapper, results):
         mapper.newline()
       last_fn = fn.name
       mapper.write(' ' * 2)
+      mapper.StartFileSection()
       mapper.SetTargetForPos(fn.name, 1)
       with TaggedBlock(mapper, 'F'):
         mapper.write(fn.name)
@@ -318,87 +974,242 @@ def RenderXrefResults(mapper, results):
     mapper.newline()
 
 
+def _XrefCategoryNames():
+  # In display order. Matches of any other kind are grouped under
+  # 'References', which is keyed by 0.
+  return [
+      (cs.KytheXrefKind.DEFINITION, 'Definition'),
+      (cs.KytheXrefKind.DECLARATION, 'Declaration'),
+      (cs.KytheXrefKind.CALLED_BY, 'Called by'),
+      (cs.KytheXrefKind.INSTANTIATION, 'Instantiations'),
+      (cs.KytheXrefKind.OVERRIDDEN_BY, 'Overridden by'),
+      (cs.KytheXrefKind.OVERRIDES, 'Overrides'),
+      (cs.KytheXrefKind.EXTENDED_BY, 'Extended by'),
+      (cs.KytheXrefKind.EXTENDS, 'Extends'),
+      (cs.KytheXrefKind.GENERATES, 'Generates'),
+      (cs.KytheXrefKind.GENERATED_BY, 'Generated by'),
+      (cs.KytheXrefKind.ANNOTATES, 'Annotates'),
+      (cs.KytheXrefKind.ANNOTATED_BY, 'Annotated by'),
+      (0, 'References'),
+  ]
+
+
+def BinXrefMatches(xref_search_response):
+  """\
+  Sorts the matches in |xref_search_response| into categories. Returns a list
+  of (type_id, name, matches) tuples in display order, where each element of
+  |matches| is a (cs.FileSpec, cs.XrefSingleMatch) tuple. Empty categories are
+  omitted. |type_id| is 0 for the 'References' category, which also collects
+  matches of every kind that doesn't have a category of its own.
+  """
+  names = _XrefCategoryNames()
+  bins = dict((type_id, []) for type_id, _ in names)
+  for search_result in xref_search_response.search_result:
+    for match in search_result.match:
+      target_bin = bins.get(match.type_id, bins[0])
+      target_bin.append((search_result.file, match))
+
+  return [(type_id, name, bins[type_id])
+          for type_id, name in names
+          if bins[type_id]]
+
+
+def _RenderXrefSearchFailure(mapper, xref_search_response):
+  mapper.write('No results for query\n')
+  if xref_search_response.status_message:
+    mapper.write('Server status: {}'.format(
+        xref_search_response.status_message))
+  mapper.write('Status code  : {}'.format(xref_search_response.status))
+
+
 def RenderXrefSearchResponse(mapper, xref_search_response):
   # Failed?
   if xref_search_response.status != 0:
-    mapper.write('No results for query\n')
-    if xref_search_response.status_message:
-      mapper.write('Server status: {}'.format(
-          xref_search_response.status_message))
-    mapper.write('Status code  : {}'.format(xref_search_response.status))
+    _RenderXrefSearchFailure(mapper, xref_search_response)
     return
 
-  class Bin:
-
-    def __init__(self, name, order):
-      self.name = name
-      self.order = order
-
-      # Each element in the list is a tuple, of which the first element
-      # is a cs.FileSpec, and the second element is a XrefSingleMatch.
-      self.bin = []
-
-  collectors = {
-      cs.KytheXrefKind.DEFINITION: Bin('Definition', 1),
-      cs.KytheXrefKind.DECLARATION: Bin('Declaration', 2),
-      cs.KytheXrefKind.CALLED_BY: Bin('Called by', 3),
-      cs.KytheXrefKind.INSTANTIATION: Bin('Instantiations', 4),
-      cs.KytheXrefKind.OVERRIDDEN_BY: Bin('Overridden by', 5),
-      cs.KytheXrefKind.OVERRIDES: Bin('Overrides', 6),
-      cs.KytheXrefKind.EXTENDED_BY: Bin('Extended by', 7),
-      cs.KytheXrefKind.EXTENDS: Bin('Extends', 8),
-      cs.KytheXrefKind.GENERATES: Bin('Generates', 9),
-      cs.KytheXrefKind.GENERATED_BY: Bin('Generated by', 10),
-      cs.KytheXrefKind.ANNOTATES: Bin('Annotates', 11),
-      cs.KytheXrefKind.ANNOTATED_BY: Bin('Annotated by', 12),
-
-      # Everything else.
-      0: Bin('References', 100)
-  }
+  for _, name, matches in BinXrefMatches(xref_search_response):
+    with TaggedBlock(mapper, 'Cat'):
+      mapper.write('{}:\n'.format(name))
+    RenderXrefResults(mapper, matches)
+    mapper.newline()
 
-  for search_result in xref_search_response.search_result:
-    for match in search_result.match:
-      if match.type_id in collectors:
-        target_bin = collectors[match.type_id]
-      else:
-        target_bin = collectors[0]
-      target_bin.bin.append((search_result.file, match))
 
-  bins = collectors.values()
-  bins.sort(key=lambda b: b.order)
+# Number of matches that are added each time a collapsed xref category is
+# expanded.
+XREF_CATEGORY_PAGE_SIZE = 20
 
-  for ref_bin in bins:
-    if len(ref_bin.bin) == 0:
-      continue
-    with TaggedBlock(mapper, 'Cat'):
-      mapper.write('{}:\n'.format(ref_bin.name))
-    RenderXrefResults(mapper, ref_bin.bin)
+
+def _XrefMatchKey(file_and_match):
+  file_spec, match = file_and_match
+  return file_spec.name, match.line_number, match.type_id
+
+
+class XrefCategory(object):
+  """\
+  A category of cross references, e.g. 'Called by', in an xref buffer whose
+  categories are expanded on demand. See RenderLazyXrefSearchResponse().
+
+  |matches| are the (cs.FileSpec, cs.XrefSingleMatch) tuples that are known so
+  far. |complete| is False if the server has more. |shown| is the number of
+  matches that are rendered while the category is |expanded|. |page_token|
+  continues the category's own query where the last page fetched for it left
+  off, and is None until the first page has been fetched.
+
+  Categories are tracked by the LocationMapper the same way call graph nodes
+  are. Hence NodeAt() returns the category for any line within it.
+  """
+
+  def __init__(self, type_id, name, matches, complete):
+    self.type_id = type_id
+    self.name = name
+    self.expanded = False
+    self.shown = 0
+    self.page_token = None
+    self.SetMatches(matches, complete)
+
+    # Categories don't have signatures. Needed by AddRenderedNode().
+    self.signature = None
+
+  def SetMatches(self, matches, complete):
+    self.matches = sorted(matches, key=lambda r: (r[0].name, r[1].line_number))
+    self.complete = complete
+    self.shown = min(self.shown, len(self.matches))
+
+  def MergeFetchedMatches(self, matches, next_page_token):
+    """\
+    Adds |matches|, a page of matches that was fetched for this category
+    alone, to the known ones. |next_page_token| is the token for the next page
+    or empty if there are no more.
+
+    Pages can repeat matches from the initial response since the order isn't
+    the same. Only plain references are fetched for the 'References' category.
+    Matches of the other kinds that it collects come from the initial response.
+    """
+    fetched = set(_XrefMatchKey(m) for m in matches)
+    self.SetMatches(
+        [m for m in self.matches if _XrefMatchKey(m) not in fetched] +
+        list(matches), not next_page_token)
+    self.page_token = next_page_token
+
+  def Count(self):
+    # type: () -> str
+    if self.complete:
+      return str(len(self.matches))
+    return '{}+'.format(len(self.matches))
+
+
+def MakeXrefCategories(xref_search_response):
+  """\
+  Returns a list of XrefCategory objects for the matches in
+  |xref_search_response|. All of them are incomplete if the server has more
+  matches than it returned, since there's no telling which categories they
+  belong to.
+  """
+  complete = not xref_search_response.kythe_next_page_token
+  return [
+      XrefCategory(type_id, name, matches, complete)
+      for type_id, name, matches in BinXrefMatches(xref_search_response)
+  ]
+
+
+def RenderXrefCategory(mapper, category):
+  start = mapper.Position()
+  mapper.SetNodeForLine(category)
+  with TaggedBlock(mapper, 'Cat'):
+    mapper.write('{} {} ({})'.format('[-]' if category.expanded else '[+]',
+                                     category.name, category.Count()))
+  mapper.newline()
+
+  if category.expanded:
+    RenderXrefResults(mapper, category.matches[:category.shown])
+    remaining = len(category.matches) - category.shown
+    if remaining > 0 or not category.complete:
+      mapper.write('    ... {} more'.format(
+          remaining if category.complete else '{}+'.format(remaining)))
+      mapper.newline()
     mapper.newline()
 
+  mapper.AddRenderedNode(category, 0, start, mapper.Position())
+
+
+def RenderLazyXrefSearchResponse(mapper, xref_search_response):
+  """\
+  Like RenderXrefSearchResponse(), but only renders a header for each category
+  along with the number of matches in it. The matches are rendered once the
+  category is expanded. See RerenderXrefCategory().
+  """
+  if xref_search_response.status != 0:
+    _RenderXrefSearchFailure(mapper, xref_search_response)
+    return
+
+  for category in MakeXrefCategories(xref_search_response):
+    RenderXrefCategory(mapper, category)
+
+
+def RerenderXrefCategory(mapper, category):
+  # type: (LocationMapper, XrefCategory) -> Optional[Tuple[int, int, List[str]]]
+  """\
+  Re-render |category| in place after it has been expanded, collapsed or its
+  matches have changed. Returns the same thing as RerenderNode().
+  """
+  return _RerenderBlock(mapper, category, lambda m, _: RenderXrefCategory(
+      m, category))
+
 
 NODE_INDENT = 4
 
 
+RE_TEMPLATE_BRACKET = re.compile(r'[<>]')
+
+# Memoized results of AbbreviateCppSymbol(). Call graphs are re-rendered each
+# time a node is expanded or collapsed, which means abbreviating the same
+# symbols over and over. Cleared once it grows to ABBREVIATION_CACHE_SIZE
+# entries.
+g_abbreviation_cache_ = {}
+
+ABBREVIATION_CACHE_SIZE = 4096
+
+
 # Shorten display names by adding elided sections for template parameters.
 def AbbreviateCppSymbol(s):
-  s = s.replace('<anonymous-namespace>', '{}')
-  short = ''
-  template_count = 0
-  for c in s:
-    if c == '>':
-      template_count -= 1
+  short = g_abbreviation_cache_.get(s)
+  if short is not None:
+    return short
 
+  symbol = s.replace('<anonymous-namespace>', '{}')
+  pieces = []
+  template_count = 0
+  last = 0
+  for m in RE_TEMPLATE_BRACKET.finditer(symbol):
+    index = m.start()
     if template_count == 0:
-      short += c
+      pieces.append(symbol[last:index])
 
-    if c == '<':
+    if symbol[index] == '>':
+      template_count -= 1
+      if template_count == 0:
+        pieces.append('>')
+    else:
+      if template_count == 0:
+        pieces.append('<')
       template_count += 1
       if template_count == 1:
-        short += '...'
+        pieces.append('...')
+    last = index + 1
+
+  if template_count == 0:
+    pieces.append(symbol[last:])
+  short = ''.join(pieces)
+
+  if len(g_abbreviation_cache_) >= ABBREVIATION_CACHE_SIZE:
+    g_abbreviation_cache_.clear()
+  g_abbreviation_cache_[s] = short
   return short
 
 
 def RenderNode(mapper, node, level):
+  start = mapper.Position()
 
   with TaggedBlock(mapper, 'N'):
     # Rendered text looks like:
@@ -412,6 +1223,7 @@ def RenderNode(mapper, node, level):
 
     # Widget
     mapper.SetSignatureForLine(node.signature)
+    mapper.SetNodeForLine(node)
 
     if node.children:
       expander = '[-]' if len(node.children) > 0 else ' * '
@@ -453,6 +1265,36 @@ def RenderNode(mapper, node, level):
     for c in node.children:
       RenderNode(mapper, c, level + 1)
 
+  mapper.AddRenderedNode(node, level, start, mapper.Position())
+
+
+def RerenderNode(mapper, node):
+  # type: (LocationMapper, Any) -> Optional[Tuple[int, int, List[str]]]
+  """\
+  Re-render |node| in place after its children have changed. |node| must have
+  been rendered into |mapper| via RenderNode(). Only the lines spanned by
+  |node| and its descendants are rendered again.
+
+  Returns a (first, last, lines) tuple indicating that lines |first| through
+  |last| of the previous rendering, counting from 0 and inclusive, have been
+  replaced by |lines|. Returns None if |node| is not currently rendered, e.g.
+  because one of its ancestors has since been collapsed.
+  """
+  return _RerenderBlock(mapper, node, lambda m, level: RenderNode(
+      m, node, level))
+
+
+def _RerenderBlock(mapper, node, render):
+  rendered = mapper.GetRenderedNode(node)
+  if rendered is None:
+    return None
+
+  subtree = LocationMapper()
+  render(subtree, rendered.level)
+  first, last = rendered.start[0], rendered.end[0]
+  mapper.Splice(rendered.start, rendered.end, subtree)
+  return (first, last, mapper.Lines()[first:first + len(subtree.Lines())])
+
 
 def RenderCompoundResponse(compound_response, query):
   mapper = LocationMapper()
@@ -478,6 +1320,43 @@ def RenderCompoundResponse(compound_response, query):
   return mapper
 
 
+def RenderPendingRequest(query):
+  """\
+  Renders the placeholder that's shown in a results buffer while the response
+  for |query| is being fetched in the background.
+  """
+  mapper = LocationMapper()
+  mapper.write('Waiting for CodeSearch results for ')
+  with TaggedBlock(mapper, 'q'):
+    mapper.write(query)
+  mapper.newline()
+  return mapper
+
+
+def RenderFailedRequest(query):
+  """\
+  Renders what's left in a results buffer in place of the placeholder once the
+  background request for |query| has failed.
+  """
+  mapper = LocationMapper()
+  mapper.write('Failed to get CodeSearch results for ')
+  with TaggedBlock(mapper, 'q'):
+    mapper.write(query)
+  mapper.newline()
+  return mapper
+
+
+def EnableHighlightSpans():
+  """\
+  Render plain text along with a list of highlight spans for each rendered
+  buffer instead of concealable markup. See LocationMapper.HighlightSpans().
+  """
+  global HIGHLIGHT_SPANS
+
+  DisableConcealableMarkup()
+  HIGHLIGHT_SPANS = True
+
+
 def DisableConcealableMarkup():
   global TAG_START_FORMAT
   global TAG_END_FORMAT
@@ -4,7 +4,10 @@
 # license that can be found in the LICENSE file or at
 # https://developers.google.com/open-source/licenses/bsd.
 
+import copy
+import itertools
 import json
+import pickle
 import sys
 import unittest
 import os
@@ -35,13 +38,17 @@ line contains an object representing associated metadata.
 -------------------------------------------------------------------------------
 '''
   ]
+  signature_map = l.SignatureMap()
+  jump_map = l.JumpMap()
   for index, line in enumerate(l.Lines()):
-    o = {}
-    if index in l.jump_map_:
-      o['j'] = l.jump_map_[index]
-    if index in l.signature_map_:
-      o['s'] = l.signature_map_[index]
-    s.append('{:03d}|{}\n   |{}'.format(index + 1, line, str(o)))
+    # Spelled out rather than using a dict so that the order of the keys
+    # doesn't depend on the Python version.
+    o = []
+    if index in signature_map:
+      o.append("'s': {!r}".format(signature_map[index]))
+    if index in jump_map:
+      o.append("'j': {!r}".format(jump_map[index]))
+    s.append('{:03d}|{}\n   |{{{}}}'.format(index + 1, line, ', '.join(o)))
   return '\n'.join(s) + '\n'
 
 
@@ -71,6 +78,55 @@ class TestRenderers(unittest.TestCase):
     _, _, c = l_map.JumpTargetAt(50, 30)
     self.assertEqual(16, c)
 
+  def test_search_response_01_without_markup(self):
+    start_format, end_format = r.TAG_START_FORMAT, r.TAG_END_FORMAT
+    r.DisableConcealableMarkup()
+    try:
+      with open(TestDataPath('search-response-01.json'), 'r') as f:
+        m = cs.Message.Coerce(json.load(f), cs.CompoundResponse)
+      l_map = r.RenderCompoundResponse(m, 'unspecified')
+    finally:
+      r.TAG_START_FORMAT, r.TAG_END_FORMAT = start_format, end_format
+
+    self.assertTrue(l_map.Lines()[49].startswith('    409 bool '))
+    for c in range(1, 40):
+      self.assertEqual(('src/chrome/browser/download/download_prefs.cc', 409,
+                        c), l_map.JumpTargetAt(50, c + 8))
+
+  def RenderWithHighlightSpans(self, test_file_name):
+    saved = r.TAG_START_FORMAT, r.TAG_END_FORMAT, r.HIGHLIGHT_SPANS
+    r.EnableHighlightSpans()
+    try:
+      with open(TestDataPath(test_file_name), 'r') as f:
+        m = cs.Message.Coerce(json.load(f), cs.CompoundResponse)
+      return r.RenderCompoundResponse(m, 'unspecified')
+    finally:
+      r.TAG_START_FORMAT, r.TAG_END_FORMAT, r.HIGHLIGHT_SPANS = saved
+
+  def test_search_response_01_highlight_spans(self):
+    l_map = self.RenderWithHighlightSpans('search-response-01.json')
+    lines = l_map.Lines()
+
+    def SpanText(span):
+      (start_line, start_column), (end_line, end_column), _ = span
+      if start_line == end_line:
+        return lines[start_line][start_column:end_column]
+      return None
+
+    self.assertTrue(lines[49].startswith('    409 bool '))
+    self.assertEqual(('src/chrome/browser/download/download_prefs.cc', 409,
+                      1), l_map.JumpTargetAt(50, 9))
+
+    spans = [(s, e, g) for s, e, g in l_map.HighlightSpans() if s[0] == 49]
+    self.assertEqual(['409', 'bool'], [SpanText(s) for s in spans[:2]])
+    self.assertEqual(['csLineNum', 'csKeyword'], [g for _, _, g in spans[:2]])
+
+    # The query is highlighted on the first line. Structural blocks aren't.
+    self.assertIn(((0, 23), (0, 34), 'csQuery'), l_map.HighlightSpans())
+    for _, _, group in l_map.HighlightSpans():
+      self.assertTrue(group in r.HIGHLIGHT_GROUPS.values() or
+                      group == 'csLineNum')
+
   def test_search_response_02(self):
     l_map = self.run_render_test('search-response-02.json')
 
@@ -85,6 +141,12 @@ class TestRenderers(unittest.TestCase):
     self.assertEqual(35, l_map.PreviousFileLocation(45))
     self.assertEqual(45, l_map.NextFileLocation(45))
 
+    self.assertEqual(2, l_map.FileCount())
+    self.assertEqual(3, l_map.NthFileLocation(1))
+    self.assertEqual(35, l_map.NthFileLocation(2))
+    self.assertIsNone(l_map.NthFileLocation(3))
+    self.assertIsNone(l_map.NthFileLocation(0))
+
   def test_search_response_03(self):
     self.run_render_test('search-response-03.json')
 
@@ -98,14 +160,382 @@ class TestRenderers(unittest.TestCase):
     self.run_render_test('xrefs-response-02.json')
 
   def test_xref_search_response_03(self):
-    self.run_render_test('xrefs-response-03.json')
+    l_map = self.run_render_test('xrefs-response-03.json')
+
+    self.assertEqual(9, l_map.FileCount())
+    self.assertEqual(2, l_map.NextFileLocation(1))
+    self.assertEqual(6, l_map.NextFileLocation(2))
+    self.assertEqual(6, l_map.PreviousFileLocation(10))
+    self.assertEqual(10, l_map.PreviousFileLocation(12))
+    self.assertEqual(33, l_map.NthFileLocation(9))
 
   def test_call_graph_01(self):
-    self.run_render_test('call-graph-01.json')
+    l_map = self.run_render_test('call-graph-01.json')
+
+    root_signature = l_map.SignatureAt(1)
+    self.assertTrue(root_signature.endswith('http_auth_handler.h#'
+                                            'JeFRw996xZZVV9czj%2FFb1cDpm3lK9K'
+                                            'ygMuH3I5j8Gvs%3D'))
+    self.assertEqual(root_signature, l_map.SignatureAt(2))
+    self.assertNotEqual(root_signature, l_map.SignatureAt(3))
+    self.assertEqual(l_map.SignatureAt(3), l_map.SignatureAt(5))
 
   def test_call_graph_02(self):
     self.run_render_test('call-graph-02.json')
 
+  def test_markup_like_source_text(self):
+    l_map = r.LocationMapper()
+    l_map.SetTargetForPos('a.cc', 1)
+    l_map.write('x = {a}; y_ = ')
+    with r.TaggedBlock(l_map, 'k'):
+      l_map.write('z')
+    l_map.write(' ^b{')
+
+    # Text that looks like markup isn't mistaken for markup.
+    self.assertEqual(('a.cc', 1, 14), l_map.JumpTargetAt(1, 14))
+    self.assertEqual(('a.cc', 1, 15), l_map.JumpTargetAt(1, 18))
+    self.assertEqual(('a.cc', 1, 19), l_map.JumpTargetAt(1, 25))
+
+  def assertSameRendering(self, expected, actual):
+    self.assertEqual(expected.Lines(), actual.Lines())
+    self.assertEqual(expected.JumpMap(), actual.JumpMap())
+    self.assertEqual(expected.SignatureMap(), actual.SignatureMap())
+    self.assertEqual(expected.markup_map_, actual.markup_map_)
+    self.assertEqual(expected.file_lines_, actual.file_lines_)
+    self.assertEqual(expected.node_map_, actual.node_map_)
+    self.assertEqual(expected.node_lines_, actual.node_lines_)
+    self.assertEqual(expected.signature_nodes_, actual.signature_nodes_)
+    self.assertEqual(
+        sorted(expected.HighlightSpans()), sorted(actual.HighlightSpans()))
+
+    def Nodes(mapper):
+      return dict((k, (n.level, n.start, n.end))
+                  for k, n in mapper.rendered_nodes_.items())
+
+    self.assertEqual(Nodes(expected), Nodes(actual))
+
+  def test_call_graph_rerender_node(self):
+    with open(TestDataPath('call-graph-01.json'), 'r') as f:
+      m = cs.Message.Coerce(json.load(f), cs.CompoundResponse)
+    root = m.call_graph_response[0].node
+
+    def RenderFromScratch():
+      mapper = r.LocationMapper()
+      r.RenderNode(mapper, root, 0)
+      return mapper
+
+    l_map = RenderFromScratch()
+    parent = root.children[1]
+    parent.children = [
+        copy.deepcopy(root.children[2]),
+        copy.deepcopy(root.children[3])
+    ]
+
+    first, last, lines = r.RerenderNode(l_map, parent)
+    self.assertSameRendering(RenderFromScratch(), l_map)
+    self.assertEqual((5, 8), (first, last))
+    self.assertEqual(l_map.Lines()[5:5 + len(lines)], lines)
+    self.assertEqual(
+        sorted(RenderFromScratch().HighlightSpans(5, 4 + len(lines))),
+        sorted(l_map.HighlightSpans(5, 4 + len(lines))))
+    self.assertTrue(all(5 <= s[0] < 5 + len(lines)
+                        for s, _, _ in l_map.HighlightSpans(5, 4 + len(lines))))
+
+    grandchild = parent.children[1]
+    grandchild.children = [copy.deepcopy(root.children[0])]
+    r.RerenderNode(l_map, grandchild)
+    self.assertSameRendering(RenderFromScratch(), l_map)
+
+    parent.children = []
+    r.RerenderNode(l_map, parent)
+    self.assertSameRendering(RenderFromScratch(), l_map)
+    self.assertIsNone(r.RerenderNode(l_map, grandchild))
+
+  def test_call_graph_rerender_node_highlight_spans(self):
+    saved = r.TAG_START_FORMAT, r.TAG_END_FORMAT, r.HIGHLIGHT_SPANS
+    r.EnableHighlightSpans()
+    try:
+      self.test_call_graph_rerender_node()
+    finally:
+      r.TAG_START_FORMAT, r.TAG_END_FORMAT, r.HIGHLIGHT_SPANS = saved
+
+  def test_call_graph_pickle(self):
+    with open(TestDataPath('call-graph-01.json'), 'r') as f:
+      m = cs.Message.Coerce(json.load(f), cs.CompoundResponse)
+    root = m.call_graph_response[0].node
+    l_map = r.LocationMapper()
+    r.RenderNode(l_map, root, 0)
+    setattr(l_map, 'root_node', root)
+    self.assertLess(0, l_map.EstimateSize())
+
+    loaded = pickle.loads(pickle.dumps(l_map, protocol=2))
+    self.assertEqual(LocationMapToString(l_map), LocationMapToString(loaded))
+    self.assertEqual(l_map.markup_map_, loaded.markup_map_)
+    self.assertEqual(l_map.node_lines_, loaded.node_lines_)
+    self.assertEqual(l_map.EstimateSize(), loaded.EstimateSize())
+
+    # Nodes can still be looked up and rerendered, and refer to the same
+    # objects as the tree that was pickled along with the mapper.
+    parent = loaded.NodeAt(6)
+    self.assertIs(loaded.root_node.children[1], parent)
+    self.assertEqual([parent], loaded.NodesForSignature(parent.signature))
+    parent.children = [copy.deepcopy(loaded.root_node.children[2])]
+    r.RerenderNode(loaded, parent)
+    expected = r.LocationMapper()
+    r.RenderNode(expected, loaded.root_node, 0)
+    self.assertEqual(LocationMapToString(expected),
+                     LocationMapToString(loaded))
+
+  def test_search_response_pages(self):
+    with open(TestDataPath('search-response-01.json'), 'r') as f:
+      m = cs.Message.Coerce(json.load(f), cs.CompoundResponse)
+    response = m.search_response[0]
+    results = response.search_result
+
+    def Response(offset, count, hit_max_results):
+      page = copy.deepcopy(response)
+      page.search_result = results[offset:offset + count]
+      page.results_offset = offset
+      page.hit_max_results = hit_max_results
+      return page
+
+    def RenderFromScratch(count, hit_max_results):
+      mapper = r.LocationMapper()
+      r.RenderSearchResponse(mapper, 'query',
+                             Response(0, count, hit_max_results))
+      return mapper
+
+    l_map = RenderFromScratch(6, True)
+    continuation = l_map.continuation_
+    self.assertEqual('query', continuation.query)
+    self.assertEqual(6, continuation.results_offset)
+    self.assertEqual('Search results are truncated. Showing 6 results out of'
+                     ' an estimated {}.'.format(
+                         response.estimated_total_number_of_results),
+                     l_map.Lines()[continuation.position[0]])
+
+    first = r.AppendSearchResponsePage(
+        l_map, r.RenderSearchResponsePage('query', Response(6, 6, True)))
+    self.assertEqual(continuation.position[0], first)
+    self.assertSameRendering(RenderFromScratch(12, True), l_map)
+    self.assertEqual(12, l_map.continuation_.results_offset)
+    self.assertEqual(RenderFromScratch(12, True).continuation_.position,
+                     l_map.continuation_.position)
+
+    r.AppendSearchResponsePage(
+        l_map, r.RenderSearchResponsePage('query', Response(12, 6, False)))
+    self.assertSameRendering(RenderFromScratch(len(results), False), l_map)
+    self.assertIsNone(l_map.continuation_)
+    self.assertEqual(len(results), l_map.FileCount())
+
+  def test_lazy_xref_categories(self):
+    with open(TestDataPath('xrefs-response-03.json'), 'r') as f:
+      m = cs.Message.Coerce(json.load(f), cs.CompoundResponse)
+    response = m.xref_search_response[0]
+
+    l_map = r.LocationMapper()
+    r.RenderLazyXrefSearchResponse(l_map, response)
+    self.assertEqual([
+        '^Cat{[+] Declaration (1)}Cat_', '^Cat{[+] Overridden by (10)}Cat_',
+        '^Cat{[+] References (3)}Cat_', ''
+    ], l_map.Lines())
+    categories = [l_map.NodeAt(line) for line in range(1, 4)]
+    self.assertIsNone(l_map.JumpTargetAt(2, 1))
+
+    def RenderFromScratch():
+      mapper = r.LocationMapper()
+      for category in categories:
+        r.RenderXrefCategory(mapper, category)
+      return mapper
+
+    overridden_by = categories[1]
+    overridden_by.expanded = True
+    overridden_by.shown = 4
+    self.assertEqual(1, r.RerenderXrefCategory(l_map, overridden_by)[0])
+    self.assertSameRendering(RenderFromScratch(), l_map)
+    self.assertEqual('    ... 6 more', l_map.Lines()[-4])
+    self.assertIs(overridden_by, l_map.NodeAt(4))
+    self.assertIs(categories[2], l_map.NodeAt(len(l_map.Lines()) - 1))
+
+    # Expanding the category fully renders the same matches as the regular
+    # xref buffer. Only the category header differs.
+    overridden_by.shown = len(overridden_by.matches)
+    r.RerenderXrefCategory(l_map, overridden_by)
+    self.assertSameRendering(RenderFromScratch(), l_map)
+    eager = r.RenderCompoundResponse(m, 'unspecified')
+    self.assertEqual(eager.Lines()[6:25], l_map.Lines()[3:22])
+    self.assertEqual('^Cat{[+] References (3)}Cat_', l_map.Lines()[22])
+
+    overridden_by.expanded = False
+    r.RerenderXrefCategory(l_map, overridden_by)
+    self.assertEqual(categories[2], l_map.NodeAt(3))
+    self.assertEqual(4, len(l_map.Lines()))
+
+    response.kythe_next_page_token = 'more'
+    self.assertEqual(['1+', '10+', '3+'],
+                     [c.Count() for c in r.MakeXrefCategories(response)])
+
+  def test_merge_fetched_xref_matches(self):
+    with open(TestDataPath('xrefs-response-03.json'), 'r') as f:
+      m = cs.Message.Coerce(json.load(f), cs.CompoundResponse)
+    response = m.xref_search_response[0]
+    response.kythe_next_page_token = 'more'
+    declaration, overridden_by, references = r.MakeXrefCategories(response)
+
+    # One of the references is of a kind that has no category of its own.
+    # Fetching the category only returns plain references, one of which was
+    # already known.
+    self.assertIsNone(references.page_token)
+    references.matches[0][1].type_id = 'USES'
+    fetched = [(f, copy.deepcopy(match)) for f, match in references.matches[1:]]
+    fetched.append((fetched[0][0], copy.deepcopy(fetched[0][1])))
+    fetched[-1][1].line_number += 1000
+    references.MergeFetchedMatches(fetched, 'page-2')
+    self.assertEqual('4+', references.Count())
+    self.assertEqual('page-2', references.page_token)
+    self.assertEqual(['USES', 'REFERENCE', 'REFERENCE', 'REFERENCE'],
+                     [match.type_id for _, match in references.matches])
+
+    # The next page adds to the matches.
+    fetched = [(f, copy.deepcopy(match)) for f, match in fetched[-1:]]
+    fetched[0][1].line_number += 1
+    references.MergeFetchedMatches(fetched, '')
+    self.assertEqual('5', references.Count())
+
+    # Pages of other categories add to the matches of the initial response
+    # in the same way.
+    overridden_by.MergeFetchedMatches(overridden_by.matches[:2], '')
+    self.assertEqual('10', overridden_by.Count())
+
+  def test_call_graph_node_lookup(self):
+    with open(TestDataPath('call-graph-01.json'), 'r') as f:
+      m = cs.Message.Coerce(json.load(f), cs.CompoundResponse)
+    root = m.call_graph_response[0].node
+
+    # Make the second child recursive, so its signature appears twice.
+    parent = root.children[1]
+    parent.children = [copy.deepcopy(parent)]
+    duplicate = parent.children[0]
+
+    l_map = r.LocationMapper()
+    r.RenderNode(l_map, root, 0)
+
+    self.assertIs(root, l_map.NodeAt(1))
+    self.assertIs(root, l_map.NodeAt(2))
+    self.assertIs(root.children[0], l_map.NodeAt(3))
+    self.assertIs(parent, l_map.NodeAt(6))
+    self.assertIs(parent, l_map.NodeAt(8))
+    self.assertIs(duplicate, l_map.NodeAt(9))
+    self.assertEqual(parent.signature, l_map.SignatureAt(9))
+
+    nodes = l_map.NodesForSignature(parent.signature)
+    self.assertEqual(2, len(nodes))
+    self.assertEqual(set([id(parent), id(duplicate)]), set(map(id, nodes)))
+    self.assertEqual([], l_map.NodesForSignature('no such signature'))
+
+    parent.children = []
+    r.RerenderNode(l_map, parent)
+    self.assertEqual([parent], l_map.NodesForSignature(parent.signature))
+    self.assertIs(root.children[2], l_map.NodeAt(9))
+
+  def test_lookups_before_first_target(self):
+    l_map = r.LocationMapper()
+    l_map.write('header')
+    l_map.newline()
+    l_map.SetTargetForPos('a.cc', 10)
+    l_map.SetSignatureForLine('sig')
+    l_map.write('body')
+
+    self.assertIsNone(l_map.JumpTargetAt(1, 1))
+    self.assertIsNone(l_map.SignatureAt(1))
+    self.assertEqual(('a.cc', 10, 1), l_map.JumpTargetAt(2, 1))
+    self.assertEqual('sig', l_map.SignatureAt(20))
+
+  def test_interned_strings(self):
+    l_map = r.LocationMapper()
+    for i in range(3):
+      l_map.SetTargetForPos('a.cc', i + 1)
+      l_map.SetSignatureForLine('sig')
+      l_map.write('x')
+      l_map.newline()
+    self.assertEqual(['a.cc', 'sig'], l_map.strings_.strings_)
+
+    # Setting the target for the same line again replaces it.
+    l_map.SetTargetForPos('b.cc', 7)
+    l_map.SetTargetForPos('b.cc', 8)
+    self.assertEqual([0, 1, 2, 3], list(l_map.jump_table_.Lines()))
+
+    # Strings from a spliced mapper are re-interned.
+    other = r.LocationMapper()
+    other.SetTargetForPos('c.cc', 5)
+    other.SetSignatureForLine('sig2')
+    other.write('y')
+    other.newline()
+    other.write('z')
+    l_map.Splice((1, 0), (2, 0), other)
+    self.assertEqual(['a.cc', 'sig', 'b.cc', 'c.cc', 'sig2'],
+                     l_map.strings_.strings_)
+    self.assertEqual({
+        0: ('a.cc', 0, 0),
+        1: ('c.cc', 4, 0),
+        2: ('a.cc', 2, 1),
+        3: ('b.cc', 7, 0)
+    }, l_map.JumpMap())
+    self.assertEqual({0: 'sig', 1: 'sig2', 2: 'sig'}, l_map.SignatureMap())
+
+
+def ReferenceAbbreviateCppSymbol(s):
+  # The original character at a time implementation.
+  s = s.replace('<anonymous-namespace>', '{}')
+  short = ''
+  template_count = 0
+  for c in s:
+    if c == '>':
+      template_count -= 1
+
+    if template_count == 0:
+      short += c
+
+    if c == '<':
+      template_count += 1
+      if template_count == 1:
+        short += '...'
+  return short
+
+
+class TestAbbreviateCppSymbol(unittest.TestCase):
+
+  def setUp(self):
+    r.g_abbreviation_cache_.clear()
+
+  def test_abbreviate(self):
+    self.assertEqual('base::Callback<...>::Run()',
+                     r.AbbreviateCppSymbol(
+                         'base::Callback<void (std::unique_ptr<Foo>)>::Run()'))
+    self.assertEqual('{}::Foo()',
+                     r.AbbreviateCppSymbol('<anonymous-namespace>::Foo()'))
+    self.assertEqual('Foo()', r.AbbreviateCppSymbol('Foo()'))
+
+  def test_matches_reference(self):
+    symbols = [
+        '', '<', '>', '<>', 'a<b<c>d>e<f>g', 'operator<', 'operator>',
+        'operator>>(a<b>)', 'x<<y>', 'a>b<c>d', '<anonymous-namespace>::f<T>'
+    ]
+    # Plus every string of up to 6 characters drawn from 'a<>'.
+    for length in range(7):
+      for chars in itertools.product('a<>', repeat=length):
+        symbols.append(''.join(chars))
+
+    for s in symbols:
+      self.assertEqual(
+          ReferenceAbbreviateCppSymbol(s), r.AbbreviateCppSymbol(s), s)
+
+  def test_cache_is_bounded(self):
+    for i in range(r.ABBREVIATION_CACHE_SIZE + 10):
+      r.AbbreviateCppSymbol('f<{}>'.format(i))
+    self.assertTrue(len(r.g_abbreviation_cache_) <= r.ABBREVIATION_CACHE_SIZE)
+    self.assertEqual('f<...>', r.AbbreviateCppSymbol('f<1>'))
+
 
 if __name__ == '__main__':
   unittest.main()
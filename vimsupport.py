@@ -6,9 +6,15 @@
 
 from __future__ import absolute_import
 
+import atexit
+import copy
+import hashlib
 import os
+import socket
 import sys
+import threading
 import vim
+from collections import OrderedDict
 from ssl import SSLError
 
 if sys.version_info.major == 3:
@@ -26,6 +32,13 @@ def EscapeVimString(s):
       s.replace('\\', '\\\\').replace("'", "\\'").replace('\n', r'\n'))
 
 
+def _ToStr(s):
+  # vim.vars returns bytes for strings under Python 3.
+  if isinstance(s, bytes) and not isinstance(s, str):
+    return s.decode('utf-8')
+  return s
+
+
 def EchoVimError(s):
   vim.command('echohl WarningMsg | echo {} | echohl None'.format(
       EscapeVimString(s)))
@@ -38,21 +51,45 @@ try:
       CallGraphRequest,\
       CodeSearch, \
       CompoundRequest,\
+      CompoundResponse,\
       InstallTestRequestHandler,\
       KytheXrefKind,\
+      Message,\
       NoFileSpecError, \
       NoSourceRootError, \
       NotFoundError, \
       SearchRequest, \
       ServerError,\
-      XrefNode,\
       XrefSearchRequest,\
       XrefSearchResponse
   from render.render import \
+      AppendSearchResponsePage, \
+      BinXrefMatches, \
       RenderCompoundResponse, \
+      RenderFailedRequest, \
       RenderNode, \
+      RenderLazyXrefSearchResponse, \
+      RenderPendingRequest, \
+      RenderSearchResponsePage, \
+      RerenderNode, \
+      RerenderXrefCategory, \
+      XREF_CATEGORY_PAGE_SIZE, \
       LocationMapper, \
-      DisableConcealableMarkup
+      DisableConcealableMarkup, \
+      EnableHighlightSpans
+  from client.annotations import AnnotationIndex
+  from client.buffers import BufferMap, DEFAULT_MAX_BYTES
+  from client.cache import ResponseCache
+  from client.coalesce import RequestCoalescer
+  from client.connection_pool import ConnectionPool, InstallConnectionPool, \
+      DEFAULT_IDLE_TIMEOUT_IN_SECONDS, DEFAULT_MAX_IDLE_CONNECTIONS
+  from client.jobs import Job, WorkerPool, DEFAULT_NUM_WORKERS
+  from client.prefetch import Prefetcher
+  from client.staleness import StalenessTracker
+  from client.stats import Stats
+  from client.trigram import TrigramIndex, DEFAULT_EXCLUDES, \
+      DEFAULT_UPDATE_INTERVAL_IN_SECONDS
+  from client.xrefs import PartitionByKind, TraverseXrefs
 
 except ImportError:
   EchoVimError("""\
@@ -69,36 +106,103 @@ pull in the submodule, could you try the following?
 
 g_codesearch = None
 
-g_buffer_map_ = {}
 
+def _CreateBufferMap():
+  max_bytes = DEFAULT_MAX_BYTES
+  if 'codesearch_buffer_memory_in_megabytes' in vim.vars:
+    max_bytes = int(
+        vim.vars['codesearch_buffer_memory_in_megabytes']) * 1024 * 1024
 
-def CalledFromVim(default=None):
+  spill_dir = None
+  if 'codesearch_buffer_spill_dir' in vim.vars:
+    spill_dir = os.path.expanduser(
+        _ToStr(vim.vars['codesearch_buffer_spill_dir']))
 
-  def wrapper(func):
+  buffer_map = BufferMap(
+      max_bytes=max_bytes,
+      spill_dir=spill_dir,
+      size_fn=lambda location_map: (location_map.EstimateSize()
+                                    if location_map else 0),
+      can_spill=lambda buffer_num, _: _CanSpillBuffer(buffer_num),
+      on_spill=lambda _, location_map: _DropPrefetcher(location_map))
+  atexit.register(buffer_map.Close)
+  return buffer_map
 
-    def inner_call_wrapper(*args, **kwargs):
-      global g_codesearch
-      try:
-        return func(*args, **kwargs)
 
-      except (URLError, HTTPError, SSLError):
-        EchoVimError('couldn\'t contact codesearch server.')
-        return default
+# Maps a buffer number to the LocationMapper for the results shown in that
+# buffer, or to None until there are any. LocationMappers for hidden buffers
+# are spilled to disk once they take up too much memory. See BufferMap.
+g_buffer_map_ = _CreateBufferMap()
+
+g_worker_pool = None
+
+# ConnectionPool through which requests to the server are sent. See
+# _InstallConnectionPool().
+g_connection_pool_ = None
+
+# Maps a signature to the list of XrefSearchResults for it, in least recently
+# used order. Lets successive tours for the same symbol skip the server.
+g_xref_memo_ = OrderedDict()
+g_xref_memo_lock_ = threading.Lock()
+
+XREF_MEMO_SIZE = 32
+
+# Maps a buffer number to a (filename, modification time, AnnotationIndex)
+# tuple for the source file in that buffer, in least recently used order.
+g_annotation_indexes_ = OrderedDict()
+
+ANNOTATION_INDEX_COUNT = 16
+
+# Maps a buffer number to a (filename, StalenessTracker) tuple for the source
+# file in that buffer, in least recently used order.
+g_staleness_trackers_ = OrderedDict()
+
+STALENESS_TRACKER_COUNT = 16
+
+# Maps a buffer number to the Job whose results are going to be displayed in
+# that buffer. Results from jobs that have been superseded are dropped.
+g_pending_jobs_ = {}
+
+# Maps a buffer number to the SearchContinuation for which the next page of
+# search results is being fetched.
+g_pending_pages_ = {}
+
+# TrigramIndex over the source checkout that :CrSearch falls back to. See
+# _GetLocalIndex().
+g_local_index_ = None
+
+# Stats instance that collects the time taken by each stage of each command.
+# See _GetStats().
+g_stats_ = None
 
-      except ServerError as e:
-        EchoVimError('server error: {}'.format(e.message))
-        return default
 
-      except NoFileSpecError as e:
-        EchoVimError('internal error: {}'.format(e.message))
-        return default
+def _CallAndReportErrors(func, default, *args, **kwargs):
+  """\
+  Invokes |func| and returns its result. Errors that the user needs to know
+  about are echoed instead, and |default| is returned.
+  """
+  global g_codesearch
+  try:
+    return func(*args, **kwargs)
+
+  except (URLError, HTTPError, SSLError, socket.error):
+    EchoVimError('couldn\'t contact codesearch server.')
+    return default
+
+  except ServerError as e:
+    EchoVimError('server error: {}'.format(e.message))
+    return default
+
+  except NoFileSpecError as e:
+    EchoVimError('internal error: {}'.format(e.message))
+    return default
 
-      except NotFoundError as e:
-        EchoVimError(e.message)
-        return default
+  except NotFoundError as e:
+    EchoVimError(e.message)
+    return default
 
-      except NoSourceRootError:
-        EchoVimError("""\
+  except NoSourceRootError:
+    EchoVimError("""\
 Couldn't determine Chromium source location.
 
 In order to show search results and link to corresponding files in the working
@@ -116,19 +220,69 @@ This can be accomplished via two ways:
          " E.g.: If you checked out Chromium to ~/sources/chrome/src
          let g:codesearch_source_root = '~/sources/chrome/'
 """)
-        g_codesearch = None
-        return default
+    g_codesearch = None
+    return default
+
+
+def CalledFromVim(default=None, record_stats=True):
+
+  def wrapper(func):
+
+    def inner_call_wrapper(*args, **kwargs):
+      if not record_stats:
+        return _CallAndReportErrors(func, default, *args, **kwargs)
+      with _GetStats().Command(func.__name__):
+        return _CallAndReportErrors(func, default, *args, **kwargs)
 
     return inner_call_wrapper
 
   return wrapper
 
 
+def _GetStats():
+  global g_stats_
+  if g_stats_ is None:
+    log_path = None
+    if 'codesearch_stats_log' in vim.vars:
+      log_path = os.path.expanduser(_ToStr(vim.vars['codesearch_stats_log']))
+    g_stats_ = Stats(log_path=log_path)
+  return g_stats_
+
+
+def _Stage(stage):
+  """\
+  Returns a context manager that records the time taken by the block as
+  |stage| of the command that's currently running. See Stats.Stage().
+  """
+  return _GetStats().Stage(stage)
+
+
+@CalledFromVim(record_stats=False)
+def ShowStats(clear=False):
+  if clear:
+    _GetStats().Clear()
+    return
+  lines = _GetStats().Report()
+  coalescer = getattr(g_codesearch, 'coalescer_', None)
+  if coalescer is not None:
+    counts = coalescer.Counts()
+    lines.append('Identical requests in flight: {} shared, {} sent'.format(
+        counts['hits'], counts['misses']))
+  vim.command('echo {}'.format(EscapeVimString('\n'.join(lines))))
+
+
 def _GetCodeSearch(base_filename=None):
   global g_codesearch
   if g_codesearch:
     return g_codesearch
 
+  with _Stage('source_root'):
+    return _CreateCodeSearch(base_filename)
+
+
+def _CreateCodeSearch(base_filename):
+  global g_codesearch
+
   arguments = {
       'user_agent_string':
           'Vim-CodeSearch-Client (https://github.com/chromium/vim-codesearch)'
@@ -145,19 +299,16 @@ def _GetCodeSearch(base_filename=None):
 
     arguments['a_path_inside_source_dir'] = base_filename
 
-  if 'codesearch_cache_dir' in vim.vars:
-    arguments['cache_dir'] = vim.vars['codesearch_cache_dir']
-    arguments['should_cache'] = True
-
-  if 'codesearch_cache_timeout_in_seconds' in vim.vars:
-    arguments['cache_timeout_in_seconds'] = int(
-        vim.vars['codesearch_cache_timeout_in_seconds'])
-
   if 'codesearch_timeout_in_seconds' in vim.vars:
     arguments['request_timeout_in_seconds'] = int(
         vim.vars['codesearch_timeout_in_seconds'])
 
-  g_codesearch = CodeSearch(**arguments)
+  _InstallConnectionPool()
+
+  if 'codesearch_cache_dir' in vim.vars:
+    g_codesearch = CachingCodeSearch(_CreateResponseCache(), **arguments)
+  else:
+    g_codesearch = TimedCodeSearch(**arguments)
 
   if 'codesearch_source_root' not in vim.vars:
     vim.vars['codesearch_source_root'] = g_codesearch.GetSourceRoot()
@@ -165,6 +316,215 @@ def _GetCodeSearch(base_filename=None):
   return g_codesearch
 
 
+def _InstallConnectionPool():
+  """\
+  Keeps connections to the server alive across requests, unless
+  g:codesearch_connection_pool_size is 0. The pool is installed into urllib
+  since that's what CodeSearch uses to talk to the server.
+  """
+  global g_connection_pool_
+  if g_connection_pool_:
+    return
+
+  max_idle = DEFAULT_MAX_IDLE_CONNECTIONS
+  if 'codesearch_connection_pool_size' in vim.vars:
+    max_idle = int(vim.vars['codesearch_connection_pool_size'])
+  if max_idle <= 0:
+    return
+
+  idle_timeout = DEFAULT_IDLE_TIMEOUT_IN_SECONDS
+  if 'codesearch_connection_idle_timeout_in_seconds' in vim.vars:
+    idle_timeout = int(
+        vim.vars['codesearch_connection_idle_timeout_in_seconds'])
+
+  g_connection_pool_ = ConnectionPool(
+      max_idle=max_idle, idle_timeout=idle_timeout)
+  InstallConnectionPool(g_connection_pool_)
+  atexit.register(g_connection_pool_.Close)
+
+
+# Maps a CompoundRequest field to the kind of request it represents for the
+# purpose of picking a cache timeout.
+REQUEST_KINDS = [
+    ('search_request', 'search'),
+    ('xref_search_request', 'xref'),
+    ('call_graph_request', 'callgraph'),
+    ('annotation_request', 'annotation'),
+]
+
+
+def _GetRequestKind(request):
+  for field, kind in REQUEST_KINDS:
+    if getattr(request, field, None):
+      return kind
+  return 'other'
+
+
+def _RequestKey(compound_request):
+  return '&'.join(
+      '{}={}'.format(k, v) for k, v in compound_request.AsQueryString())
+
+
+class TimedCodeSearch(CodeSearch):
+  """\
+  A CodeSearch that records the time taken by each request to the server as
+  the 'request' stage of the current command. This includes decoding the
+  response.
+
+  Identical requests that are in flight at the same time, e.g. from worker
+  threads, share a single request to the server and its decoded response. See
+  RequestCoalescer.
+  """
+
+  def __init__(self, **kwargs):
+    super(TimedCodeSearch, self).__init__(**kwargs)
+    self.coalescer_ = RequestCoalescer()
+
+  def SendRequestToServer(self, compound_request):
+    return self.coalescer_.Fetch(
+        _RequestKey(compound_request),
+        lambda: self._SendUncoalescedRequest(compound_request))
+
+  def _SendUncoalescedRequest(self, compound_request):
+    with _Stage('request'):
+      return CodeSearch.SendRequestToServer(self, compound_request)
+
+
+class CachingCodeSearch(TimedCodeSearch):
+  """\
+  A CodeSearch whose responses are cached by a ResponseCache instead of by
+  CodeSearch itself. Looking up a response, and fetching it on a miss, is
+  recorded as the 'cache' stage.
+  """
+
+  def __init__(self, response_cache, **kwargs):
+    super(CachingCodeSearch, self).__init__(**kwargs)
+    self.response_cache_ = response_cache
+
+  def SendRequestToServer(self, compound_request):
+    with _Stage('cache'):
+      return self.response_cache_.Fetch(
+          _RequestKey(compound_request), _GetRequestKind(compound_request),
+          lambda: TimedCodeSearch.SendRequestToServer(self, compound_request))
+
+
+def _CreateResponseCache():
+  arguments = {}
+  if 'codesearch_cache_size_in_megabytes' in vim.vars:
+    arguments['max_bytes'] = int(
+        vim.vars['codesearch_cache_size_in_megabytes']) * 1024 * 1024
+
+  if 'codesearch_cache_timeout_in_seconds' in vim.vars:
+    arguments['default_ttl'] = int(
+        vim.vars['codesearch_cache_timeout_in_seconds'])
+
+  if 'codesearch_cache_timeouts' in vim.vars:
+    arguments['ttls'] = dict(
+        (_ToStr(k), int(v))
+        for k, v in vim.vars['codesearch_cache_timeouts'].items())
+
+  if 'codesearch_cache_stale_while_revalidate' in vim.vars:
+    arguments['stale_while_revalidate'] = bool(
+        int(vim.vars['codesearch_cache_stale_while_revalidate']))
+
+  cache_dir = os.path.expanduser(_ToStr(vim.vars['codesearch_cache_dir']))
+  return ResponseCache(cache_dir, **arguments)
+
+
+def _IsAsyncEnabled():
+  return 'codesearch_async' in vim.vars and int(vim.vars['codesearch_async'])
+
+
+def _GetWorkerPool():
+  global g_worker_pool
+  if g_worker_pool:
+    return g_worker_pool
+
+  num_workers = DEFAULT_NUM_WORKERS
+  if 'codesearch_worker_count' in vim.vars:
+    num_workers = max(1, int(vim.vars['codesearch_worker_count']))
+
+  g_worker_pool = WorkerPool(num_workers)
+  return g_worker_pool
+
+
+def _RunRequest(func, args, callback, buffer_num=None):
+  """\
+  Invokes |func| with |args| and passes the completed Job to |callback|.
+
+  If g:codesearch_async is set, |func| is run on a worker thread and |callback|
+  is invoked later from a Vim timer. Otherwise both are invoked before
+  returning. Either way |func| must not touch any Vim state.
+
+  If |buffer_num| is specified, the results are destined for that buffer and
+  |callback| is skipped if the buffer is gone or if a newer request was issued
+  for the same buffer in the meantime.
+
+  Exceptions raised by |func| are raised again by the Job's Result(). When
+  |callback| runs from the timer, any exception that escapes it is reported
+  the same way CalledFromVim reports errors. If the buffer is still showing
+  the placeholder from _ShowPendingRequestInBuffer at that point, the
+  placeholder is replaced by a note that the request failed.
+  """
+  if not _IsAsyncEnabled():
+    job = Job(func, args)
+    job.Run()
+    callback(job)
+    return
+
+  # Both run after the command that issued the request has returned. Their
+  # stages are still attributed to it.
+  stats = _GetStats()
+  record = stats.Current()
+
+  def Run(*args):
+    with stats.Activate(record):
+      return func(*args)
+
+  def Deliver(job):
+    if buffer_num is not None:
+      if g_pending_jobs_.get(buffer_num) is not job:
+        return
+      del g_pending_jobs_[buffer_num]
+      if buffer_num not in g_buffer_map_:
+        return
+    if not _DeliverJob(callback, job, record) and buffer_num is not None:
+      _ShowFailedRequestInBuffer(buffer_num)
+
+  job = _GetWorkerPool().Submit(Run, args, Deliver)
+  if buffer_num is not None:
+    g_pending_jobs_[buffer_num] = job
+  vim.eval('crcs#StartJobPolling()')
+
+
+def _DeliverJob(callback, job, record):
+  """\
+  Invokes |callback| with the completed |job| on behalf of the command whose
+  stats are in |record|. Errors are reported instead of being raised. Returns
+  False if |callback| failed.
+  """
+  failed = object()
+  with _GetStats().Activate(record):
+    try:
+      return _CallAndReportErrors(callback, failed, job) is not failed
+    except Exception as e:
+      # Letting it escape into the timer would hold up the other completed
+      # jobs.
+      EchoVimError('internal error: {}'.format(e))
+      return False
+
+
+@CalledFromVim(default=True, record_stats=False)
+def DispatchCompletedJobs():
+  """\
+  Called periodically from a Vim timer while there are outstanding jobs.
+  Returns True if the timer should keep running.
+  """
+  if not g_worker_pool:
+    return False
+  return g_worker_pool.DispatchCompleted()
+
+
 def _SetupVimBuffer(t, name):
   assert g_codesearch
 
@@ -183,12 +543,111 @@ def _GetLocationMapForCurrentBuffer():
   if buffer_num not in g_buffer_map_:
     vim.command('echo "Buffer #{} not in map"'.format(buffer_num))
     return None
-  return g_buffer_map_[buffer_num]
+  # None if the results couldn't be loaded back from disk.
+  return g_buffer_map_.get(buffer_num)
+
+
+def _ShowLocationMapInBuffer(buffer_num, location_map):
+  _CancelPrefetch(g_buffer_map_.get(buffer_num))
+  g_buffer_map_[buffer_num] = location_map
+  with _Stage('buffer') as stage:
+    lines = location_map.Lines()
+    stage.size = len(lines)
+    vim.eval('setbufvar({}, "&modifiable", 1)'.format(buffer_num))
+    vim.buffers[buffer_num][:] = lines
+    vim.eval('setbufvar({}, "&modifiable", 0)'.format(buffer_num))
+  _ApplyHighlightSpans(buffer_num, location_map)
+
+
+def _ByteColumn(line, column):
+  # Vim counts columns in bytes while rendered lines are counted in characters
+  # under Python 3.
+  prefix = line[:column]
+  if isinstance(prefix, bytes):
+    return len(prefix)
+  return len(prefix.encode('utf-8'))
+
+
+def _ApplyHighlightSpans(buffer_num, location_map, first=None, last=None):
+  """\
+  Replace the highlighting in |buffer_num| with the spans in |location_map|.
+  If |first| and |last| are given, only lines |first| through |last| are
+  touched.
+  """
+  if location_map.highlight_spans_ is None:
+    return
+  with _Stage('highlight') as stage:
+    lines = location_map.Lines()
+    spans = []
+    for (start_line, start_column), (end_line, end_column), group in \
+        location_map.HighlightSpans(first or 0, last):
+      spans.append([
+          start_line,
+          _ByteColumn(lines[start_line], start_column), end_line,
+          _ByteColumn(lines[end_line], end_column), group
+      ])
+    stage.size = len(spans)
+    vim.vars['crcs_highlight_spans'] = spans
+    line_range = '' if first is None else ', {}, {}'.format(first, last)
+    vim.command('call crcs#ApplyHighlightSpans({}, g:crcs_highlight_spans{})'
+                ' | unlet g:crcs_highlight_spans'.format(
+                    buffer_num, line_range))
+
+
+def _ShowPendingRequestInBuffer(buffer_num, query):
+  if _IsAsyncEnabled():
+    location_map = RenderPendingRequest(query)
+    setattr(location_map, 'pending_query', query)
+    _ShowLocationMapInBuffer(buffer_num, location_map)
+
+
+def _ShowFailedRequestInBuffer(buffer_num):
+  # Results that made it into the buffer before the failure are left alone.
+  query = getattr(g_buffer_map_.get(buffer_num), 'pending_query', None)
+  if query is not None:
+    _ShowLocationMapInBuffer(buffer_num, RenderFailedRequest(query))
+
+
+def _LoadQuickFixList(lines, title=None):
+  if not lines:
+    return
+  vim.vars['crcs_quickfix_lines'] = lines
+  if title is None:
+    vim.command('cexpr g:crcs_quickfix_lines | unlet g:crcs_quickfix_lines')
+    return
+  vim.command(
+      'call setqflist([], " ", {{"title": {}, "lines": g:crcs_quickfix_lines}})'
+      ' | unlet g:crcs_quickfix_lines'.format(EscapeVimString(title)))
+
+
+def _LoadQuickFixLists(tours):
+  # Loaded in reverse so that the first tour ends up as the current list and
+  # :colder moves on to the next one.
+  for title, lines in reversed(tours):
+    _LoadQuickFixList(lines, title)
+
+
+def _CanSpillBuffer(buffer_num):
+  # Responses that are in flight for a buffer are applied to the
+  # LocationMapper at hand. Hence it has to stay put until they arrive.
+  if buffer_num in g_pending_jobs_ or buffer_num in g_pending_pages_:
+    return False
+  return not vim.eval('win_findbuf({})'.format(buffer_num))
+
+
+def _DropPrefetcher(location_map):
+  # A call graph in a hidden buffer isn't going to be expanded any time soon.
+  # Prefetched results are dropped along with the Prefetcher.
+  _CancelPrefetch(location_map)
+  if getattr(location_map, 'prefetcher', None) is not None:
+    delattr(location_map, 'prefetcher')
 
 
 @CalledFromVim()
 def CleanupBuffer(buffer_num):
-  del g_buffer_map_[buffer_num]
+  _CancelPrefetch(g_buffer_map_.pop(buffer_num))
+  g_pending_jobs_.pop(buffer_num, None)
+  g_pending_pages_.pop(buffer_num, None)
 
 
 def _GetJumpTargetAtPos():
@@ -207,6 +666,13 @@ def JumpToContext():
   if root_path is None or root_path == '':
     return
 
+  location_map = g_buffer_map_.get(vim.current.buffer.number)
+  continuation = getattr(location_map, 'continuation_', None)
+  if continuation is not None and \
+      int(vim.eval("line('.')")) == continuation.position[0] + 1:
+    _LoadMoreSearchResults(vim.current.buffer.number, location_map, 1)
+    return
+
   target = _GetJumpTargetAtPos()
   if target is None:
     return
@@ -240,10 +706,26 @@ def JumpToPrevFile():
   vim.command('norm zz')
 
 
+@CalledFromVim()
+def JumpToNthFile(n):
+  location_map = _GetLocationMapForCurrentBuffer()
+  if location_map is None:
+    return
+  line = location_map.NthFileLocation(n)
+  if line is None:
+    EchoVimError('there are only {} files in the results.'.format(
+        location_map.FileCount()))
+    return
+  vim.eval("setpos('.', [%d, %d, %d, %d])" % (0, line, 1, 0))
+  vim.command('norm zz')
+
+
 def _GetSignatureAtSource():
   buffer_num = vim.current.buffer.number
   if buffer_num in g_buffer_map_:
-    location_map = g_buffer_map_[buffer_num]
+    location_map = g_buffer_map_.get(buffer_num)
+    if location_map is None:
+      return None
     return location_map.SignatureAt(int(vim.eval("line('.')")))
 
   _, line, column, _ = vim.eval("getpos('.')")
@@ -253,32 +735,259 @@ def _GetSignatureAtSource():
   filename = vim.eval("expand('%:p')")
   cs = _GetCodeSearch(filename)
 
-  if cs.IsContentStale(filename, vim.current.buffer[:line], check_prefix=True):
+  if _IsBufferStale(cs, filename, line):
     return cs.GetSignatureForSymbol(filename, vim.eval("expand('<cword>')"))
 
-  return cs.GetSignatureForLocation(filename, line, column)
+  index = _GetAnnotationIndex(cs, vim.current.buffer.number, filename)
+  signature = index.SignatureAt(line, column)
+  if signature is None:
+    raise NotFoundError('Can\'t determine signature for {}:{}:{}'.format(
+        filename, line, column))
+  return signature
+
+
+def _IsBufferStale(cs, filename, line):
+  """\
+  Returns True if the first |line| lines of the current buffer differ from the
+  indexed version of |filename|.
+  """
+  buffer = vim.current.buffer
+  cached = g_staleness_trackers_.pop(buffer.number, None)
+  if cached is None or cached[0] != filename:
+    cached = (filename, StalenessTracker())
+  g_staleness_trackers_[buffer.number] = cached
+  while len(g_staleness_trackers_) > STALENESS_TRACKER_COUNT:
+    g_staleness_trackers_.popitem(last=False)
+
+  return cached[1].IsStale(
+      line, int(vim.eval('b:changedtick')),
+      lambda start, end: buffer[start:end],
+      lambda lines: cs.IsContentStale(filename, lines, check_prefix=True))
+
+
+def _GetAnnotationIndex(cs, buffer_num, filename):
+  """\
+  Returns an AnnotationIndex for the XREF_SIGNATURE annotations of |filename|,
+  which is shown in buffer |buffer_num|. Annotations are only fetched again if
+  the buffer now shows a different file or the file was modified on disk.
+  """
+  try:
+    mtime = os.path.getmtime(filename)
+  except OSError:
+    mtime = None
+
+  cached = g_annotation_indexes_.pop(buffer_num, None)
+  if cached is not None and cached[:2] == (filename, mtime):
+    g_annotation_indexes_[buffer_num] = cached
+    return cached[2]
+
+  result = cs.GetAnnotationsForFile(
+      filename, [AnnotationType(id=AnnotationTypeValue.XREF_SIGNATURE)])
+  index = AnnotationIndex(result.annotation_response[0].annotation)
+  g_annotation_indexes_[buffer_num] = (filename, mtime, index)
+  while len(g_annotation_indexes_) > ANNOTATION_INDEX_COUNT:
+    g_annotation_indexes_.popitem(last=False)
+  return index
+
+
+def _SendAndRender(cs, request, query):
+  response = cs.SendRequestToServer(request)
+  with _Stage('render'):
+    return RenderCompoundResponse(response, query)
+
+
+# Number of results per page of search results, and number of lines of context
+# around matching lines in search results.
+SEARCH_PAGE_SIZE = 100
+SEARCH_LINES_CONTEXT = 3
+
+
+def _SearchRequest(q, results_offset=0):
+  args = dict(
+      query=q,
+      return_all_snippets=False,
+      return_snippets=True,
+      max_num_results=SEARCH_PAGE_SIZE,
+      lines_context=SEARCH_LINES_CONTEXT,
+      return_decorated_snippets=True)
+  # Only subsequent pages specify an offset. The request for the first page is
+  # the same as it has always been.
+  if results_offset > 0:
+    args['results_offset'] = results_offset
+  return CompoundRequest(search_request=[SearchRequest(**args)])
+
+
+def _GetLocalSearchMode():
+  if 'codesearch_local_search' in vim.vars:
+    return _ToStr(vim.vars['codesearch_local_search'])
+  return 'off'
+
+
+def _GetLocalIndex(cs):
+  """\
+  Returns the TrigramIndex over the source checkout, or None unless
+  g:codesearch_local_search is 'fallback' or 'always'. Starts bringing the
+  index up to date in the background unless that happened recently.
+  """
+  global g_local_index_
+  if _GetLocalSearchMode() not in ('fallback', 'always'):
+    return None
+
+  root = os.path.abspath(os.path.expanduser(_ToStr(cs.GetSourceRoot())))
+  if g_local_index_ is None or g_local_index_.root_ != root:
+    if g_local_index_ is not None:
+      g_local_index_.Close()
+    index_dir = None
+    if 'codesearch_local_index_dir' in vim.vars:
+      index_dir = os.path.join(
+          os.path.expanduser(_ToStr(vim.vars['codesearch_local_index_dir'])),
+          hashlib.sha1(root.encode('utf-8')).hexdigest())
+
+    excludes = DEFAULT_EXCLUDES
+    if 'codesearch_local_index_exclude' in vim.vars:
+      excludes = [
+          _ToStr(p) for p in vim.vars['codesearch_local_index_exclude']
+      ]
+
+    update_interval = DEFAULT_UPDATE_INTERVAL_IN_SECONDS
+    if 'codesearch_local_index_update_interval_in_seconds' in vim.vars:
+      update_interval = int(
+          vim.vars['codesearch_local_index_update_interval_in_seconds'])
+
+    g_local_index_ = TrigramIndex(
+        root,
+        index_dir=index_dir,
+        excludes=excludes,
+        update_interval=update_interval)
+    atexit.register(g_local_index_.Close)
+
+  g_local_index_.UpdateInBackground()
+  return g_local_index_
+
+
+def _SendSearchRequest(cs, query, results_offset, local_index, local_only):
+  """\
+  Returns a (CompoundResponse, searched locally) tuple with the results for
+  |query| starting at |results_offset|. They come from |local_index| if
+  |local_only| is set, or if there's a |local_index| and the server can't be
+  reached. Otherwise they come from the server.
+  """
+  if not local_only:
+    try:
+      return cs.SendRequestToServer(_SearchRequest(query, results_offset)), \
+          False
+    except (URLError, SSLError, socket.error):
+      if local_index is None:
+        raise
+
+  with _Stage('local_search'):
+    response = local_index.Search(
+        query,
+        results_offset=results_offset,
+        max_num_results=SEARCH_PAGE_SIZE,
+        lines_context=SEARCH_LINES_CONTEXT)
+    return Message.Coerce(response, CompoundResponse), True
+
+
+def _SendAndRenderSearch(cs, query, local_index, local_only):
+  response, searched_locally = _SendSearchRequest(cs, query, 0, local_index,
+                                                  local_only)
+  with _Stage('render'):
+    location_map = RenderCompoundResponse(response, query)
+  location_map.searched_locally = searched_locally
+  return location_map
+
+
+def _SendAndRenderSearchPage(cs, query, results_offset, local_index,
+                             local_only):
+  response, _ = _SendSearchRequest(cs, query, results_offset, local_index,
+                                   local_only)
+  with _Stage('render'):
+    return RenderSearchResponsePage(query, response.search_response[0])
+
+
+def _GetSearchPageCount():
+  if 'codesearch_search_page_count' in vim.vars:
+    return max(1, int(vim.vars['codesearch_search_page_count']))
+  return 1
+
+
+def _LoadMoreSearchResults(buffer_num, location_map, page_count):
+  """\
+  Fetches up to |page_count| more pages of search results, one after the
+  other, and appends each to the results in |buffer_num| as it arrives. Lines
+  preceding the truncation notice are left as is.
+  """
+  continuation = location_map.continuation_
+  if page_count <= 0 or continuation is None or buffer_num in g_pending_pages_:
+    return
+  g_pending_pages_[buffer_num] = continuation
+
+  def OnPage(job):
+    if g_pending_pages_.get(buffer_num) is not continuation:
+      return
+    del g_pending_pages_[buffer_num]
+    # The buffer may have been wiped or may be showing different results by
+    # now.
+    if g_buffer_map_.get(buffer_num) is not location_map or \
+        location_map.continuation_ is not continuation:
+      return
+
+    page = job.Result()
+    with _Stage('render'):
+      first = AppendSearchResponsePage(location_map, page)
+    with _Stage('buffer') as stage:
+      lines = location_map.Lines()[first:]
+      stage.size = len(lines)
+      vim.eval('setbufvar({}, "&modifiable", 1)'.format(buffer_num))
+      vim.buffers[buffer_num][first:] = lines
+      vim.eval('setbufvar({}, "&modifiable", 0)'.format(buffer_num))
+    g_buffer_map_.Resize(buffer_num)
+    _ApplyHighlightSpans(buffer_num, location_map)
+    _LoadMoreSearchResults(buffer_num, location_map, page_count - 1)
+
+  # Later pages come from wherever the first page came from, since result
+  # offsets don't carry over between the server and the local index.
+  cs = _GetCodeSearch()
+  local_only = getattr(location_map, 'searched_locally', False)
+  local_index = _GetLocalIndex(cs)
+  if local_only and local_index is None:
+    return
+  _RunRequest(_SendAndRenderSearchPage,
+              (cs, continuation.query, continuation.results_offset,
+               local_index, local_only), OnPage)
+
+
+@CalledFromVim()
+def LoadMoreSearchResults():
+  location_map = _GetLocationMapForCurrentBuffer()
+  if getattr(location_map, 'continuation_', None) is None:
+    EchoVimError('there are no more search results.')
+    return
+  _LoadMoreSearchResults(vim.current.buffer.number, location_map, 1)
 
 
 @CalledFromVim()
 def RunCodeSearch(q):
   cs = _GetCodeSearch()
   buffer_num = _SetupVimBuffer('search', 'Codesearch: %s' % (q))
-  response = cs.SendRequestToServer(
-      CompoundRequest(search_request=[
-          SearchRequest(
-              query=q,
-              return_all_snippets=False,
-              return_snippets=True,
-              max_num_results=100,
-              lines_context=3,
-              return_decorated_snippets=True)
-      ]))
+  _ShowPendingRequestInBuffer(buffer_num, q)
+  local_index = _GetLocalIndex(cs)
+  local_only = local_index is not None and _GetLocalSearchMode() == 'always'
 
-  location_map = RenderCompoundResponse(response, q)
-  g_buffer_map_[buffer_num] = location_map
-  vim.command('setlocal modifiable')
-  vim.current.buffer[:] = location_map.Lines()
-  vim.command('setlocal nomodifiable')
+  def OnResponse(job):
+    location_map = job.Result()
+    _ShowLocationMapInBuffer(buffer_num, location_map)
+    if location_map.searched_locally and not local_index.IsReady():
+      EchoVimError('the local index is still being built. '
+                   'Results may be incomplete.')
+    elif location_map.searched_locally and not local_only:
+      EchoVimError('couldn\'t contact codesearch server. '
+                   'Showing results from the local index.')
+    _LoadMoreSearchResults(buffer_num, location_map, _GetSearchPageCount() - 1)
+
+  _RunRequest(_SendAndRenderSearch, (cs, q, local_index, local_only),
+              OnResponse, buffer_num)
 
 
 @CalledFromVim()
@@ -288,28 +997,140 @@ def RunXrefSearch():
     return
 
   buffer_num = _SetupVimBuffer('xref', 'Crossreferences')
+  _ShowPendingRequestInBuffer(buffer_num, signature)
   cs = _GetCodeSearch()
+  lazy = _IsLazyXrefsEnabled()
+  # Lazily rendered categories fetch further matches of their own as they are
+  # expanded. The initial response only needs enough for the first page.
+  request = CompoundRequest(xref_search_request=[
+      XrefSearchRequest(
+          query=signature,
+          file_spec=cs.GetFileSpec(),
+          max_num_results=XREF_CATEGORY_PAGE_SIZE if lazy else 100)
+  ])
+
+  if lazy:
+
+    def OnResponse(job):
+      location_map = job.Result()
+      setattr(location_map, 'xref_signature', signature)
+      _ShowLocationMapInBuffer(buffer_num, location_map)
+
+    _RunRequest(_SendAndRenderLazyXrefs, (cs, request), OnResponse, buffer_num)
+    return
+
+  _RunRequest(
+      _SendAndRender, (cs, request, signature),
+      lambda job: _ShowLocationMapInBuffer(buffer_num, job.Result()),
+      buffer_num)
+
+
+def _IsLazyXrefsEnabled():
+  return 'codesearch_lazy_xrefs' in vim.vars and int(
+      vim.vars['codesearch_lazy_xrefs'])
+
+
+def _SendAndRenderLazyXrefs(cs, request):
+  response = cs.SendRequestToServer(request)
+  with _Stage('render'):
+    location_map = LocationMapper()
+    RenderLazyXrefSearchResponse(location_map,
+                                 response.xref_search_response[0])
+    return location_map
+
+
+def _FetchXrefCategory(cs, signature, type_id, page_token):
+  """\
+  Fetches a page of XREF_CATEGORY_PAGE_SIZE cross references of kind |type_id|
+  to |signature|, continuing from |page_token| unless it's None. Returns a
+  tuple of the matches and the token for the next page, which is empty if
+  there are no more.
+  """
+  # The 'References' category collects every kind of cross reference that
+  # doesn't have a category of its own. Plain references are by far the most
+  # common of those.
+  kind = type_id if type_id else KytheXrefKind.REFERENCE
+  arguments = {}
+  if page_token:
+    arguments['page_token'] = page_token
   response = cs.SendRequestToServer(
       CompoundRequest(xref_search_request=[
           XrefSearchRequest(
-              query=signature, file_spec=cs.GetFileSpec(), max_num_results=100)
+              query=signature,
+              file_spec=cs.GetFileSpec(),
+              max_num_results=XREF_CATEGORY_PAGE_SIZE,
+              edge_filter=[kind],
+              **arguments)
       ]))
+  xref_search_response = response.xref_search_response[0]
+  matches = []
+  for bin_type_id, _, bin_matches in BinXrefMatches(xref_search_response):
+    if bin_type_id == type_id:
+      matches = bin_matches
+  return matches, xref_search_response.kythe_next_page_token or ''
 
-  location_map = RenderCompoundResponse(response, signature)
-  g_buffer_map_[buffer_num] = location_map
-  vim.command('setlocal modifiable')
-  vim.current.buffer[:] = location_map.Lines()
-  vim.command('setlocal nomodifiable')
 
+def _GetXrefCategoryAtCursor():
+  location_map = g_buffer_map_.get(vim.current.buffer.number)
+  if getattr(location_map, 'xref_signature', None) is None:
+    return None, None
+  return location_map, location_map.NodeAt(int(vim.eval("line('.')")))
+
+
+@CalledFromVim()
+def ExpandXrefCategory():
+  """\
+  Expands the xref category under the cursor, or shows the next
+  XREF_CATEGORY_PAGE_SIZE matches if it is already expanded. Matches are only
+  fetched from the server if the ones at hand run out, a page at a time.
+  """
+  location_map, category = _GetXrefCategoryAtCursor()
+  if category is None or getattr(category, 'fetching', False):
+    return
+
+  shown = XREF_CATEGORY_PAGE_SIZE
+  if category.expanded:
+    if category.complete and category.shown == len(category.matches):
+      # Nothing to do.
+      return
+    shown += category.shown
+
+  buffer_num = vim.current.buffer.number
+  if shown <= len(category.matches) or category.complete:
+    category.expanded = True
+    category.shown = min(shown, len(category.matches))
+    RerenderXrefCategoryInBuffer(location_map, category, buffer_num)
+    return
+
+  def OnResponse(job):
+    setattr(category, 'fetching', False)
+    g_buffer_map_.Unpin(buffer_num)
+    # The buffer may have been wiped or may be showing different results by
+    # now.
+    if g_buffer_map_.get(buffer_num) is not location_map:
+      return
+    matches, next_page_token = job.Result()
+    category.MergeFetchedMatches(matches, next_page_token)
+    category.expanded = True
+    category.shown = min(shown, len(category.matches))
+    RerenderXrefCategoryInBuffer(location_map, category, buffer_num)
+
+  setattr(category, 'fetching', True)
+  g_buffer_map_.Pin(buffer_num)
+  cs = _GetCodeSearch()
+  _RunRequest(_FetchXrefCategory,
+              (cs, location_map.xref_signature, category.type_id,
+               category.page_token), OnResponse)
 
-def _FindNodeForSignature(node, signature):
-  if node.signature == signature:
-    return node
-  for child in node.children:
-    n = _FindNodeForSignature(child, signature)
-    if n is not None:
-      return n
-  return None
+
+@CalledFromVim()
+def CollapseXrefCategory():
+  location_map, category = _GetXrefCategoryAtCursor()
+  if category is None or not category.expanded:
+    return
+  category.expanded = False
+  RerenderXrefCategoryInBuffer(location_map, category,
+                               vim.current.buffer.number)
 
 
 @CalledFromVim()
@@ -319,14 +1140,15 @@ def RunCallgraphSearch():
   parent_node = None
   root_node = None
   if is_nested_query:
-    if vim.current.buffer.number not in g_buffer_map_:
+    location_map = g_buffer_map_.get(vim.current.buffer.number)
+    if location_map is None:
       return
 
-    location_map = g_buffer_map_[vim.current.buffer.number]
-    signature = location_map.SignatureAt(int(vim.eval("line('.')")))
+    parent_node = location_map.NodeAt(int(vim.eval("line('.')")))
+    if parent_node is None:
+      return
+    signature = parent_node.signature
     root_node = location_map.root_node
-    parent_node = _FindNodeForSignature(root_node, signature)
-    assert parent_node is not None
   else:
     signature = _GetSignatureAtSource()
 
@@ -338,7 +1160,74 @@ def RunCallgraphSearch():
     return
 
   cs = _GetCodeSearch()
-  response = cs.SendRequestToServer(
+  if parent_node is not None:
+    buffer_num = vim.current.buffer.number
+  else:
+    buffer_num = _SetupVimBuffer('call', 'Callgraph')
+    _ShowPendingRequestInBuffer(buffer_num, signature)
+
+  def OnResponse(response):
+    if response is None:
+      return
+
+    if parent_node is not None:
+      assert root_node is not None
+
+      # The buffer may have been wiped or may be showing a different call
+      # graph by now.
+      current_map = g_buffer_map_.get(buffer_num)
+      if getattr(current_map, 'root_node', None) is not root_node:
+        return
+
+      if not response.call_graph_response:
+        # |parent_node| has no children known to the server.
+        setattr(parent_node, 'children', [])
+      else:
+        # |new_node.children| are the new children that we are going to
+        # attach to the parent node.
+        new_node = response.call_graph_response[0].node
+
+        assert parent_node.signature == new_node.signature
+        if new_node.children:
+          setattr(parent_node, 'children', new_node.children)
+        else:
+          setattr(parent_node, 'children', [])
+      RerenderCallGraphNodeInBuffer(current_map, parent_node, buffer_num)
+      _PrefetchCallers(current_map, parent_node.children)
+
+    else:
+      RenderCallGraphInBuffer(response.call_graph_response[0].node, buffer_num)
+
+  def OnJobDone(job):
+    if parent_node is not None:
+      g_buffer_map_.Unpin(buffer_num)
+    # The nodes in the response become part of the call graph. The response
+    # is copied since it can be shared with other requests for the same
+    # signature, whether prefetched or coalesced, and the same signature can
+    # appear more than once in the graph.
+    OnResponse(copy.deepcopy(job.Result()))
+
+  if parent_node is not None:
+    # The response is attached to |parent_node|. Hence the call graph has to
+    # stay in memory until it arrives.
+    g_buffer_map_.Pin(buffer_num)
+
+    # A prefetched job is delivered by the job polling timer like any other,
+    # except that it doesn't pass through _RunRequest.
+    record = _GetStats().Current()
+    prefetcher = getattr(location_map, 'prefetcher', None)
+    if prefetcher is not None and prefetcher.WhenDone(
+        signature, lambda job: _DeliverJob(OnJobDone, job, record)):
+      return
+
+  # Expanding a node doesn't supersede an earlier expansion of another node in
+  # the same buffer. Hence only top level queries are tied to |buffer_num|.
+  _RunRequest(_FetchCallGraph, (cs, signature), OnJobDone,
+              buffer_num if parent_node is None else None)
+
+
+def _FetchCallGraph(cs, signature):
+  return cs.SendRequestToServer(
       CompoundRequest(call_graph_request=[
           CallGraphRequest(
               signature=signature,
@@ -346,57 +1235,102 @@ def RunCallgraphSearch():
               max_num_results=100)
       ]))
 
-  if response is None:
-    return
 
-  if parent_node is not None:
-    assert root_node is not None
+def _GetCallerSignatures(response):
+  if response is None or not response.call_graph_response:
+    return []
+  node = response.call_graph_response[0].node
+  return [c.signature for c in node.children or [] if c.signature]
 
-    if not response.call_graph_response:
-      # |parent_node| has no children known to the server.
-      setattr(parent_node, 'children', [])
-    else:
-      # |new_node.children| are the new children that we are going to
-      # attach to the parent node.
-      new_node = response.call_graph_response[0].node
 
-      assert parent_node.signature == new_node.signature
-      if new_node.children:
-        setattr(parent_node, 'children', new_node.children)
-      else:
-        setattr(parent_node, 'children', [])
-    buffer_num = vim.current.buffer.number
+def _GetCallGraphPrefetchDepth():
+  if 'codesearch_callgraph_prefetch_depth' in vim.vars:
+    return int(vim.vars['codesearch_callgraph_prefetch_depth'])
+  return 0
 
-  else:
-    root_node = response.call_graph_response[0].node
-    buffer_num = _SetupVimBuffer('call', 'Callgraph')
 
-  RenderCallGraphInBuffer(root_node, buffer_num)
+def _PrefetchCallers(location_map, nodes):
+  """\
+  Starts fetching the callers of those |nodes| that haven't been expanded yet,
+  if prefetching is enabled for the call graph in |location_map|.
+  """
+  prefetcher = getattr(location_map, 'prefetcher', None)
+  if prefetcher is None:
+    return
+  for node in nodes:
+    rendered = location_map.GetRenderedNode(node)
+    if rendered is not None and not node.children and node.signature:
+      prefetcher.Prefetch(node.signature, rendered.level)
+  vim.eval('crcs#StartJobPolling()')
+
+
+def _CancelPrefetch(location_map):
+  prefetcher = getattr(location_map, 'prefetcher', None)
+  if prefetcher is not None:
+    prefetcher.Cancel()
 
 
 def RenderCallGraphInBuffer(root_node, buffer_num):
-  location_map = LocationMapper()
-  RenderNode(location_map, root_node, 0)
+  with _Stage('render'):
+    location_map = LocationMapper()
+    RenderNode(location_map, root_node, 0)
   setattr(location_map, 'root_node', root_node)
-  g_buffer_map_[buffer_num] = location_map
 
-  vim.command('setlocal modifiable')
-  vim.current.buffer[:] = location_map.Lines()
-  vim.command('setlocal nomodifiable')
+  depth = _GetCallGraphPrefetchDepth()
+  if depth > 0:
+    cs = _GetCodeSearch()
+    setattr(location_map, 'prefetcher',
+            Prefetcher(_GetWorkerPool(), lambda s: _FetchCallGraph(cs, s),
+                       _GetCallerSignatures, depth))
+
+  _ShowLocationMapInBuffer(buffer_num, location_map)
+  _PrefetchCallers(location_map, root_node.children or [])
+
+
+def RerenderCallGraphNodeInBuffer(location_map, node, buffer_num):
+  """\
+  Updates the call graph in |buffer_num| after the children of |node| have
+  changed. Only the lines corresponding to |node| are replaced.
+  """
+  with _Stage('render'):
+    change = RerenderNode(location_map, node)
+  _ApplyChangeToBuffer(buffer_num, location_map, change)
+
+
+def RerenderXrefCategoryInBuffer(location_map, category, buffer_num):
+  """\
+  Updates the xref category |category| in |buffer_num| after it was expanded
+  or collapsed. Only the lines corresponding to |category| are replaced.
+  """
+  with _Stage('render'):
+    change = RerenderXrefCategory(location_map, category)
+  _ApplyChangeToBuffer(buffer_num, location_map, change)
+
+
+def _ApplyChangeToBuffer(buffer_num, location_map, change):
+  if change is None:
+    return
+  first, last, lines = change
+  with _Stage('buffer') as stage:
+    stage.size = len(lines)
+    vim.eval('setbufvar({}, "&modifiable", 1)'.format(buffer_num))
+    vim.buffers[buffer_num][first:last + 1] = lines
+    vim.eval('setbufvar({}, "&modifiable", 0)'.format(buffer_num))
+  g_buffer_map_.Resize(buffer_num)
+  # Spans outside the spliced lines move along with their lines.
+  _ApplyHighlightSpans(buffer_num, location_map, first,
+                       first + len(lines) - 1)
 
 
 @CalledFromVim()
 def CloseCallgraphFold():
-  if vim.current.buffer.number not in g_buffer_map_:
+  location_map = g_buffer_map_.get(vim.current.buffer.number)
+  if location_map is None:
     return
 
-  location_map = g_buffer_map_[vim.current.buffer.number]
-  signature = location_map.SignatureAt(int(vim.eval("line('.')")))
-  if not signature:
+  parent_node = location_map.NodeAt(int(vim.eval("line('.')")))
+  if parent_node is None:
     return
-  root_node = location_map.root_node
-  parent_node = _FindNodeForSignature(root_node, signature)
-  assert parent_node is not None
 
   if not parent_node.children:
     # Nothing to do.
@@ -404,23 +1338,20 @@ def CloseCallgraphFold():
 
   parent_node.children = []
 
-  RenderCallGraphInBuffer(root_node, vim.current.buffer.number)
+  RerenderCallGraphNodeInBuffer(location_map, parent_node,
+                                vim.current.buffer.number)
 
 
-@CalledFromVim(default='')
-def GetCallers():
-  signature = _GetSignatureAtSource()
-  if not signature:
-    return ''
-
-  cs = _GetCodeSearch()
-  response = cs.GetCallGraph(signature)
+def _GetCallerLocations(cs, signature):
+  # Same request as for expanding a call graph node so that the two can share
+  # responses.
+  response = _FetchCallGraph(cs, signature)
   if response is None or not response.call_graph_response:
-    return ''
+    return []
 
   node = response.call_graph_response[0].node
   if not node.children:
-    return ''
+    return []
 
   lines = []
   for c in node.children:
@@ -430,50 +1361,99 @@ def GetCallers():
         os.path.join(cs.GetSourceRoot(),
                      c.file_path), c.call_site_range.start_line,
         c.call_site_range.start_column, c.identifier))
-  return '\n'.join(lines)
-
-
-def _XrefSearchResultsToQuickFixList(cs, results):
-  lines = []
-  assert isinstance(results, list)
-  for r in results:
-    assert isinstance(r, XrefNode)
-    if not r.single_match.line_number or not r.single_match.line_text:
-      continue
-    filepath = os.path.join(cs.GetSourceRoot(), r.filespec.name)
-    lines.append('{}:{}:1: {}'.format(filepath, r.single_match.line_number,
-                                      r.single_match.line_text))
   return lines
 
 
-def _GetLocationsForXrefType(t):
+@CalledFromVim(default='')
+def GetCallers():
   signature = _GetSignatureAtSource()
   if not signature:
-    return []
+    return ''
 
   cs = _GetCodeSearch()
-  node = XrefNode.FromSignature(cs, signature)
-  results = node.Traverse(t)
-  return _XrefSearchResultsToQuickFixList(cs, results)
+  if _IsAsyncEnabled():
+    _RunRequest(_GetCallerLocations, (cs, signature),
+                lambda job: _LoadQuickFixList(job.Result()))
+    return ''
 
+  return '\n'.join(_GetCallerLocations(cs, signature))
 
-def _GetCallTargets():
-  signature = _GetSignatureAtSource()
-  if not signature:
-    return []
-  cs = _GetCodeSearch()
-  node = XrefNode.FromSignature(cs, signature)
-  dcl_list = node.Traverse(
-      [KytheXrefKind.DECLARATION, KytheXrefKind.DEFINITION])
-  if len(dcl_list) == 0:
-    return []
 
-  overrides = []
-  for dcl in dcl_list:
-    overrides.extend(dcl.Traverse(KytheXrefKind.OVERRIDDEN_BY))
+def _XrefMatchesToQuickFixList(cs, matches):
+  lines = []
+  for filespec, match in matches:
+    if not match.line_number or not match.line_text:
+      continue
+    filepath = os.path.join(cs.GetSourceRoot(), filespec.name)
+    lines.append('{}:{}:1: {}'.format(filepath, match.line_number,
+                                      match.line_text))
+  return lines
+
+
+def _GetLocationsForXrefType(cs, signature, t):
+  results = _SearchXrefs(cs, [signature])[0]
+  return _XrefMatchesToQuickFixList(cs, PartitionByKind(results).get(t, []))
+
 
-  results = dcl_list + overrides
-  return _XrefSearchResultsToQuickFixList(cs, results)
+def _GetTours(cs, signature, tour_types):
+  """\
+  Returns a list of (title, quickfix lines) tuples, one for each of the tour
+  types in |tour_types|. The cross references for |signature| are only fetched
+  once for all of them.
+  """
+  tours = []
+  for tour_type in tour_types:
+    resolved_type = REFERENCE_TYPES[tour_type]
+    if callable(resolved_type):
+      lines = resolved_type(cs, signature)
+    else:
+      lines = _GetLocationsForXrefType(cs, signature, resolved_type)
+    tours.append(('CrTour {}'.format(tour_type), lines))
+  return tours
+
+
+def _SearchXrefs(cs, signatures):
+  """\
+  Looks up the cross references for all of |signatures|. Returns a list
+  containing the list of XrefSearchResults for each signature.
+
+  Signatures that were looked up recently are answered from memory. The rest
+  are looked up using a single CompoundRequest.
+  """
+  found = {}
+  with g_xref_memo_lock_:
+    for s in signatures:
+      if s in g_xref_memo_:
+        found[s] = g_xref_memo_.pop(s)
+        g_xref_memo_[s] = found[s]
+
+  missing = [s for s in signatures if s not in found]
+  if missing:
+    response = cs.SendRequestToServer(
+        CompoundRequest(xref_search_request=[
+            XrefSearchRequest(
+                query=s, file_spec=cs.GetFileSpec(), max_num_results=500)
+            for s in missing
+        ]))
+    if response is not None and response.xref_search_response:
+      with g_xref_memo_lock_:
+        for s, r in zip(missing, response.xref_search_response):
+          found[s] = r.search_result or []
+          g_xref_memo_[s] = found[s]
+        while len(g_xref_memo_) > XREF_MEMO_SIZE:
+          g_xref_memo_.popitem(last=False)
+
+  return [found.get(s, []) for s in signatures]
+
+
+def _GetCallTargets(cs, signature):
+  # Declarations and definitions of |signature|, followed by everything that
+  # overrides any of them. Each hop is a single round trip.
+  hops = [[KytheXrefKind.DECLARATION, KytheXrefKind.DEFINITION],
+          [KytheXrefKind.OVERRIDDEN_BY]]
+  matches = TraverseXrefs(lambda signatures: _SearchXrefs(cs, signatures),
+                          signature, hops)
+  return _XrefMatchesToQuickFixList(cs, matches)
 
 
 REFERENCE_TYPES = {
@@ -493,22 +1473,36 @@ REFERENCE_TYPES = {
 }
 
 
+# The tour types that make up ":CrTour all", in the order in which their
+# quickfix lists are presented.
+ALL_TOUR_TYPES = [
+    'declaration',
+    'definition',
+    'caller',
+    'references',
+    'overrides',
+    'overridden by',
+    'extends',
+    'extended by',
+    'instantiations',
+]
+
+
 @CalledFromVim(default=[])
 def ReferenceTypeCompleter(arglead, cmdline, cursorpos):
   if arglead == '':
-    return REFERENCE_TYPES.keys()
+    return sorted(REFERENCE_TYPES.keys()) + ['all']
 
   candidates = []
   arglead = arglead.lower()
-  for k in REFERENCE_TYPES.iterkeys():
+  for k in sorted(REFERENCE_TYPES.keys()) + ['all']:
     if k.startswith(arglead):
       candidates.append(k)
   return candidates
 
 
-@CalledFromVim(default=[])
-def GetReferences(type_string):
-  type_string = type_string.lower()
+def _ResolveTourType(type_string):
+  type_string = type_string.strip().lower()
   if type_string not in REFERENCE_TYPES:
     for s in REFERENCE_TYPES.keys():
       if s.startswith(type_string):
@@ -516,29 +1510,60 @@ def GetReferences(type_string):
         break
 
   if type_string not in REFERENCE_TYPES:
+    return None
+  return type_string
+
+
+@CalledFromVim(default=[])
+def GetReferences(type_string):
+  """\
+  Returns the quickfix lines for the tour named by |type_string|.
+
+  |type_string| can also be "all" or a comma separated list of tour types. In
+  that case each tour is loaded into its own quickfix list and the return
+  value is empty.
+  """
+  if type_string.strip().lower() == 'all':
+    tour_types = ALL_TOUR_TYPES
+  else:
+    tour_types = [_ResolveTourType(t) for t in type_string.split(',')]
+  if not tour_types or None in tour_types:
+    return []
+
+  signature = _GetSignatureAtSource()
+  if not signature:
     return []
 
-  resolved_type = REFERENCE_TYPES[type_string]
+  cs = _GetCodeSearch()
+  if len(tour_types) > 1:
+    _RunRequest(_GetTours, (cs, signature, tour_types),
+                lambda job: _LoadQuickFixLists(job.Result()))
+    return []
+
+  resolved_type = REFERENCE_TYPES[tour_types[0]]
   if callable(resolved_type):
-    return resolved_type()
+    func, args = resolved_type, (cs, signature)
+  else:
+    func, args = _GetLocationsForXrefType, (cs, signature, resolved_type)
 
-  return _GetLocationsForXrefType(resolved_type)
+  if _IsAsyncEnabled():
+    _RunRequest(func, args, lambda job: _LoadQuickFixList(job.Result()))
+    return []
+
+  return func(*args)
 
 
 @CalledFromVim()
 def ShowAnnotationsHere():
   filename = vim.eval("expand('%:p')")
   cs = _GetCodeSearch(filename)
-  result = cs.GetAnnotationsForFile(
-      filename, [AnnotationType(id=AnnotationTypeValue.XREF_SIGNATURE)])
-  result = result.annotation_response[0]
+  index = _GetAnnotationIndex(cs, vim.current.buffer.number, filename)
   _, line, column, _ = vim.eval("getpos('.')")
   line = int(line)
   column = int(column)
-  for annotation in result.annotation:
-    if annotation.range.Contains(line, column):
-      vim.command('echo \'{}\''.format('&'.join(
-          '{}={}'.format(k, v) for k, v in annotation.AsQueryString())))
+  for annotation in index.AnnotationsAt(line, column):
+    vim.command('echo \'{}\''.format('&'.join(
+        '{}={}'.format(k, v) for k, v in annotation.AsQueryString())))
 
 
 @CalledFromVim()
@@ -553,5 +1578,8 @@ def ShowSignature():
 
 @CalledFromVim()
 def PrepareForTesting():
+  # The connection pool would replace the opener that serves the recorded
+  # responses.
+  vim.vars['codesearch_connection_pool_size'] = 0
   InstallTestRequestHandler(
       test_data_dir=vim.eval('g:codesearch_test_data_dir'))